@@ -0,0 +1,358 @@
+"""
+The `.apm` package archive format.
+
+    magic            8 bytes, b"APMARC\\x00\\x01"
+    manifest length  8 bytes, little-endian
+    manifest         JSON, utf-8
+    data             compressed chunks
+
+The manifest lists every file with its mode, size, SHA-256 and chunks.
+Each chunk is compressed on its own and records its offset into the data
+section, so a single file (like `.avalon/package`) can be read without
+touching the rest of the archive, and chunks can be decompressed in
+parallel.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+from typing import Any, BinaryIO, Iterable
+
+from apm.copier import iter_included_files
+
+MAGIC = b"APMARC\x00\x01"
+HEADER = struct.Struct("<8sQ")
+CHUNK_SIZE = 1024 * 1024
+
+
+class ArchiveError(Exception):
+    "Raised when an archive is malformed or fails verification."
+
+
+@dataclass
+class Chunk:
+    "A compressed slice of a file."
+
+    offset: int
+    compressed_size: int
+    size: int
+    sha256: str
+    codec: str = "zlib"
+
+
+@dataclass
+class Entry:
+    "A file or symlink in the archive."
+
+    path: str
+    mode: int = 0o644
+    size: int = 0
+    sha256: str = ""
+    link: str | None = None
+    chunks: list[Chunk] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, entry: Any) -> "Entry":
+        "Load an entry from the manifest, checking the types of its fields."
+
+        try:
+            chunks = [Chunk(*chunk) for chunk in entry.pop("chunks", [])]
+            loaded = cls(**entry, chunks=chunks)
+
+        except (AttributeError, TypeError) as exception:
+            raise ArchiveError(
+                f"Invalid manifest entry {entry!r}"
+            ) from exception
+
+        if not (
+            isinstance(loaded.path, str)
+            and _is_size(loaded.mode)
+            and _is_size(loaded.size)
+            and isinstance(loaded.sha256, str)
+            and isinstance(loaded.link, (str, type(None)))
+            and all(
+                _is_size(chunk.offset)
+                and _is_size(chunk.compressed_size)
+                and _is_size(chunk.size)
+                and isinstance(chunk.sha256, str)
+                and isinstance(chunk.codec, str)
+                for chunk in chunks
+            )
+        ):
+            raise ArchiveError(f"Invalid manifest entry for {loaded.path!r}")
+
+        return loaded
+
+    def to_dict(self) -> dict[str, Any]:
+        "Dump the entry for the manifest."
+
+        entry: dict[str, Any] = {"path": self.path, "mode": self.mode}
+
+        if self.link is not None:
+            entry["link"] = self.link
+            return entry
+
+        entry["size"] = self.size
+        entry["sha256"] = self.sha256
+        entry["chunks"] = [
+            [
+                chunk.offset,
+                chunk.compressed_size,
+                chunk.size,
+                chunk.sha256,
+                chunk.codec,
+            ]
+            for chunk in self.chunks
+        ]
+
+        return entry
+
+
+def _is_size(value: Any) -> bool:
+    return (
+        isinstance(value, int) and not isinstance(value, bool) and value >= 0
+    )
+
+
+def _compress_chunk(data: bytes) -> tuple[bytes, str]:
+    compressed = zlib.compress(data, 6)
+
+    if len(compressed) >= len(data):
+        return data, "none"
+
+    return compressed, "zlib"
+
+
+def _decompress_chunk(data: bytes, chunk: Chunk) -> bytes:
+    if chunk.codec == "zlib":
+        data = zlib.decompress(data)
+
+    elif chunk.codec != "none":
+        raise ArchiveError(f"Unknown codec `{chunk.codec}`")
+
+    if (
+        len(data) != chunk.size
+        or hashlib.sha256(data).hexdigest() != chunk.sha256
+    ):
+        raise ArchiveError("Chunk failed verification")
+
+    return data
+
+
+def _add_file(entry: Entry, file: BinaryIO, data: BinaryIO) -> None:
+    file_hash = hashlib.sha256()
+
+    while block := file.read(CHUNK_SIZE):
+        compressed, codec = _compress_chunk(block)
+        entry.chunks.append(
+            Chunk(
+                data.tell(),
+                len(compressed),
+                len(block),
+                hashlib.sha256(block).hexdigest(),
+                codec,
+            )
+        )
+        data.write(compressed)
+        file_hash.update(block)
+        entry.size += len(block)
+
+    entry.sha256 = file_hash.hexdigest()
+
+
+def pack(
+    src: Path, archive_path: Path, files: Iterable[Path] | None = None
+) -> None:
+    """
+    Pack `files` (by default, what `.avalon/include` selects) from `src`
+    into `archive_path`.
+    """
+
+    if files is None:
+        files = iter_included_files(src)
+
+    entries = []
+
+    with tempfile.TemporaryFile() as data:
+        for file_path in sorted(files):
+            relative = file_path.relative_to(src).as_posix()
+            file_stat = file_path.lstat()
+            entry = Entry(relative, stat.S_IMODE(file_stat.st_mode))
+
+            if stat.S_ISLNK(file_stat.st_mode):
+                entry.link = os.readlink(file_path)
+
+            else:
+                with file_path.open("rb") as file:
+                    _add_file(entry, file, data)
+
+            entries.append(entry.to_dict())
+
+        manifest = json.dumps({"version": 1, "files": entries}).encode("utf-8")
+
+        with archive_path.open("wb") as archive:
+            archive.write(HEADER.pack(MAGIC, len(manifest)))
+            archive.write(manifest)
+            data.seek(0)
+            shutil.copyfileobj(data, archive)
+
+
+def is_archive(archive_path: Path) -> bool:
+    "Check whether `archive_path` is an `.apm` archive."
+
+    with archive_path.open("rb") as archive:
+        return archive.read(len(MAGIC)) == MAGIC
+
+
+class Archive:
+    "An open `.apm` archive."
+
+    def __init__(self, archive_path: Path):
+        self.path = archive_path
+        self.file = archive_path.open("rb")
+
+        try:
+            magic, manifest_size = HEADER.unpack(self.file.read(HEADER.size))
+
+            if magic != MAGIC:
+                raise ArchiveError(f"{archive_path} is not an .apm archive")
+
+            manifest = json.loads(self.file.read(manifest_size))
+            entries = [Entry.from_dict(entry) for entry in manifest["files"]]
+
+        except (struct.error, ValueError, KeyError, TypeError) as exception:
+            self.file.close()
+            raise ArchiveError(f"{archive_path} is corrupt") from exception
+
+        except ArchiveError:
+            self.file.close()
+            raise
+
+        self.data_offset = HEADER.size + manifest_size
+        self.entries = {entry.path: entry for entry in entries}
+        self.links = {
+            PurePosixPath(entry.path)
+            for entry in entries
+            if entry.link is not None
+        }
+
+    def __enter__(self) -> "Archive":
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        "Close the archive file."
+
+        self.file.close()
+
+    def _read_chunk(self, chunk: Chunk) -> bytes:
+        data = os.pread(
+            self.file.fileno(),
+            chunk.compressed_size,
+            self.data_offset + chunk.offset,
+        )
+
+        return _decompress_chunk(data, chunk)
+
+    def read(self, member: str) -> bytes:
+        "Read a single file from the archive, without extracting the rest."
+
+        if member not in self.entries or self.entries[member].link is not None:
+            raise KeyError(member)
+
+        entry = self.entries[member]
+        data = b"".join(self._read_chunk(chunk) for chunk in entry.chunks)
+
+        if hashlib.sha256(data).hexdigest() != entry.sha256:
+            raise ArchiveError(f"{member} failed verification")
+
+        return data
+
+    def _extract_chunk(
+        self, target: Path, position: int, chunk: Chunk
+    ) -> None:
+        data = self._read_chunk(chunk)
+        descriptor = os.open(target, os.O_WRONLY)
+
+        try:
+            os.pwrite(descriptor, data, position)
+
+        finally:
+            os.close(descriptor)
+
+    def _get_target(self, root: Path, entry: Entry) -> Path:
+        """
+        Where `entry` is extracted to under `root`, a resolved directory.
+        Raises `ArchiveError` if it would end up outside of it, through
+        `..`, an absolute path or a symlink.
+        """
+
+        relative = PurePosixPath(entry.path)
+
+        if (
+            relative.is_absolute()
+            or ".." in relative.parts
+            or not relative.parts
+            or self.links.intersection(relative.parents)
+        ):
+            raise ArchiveError(f"Refusing to extract {entry.path}")
+
+        target = root / relative
+        # A file may not be written through a symlink that already exists.
+        resolved = target.parent if entry.link is not None else target
+
+        if not resolved.resolve().is_relative_to(root):
+            raise ArchiveError(f"Refusing to extract {entry.path}")
+
+        return target
+
+    def extract(self, destination: Path, jobs: int | None = None) -> None:
+        "Extract every file into `destination`, decompressing in parallel."
+
+        root = destination.resolve()
+        tasks = []
+
+        # Symlinks go last, so that nothing is extracted through them.
+        for entry in sorted(
+            self.entries.values(), key=lambda e: e.link is not None
+        ):
+            target = self._get_target(root, entry)
+            target.parent.mkdir(parents=True, exist_ok=True)
+
+            if entry.link is not None:
+                os.symlink(entry.link, target)
+                continue
+
+            with target.open("wb") as file:
+                file.truncate(entry.size)
+
+            position = 0
+
+            for chunk in entry.chunks:
+                tasks.append((target, position, chunk))
+                position += chunk.size
+
+        # zlib releases the GIL, so threads decompress in parallel.
+        with ThreadPoolExecutor(
+            max_workers=jobs or os.cpu_count()
+        ) as executor:
+            for future in [
+                executor.submit(self._extract_chunk, *task) for task in tasks
+            ]:
+                future.result()
+
+        for entry in self.entries.values():
+            if entry.link is None:
+                # Never setuid, setgid or sticky.
+                self._get_target(root, entry).chmod(entry.mode & 0o777)
@@ -0,0 +1,182 @@
+"""
+A content-addressed store of package files, so that identical files in
+different packages (and generations) are stored once.
+
+Blobs are named by their SHA-256 and mode, and installed files are
+hardlinks to them. It is opt-in (`dedupe` in `config.json`) because a
+program that modifies one of its files in place modifies every copy.
+"""
+
+import hashlib
+import os
+import shutil
+import stat
+
+from pathlib import Path
+from typing import Any
+
+from apm import log
+from apm.locks import BLOBS, lock
+from apm.path import Paths, ensure_dir
+
+# Directories in `paths.files` that do not hold package files.
+SKIPPED_DIRS = {".blobs", ".staging"}
+
+
+def hash_file(path: Path) -> str:
+    "The SHA-256 of a file's contents."
+
+    digest = hashlib.sha256()
+
+    with path.open("rb") as file:
+        while block := file.read(1024 * 1024):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def get_blob_path(paths: Paths, digest: str, mode: int) -> Path:
+    "Where a file with that hash and mode is stored."
+
+    return paths.blobs / digest[:2] / f"{digest}-{mode:o}"
+
+
+def store_file(paths: Paths, src: Path, mode: int | None = None) -> Path:
+    "Copy `src` into the store, if it is not there yet, and return its blob."
+
+    if mode is None:
+        mode = stat.S_IMODE(src.stat().st_mode)
+
+    blob = get_blob_path(paths, hash_file(src), mode)
+
+    if not blob.exists():
+        temporary = ensure_dir(blob.parent) / f".{blob.name}.{os.getpid()}"
+        shutil.copyfile(src, temporary)
+        temporary.chmod(mode)
+        os.replace(temporary, blob)
+
+    return blob
+
+
+def link_from_store(
+    paths: Paths, src: Path, dst: Path, mode: int | None = None
+) -> None:
+    """
+    Put `src` at `dst` as a hardlink to its blob, falling back to a copy
+    if the store is on another filesystem.
+    """
+
+    # Unused blobs are only collected while no blob is being linked.
+    with lock(paths, BLOBS, shared=True):
+        blob = store_file(paths, src, mode)
+        link_blob(blob, dst)
+
+
+def link_blob(blob: Path, dst: Path) -> None:
+    "Replace `dst` with a hardlink to `blob`."
+
+    if dst.exists() and os.path.samefile(blob, dst):
+        return
+
+    temporary = ensure_dir(dst.parent) / f".{dst.name}.{os.getpid()}"
+    temporary.unlink(missing_ok=True)
+
+    try:
+        os.link(blob, temporary)
+
+    except OSError as exception:
+        log.debug("Copying instead of linking", dst, "reason:", str(exception))
+        shutil.copy2(blob, temporary)
+
+    os.replace(temporary, dst)
+
+
+def collect_blobs(paths: Paths) -> int:
+    "Delete blobs that no file links to any more, returning the bytes freed."
+
+    freed = 0
+
+    if not paths.blobs.exists():
+        return freed
+
+    for blob in paths.blobs.glob("*/*"):
+        blob_stat = blob.stat()
+
+        if blob_stat.st_nlink == 1:
+            freed += blob_stat.st_size
+            blob.unlink()
+
+    return freed
+
+
+def dedupe_directory(paths: Paths, directory: Path) -> int:
+    """
+    Replace every regular file in `directory` with a link to its blob,
+    returning the bytes freed. A file's space is only freed once all of
+    its hardlinks (e.g. in other generations) have been replaced.
+    """
+
+    replaced: dict[tuple[int, int], int] = {}
+    sizes: dict[tuple[int, int], tuple[int, int]] = {}
+
+    for parent, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [name for name in dirnames if name not in SKIPPED_DIRS]
+
+        for name in filenames:
+            file = Path(parent) / name
+            file_stat = file.lstat()
+
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+
+            mode = stat.S_IMODE(file_stat.st_mode)
+            blob = get_blob_path(paths, hash_file(file), mode)
+
+            if not blob.exists():
+                os.link(file, ensure_dir(blob.parent) / blob.name)
+                continue
+
+            if os.path.samefile(blob, file):
+                continue
+
+            inode = (file_stat.st_dev, file_stat.st_ino)
+            replaced[inode] = replaced.get(inode, 0) + 1
+            # Links drop as they are replaced, so count those seen first.
+            sizes.setdefault(inode, (file_stat.st_nlink, file_stat.st_size))
+
+            temporary = file.with_name(f".{name}.{os.getpid()}")
+            os.link(blob, temporary)
+            os.replace(temporary, file)
+
+    return sum(
+        size
+        for inode, (links, size) in sizes.items()
+        if replaced[inode] == links
+    )
+
+
+def format_size(size: float) -> str:
+    "A human-readable size, e.g. `1.5 MiB`."
+
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            break
+
+        size /= 1024
+
+    return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+
+
+def dedupe_packages(_flags: Any, paths: Paths, *_args: str) -> None:
+    "Hardlink identical files of all installed packages to one copy"
+
+    if not paths.files.exists():
+        log.success("Nothing is installed.")
+        return
+
+    log.note("Deduplicating installed files.....")
+
+    with lock(paths, BLOBS):
+        reclaimed = dedupe_directory(paths, paths.files) + collect_blobs(paths)
+
+    log.success(f"Reclaimed {format_size(reclaimed)}.")
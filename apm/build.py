@@ -0,0 +1,454 @@
+"""
+Building packages from source or prebuilt artifacts, staged so that the
+installed version is only replaced once the build succeeds.
+"""
+
+import os
+import shutil
+import filecmp
+import subprocess  # nosec B404
+import tarfile
+import tempfile
+import time
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import replace
+from pathlib import Path
+from typing import Iterator
+
+import kazparse.flags
+
+from apm import events, log, timings
+from apm.log import fatal_error
+from .archive import ArchiveError
+from .blobs import link_from_store
+from .config import load_config
+from .generations import (
+    allocate_generation,
+    discard_generation,
+    publish_generation,
+)
+from .git import git_output
+from .path import Paths, ensure_dir
+from .package import Package
+from .metadata import get_package_metadata
+from .prebuilt import unpack_prebuilt_artifact
+
+# Where builds are staged, in `paths.files` so they can be renamed into place.
+STAGING_DIR = ".staging"
+
+
+def copy_file(src: Path, dst: Path, store: Paths | None = None) -> None:
+    """
+    Copy a file only if files are not the same or the destination does not exist.
+    With a `store`, files are hardlinked from its blob store instead.
+    """
+    if not os.path.dirname(dst).strip() == "":
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    if os.path.isfile(src):
+        if store is not None:
+            link_from_store(store, src, dst)
+        elif not os.path.exists(dst) or not filecmp.cmp(src, dst):
+            shutil.copy2(src, dst)
+    else:
+        if os.path.exists(src):
+            for file in os.listdir(src):
+                copy_file(src / file, dst / file, store)
+
+
+def remove_package_binary_symlink(
+    paths: Paths,
+    package_name: str,
+    package: Package | None = None,
+    commit: str | None = None,
+    branch: str | None = None,
+) -> None:
+    """Deletes the symlink for a package."""
+
+    log.debug("Removing symlink for:", package_name)
+
+    if package is None:
+        package = get_package_metadata(paths, package_name, commit, branch)
+
+    if package.binname:
+        package_bin_dir = paths.binaries / package.binname
+
+        if package_bin_dir.exists():
+            log.debug("Deleting", package_bin_dir)
+            os.remove(package_bin_dir)
+
+
+def symlink_binary_for_package(
+    paths: Paths, package_name: str, bin_file: str, bin_name: Path
+) -> None:
+    """Symlinks a binary for the package."""
+
+    try:
+        if load_config(paths).dedupe:
+            link_from_store(
+                paths,
+                paths.source / package_name / bin_file,
+                paths.files / package_name / bin_name,
+                mode=0o755,
+            )
+
+        else:
+            shutil.copyfile(
+                paths.source / package_name / bin_file,
+                paths.files / package_name / bin_name,
+            )
+
+    except shutil.Error:
+        log.warn(f"Failed to copy binary to {paths.files}")
+
+    if (paths.binaries / bin_name).exists():
+        os.remove(paths.binaries / bin_name)
+
+    ensure_dir(paths.binaries)
+
+    os.symlink(
+        paths.files / package_name / bin_file, paths.binaries / bin_name
+    )
+
+    (paths.files / package_name / bin_name).chmod(0o755)
+
+
+def copy_package_files_to_files_dir(
+    paths: Paths, package_name: str, files: list[str] | None = None
+) -> None:
+    """Copies a package's files from its source directory to its files directory."""
+
+    if files in (["all"], None):
+        files = os.listdir(paths.source / package_name)
+
+    log.debug(
+        "Copying files", str(files), "from src to files for", package_name
+    )
+    store = paths if load_config(paths).dedupe else None
+
+    for file in files:
+        copy_file(
+            paths.source / package_name / file,
+            paths.files / package_name / file,
+            store,
+        )
+
+
+def run_script(
+    script_file: Path, *args: str | Path, cwd: Path | None = None
+) -> int:
+    """
+    Runs a script with its specific interpreter based on the extension, in
+    `cwd` if given. Returns its exit status.
+    """
+
+    langs = {".py": "python3", ".sh": "bash"}
+
+    if os.path.exists("/etc/portage"):
+        with open(script_file, "r", encoding="utf-8") as script:
+            contents = script.read()
+
+            with open(script_file, "w", encoding="utf-8") as script_write:
+                script_write.write(
+                    contents.replace(
+                        "pip3 install", "pip3 install --user"
+                    ).replace("pip install", "pip install --user")
+                )
+
+    joined_args = " ".join([str(arg) for arg in args])
+
+    interpreter = langs.get(script_file.suffix.lower(), langs[".sh"])
+
+    command = log.debug(f"{interpreter} {script_file} {joined_args}")
+    start = time.perf_counter()
+    # Not `os.chdir`, so that packages can be built in several threads.
+    status = subprocess.call(command, shell=True, cwd=cwd)  # nosec B602
+    events.emit_command(command, status, start)
+
+    return status
+
+
+def install_prebuilt_package(
+    paths: Paths, package_name: str, package: Package, artifact_path: Path
+) -> bool:
+    """
+    Installs a package from a downloaded prebuilt artifact. Returns False,
+    leaving the files directory empty, if the artifact cannot be unpacked
+    or lacks the package's binary.
+    """
+
+    log.note("Installing prebuilt artifact.....")
+    files_dir = paths.files / package_name
+    binary = files_dir / (package.binfile or package.binname or "")
+
+    try:
+        with timings.phase("unpack prebuilt", package=package_name):
+            unpack_prebuilt_artifact(artifact_path, files_dir)
+
+    except (ArchiveError, tarfile.TarError, OSError) as exception:
+        log.warn("Failed to unpack the prebuilt artifact:", str(exception))
+        unpacked = False
+
+    else:
+        unpacked = not package.binname or binary.is_file()
+
+        if not unpacked:
+            log.warn(f"The prebuilt artifact does not contain {binary.name}.")
+
+    artifact_path.unlink(missing_ok=True)
+
+    if not unpacked:
+        # The staged files directory links to the generation's.
+        shutil.rmtree(files_dir.resolve(), ignore_errors=True)
+        files_dir.resolve().mkdir(parents=True)
+        return False
+
+    if package.binname:
+        remove_package_binary_symlink(paths, package_name, package)
+
+        binary.chmod(0o755)
+        os.symlink(binary, ensure_dir(paths.binaries) / package.binname)
+
+    return True
+
+
+@contextmanager
+def stage_install(paths: Paths, package_name: str) -> Iterator[Paths]:
+    """
+    Paths whose files and binaries directories are a staging area next to
+    the real ones. It is removed afterwards, whether the build succeeded
+    or not.
+
+    The package's files directory in it links to its next generation, so
+    that scripts are given the path that the files keep. The binaries
+    directory is only staged, paths in it must not be recorded.
+    """
+
+    stage = Path(
+        tempfile.mkdtemp(
+            prefix=f"{package_name.replace('/', '__')}-",
+            dir=ensure_dir(paths.files / STAGING_DIR),
+        )
+    )
+    staged = replace(paths, files=stage / "files", binaries=stage / "bin")
+
+    try:
+        generation_dir = allocate_generation(paths, package_name)
+
+    except BaseException:
+        shutil.rmtree(stage, ignore_errors=True)
+        raise
+
+    try:
+        ensure_dir((staged.files / package_name).parent)
+        (staged.files / package_name).symlink_to(generation_dir)
+
+        yield staged
+
+    finally:
+        shutil.rmtree(stage, ignore_errors=True)
+        discard_generation(paths, package_name, int(generation_dir.name))
+
+
+def compile_package(
+    package_name: str,
+    paths: Paths,
+    flags: kazparse.flags.Flags,
+    prebuilt: Future[Path | None] | None = None,
+) -> None:
+    """
+    Builds a package in a staging directory, then switches to it as a new
+    generation. The installed version keeps working until then, and is
+    left alone if the build fails.
+    """
+
+    source_dir = paths.source / package_name
+    commit = None
+
+    if (source_dir / ".git").exists():
+        commit = (
+            git_output("rev-parse", "HEAD", cwd=source_dir) or ""
+        ).strip()
+
+    with stage_install(paths, package_name) as staged:
+        build_package(package_name, staged, flags, prebuilt)
+
+        with timings.phase("publish", package=package_name):
+            generation = publish_generation(
+                paths, staged, package_name, commit or None
+            )
+
+    log.debug(f"Installed generation {generation} of {package_name}")
+
+
+def relink_package_binary(
+    paths: Paths, package_name: str, package: Package
+) -> None:
+    "Replaces the symlink for a package's binary."
+
+    remove_package_binary_symlink(paths, package_name, package)
+
+    symlink_binary_for_package(
+        paths,
+        package_name,
+        package.binfile or package.binname or "",
+        Path(package.binname or ""),
+    )
+
+
+def run_compile_script(
+    paths: Paths, package_name: str, package: Package
+) -> None:
+    "Runs a package's compile script, exiting if it fails or is missing."
+
+    if not package.compileScript:
+        fatal_error(
+            "Program needs compiling but no compilation script found... exiting....."
+        )
+
+    source_dir = paths.source / package_name
+    # Where the files stay once they are installed, for scripts to record.
+    files_dir = (paths.files / package_name).resolve()
+
+    log.note("Compile script found, compiling.....")
+
+    with timings.phase("compile script"):
+        status = run_script(
+            source_dir / package.compileScript,
+            f'"{source_dir}" "{package.binname}" \
+            "{files_dir}"',
+            cwd=source_dir,
+        )
+
+    if status:
+        fatal_error("Compile script failed!")
+
+
+def run_install_script(
+    paths: Paths, package_name: str, package: Package
+) -> None:
+    "Runs a package's install script, exiting if it fails."
+
+    source_dir = paths.source / package_name
+    files_dir = (paths.files / package_name).resolve()
+
+    log.note("Installing.....")
+
+    with timings.phase("install script"):
+        if (
+            package.needsCompiled or package.compileScript
+        ) and package.binname:
+            status = run_script(
+                paths.source / package_name / package.installScript,
+                f'"{files_dir / package.binname}" \
+                "{files_dir}" \
+                "{paths.binaries}" "{paths.source}"',
+                cwd=source_dir,
+            )
+
+        else:
+            status = run_script(
+                paths.source / package_name / package.installScript,
+                f'"{files_dir}" "{paths.source}" "{package_name}"',
+                cwd=source_dir,
+            )
+
+    if status:
+        fatal_error("Install script failed!")
+
+
+def install_downloaded_prebuilt(
+    paths: Paths,
+    package_name: str,
+    package: Package,
+    prebuilt: Future[Path | None],
+) -> bool:
+    """
+    Waits for `prebuilt` and installs it, returning False if the package
+    has to be built from source instead.
+    """
+
+    with timings.phase("wait for prebuilt", package=package_name):
+        try:
+            artifact_path = prebuilt.result()
+
+        # Whatever went wrong, the package can still be built.
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exception:
+            log.warn(
+                "Failed to download the prebuilt artifact:", str(exception)
+            )
+            return False
+
+    return artifact_path is not None and install_prebuilt_package(
+        paths, package_name, package, artifact_path
+    )
+
+
+def build_package(
+    package_name: str,
+    paths: Paths,
+    _flags: kazparse.flags.Flags,
+    prebuilt: Future[Path | None] | None = None,
+) -> None:
+    """
+    Compiles a package, or installs it from `prebuilt` if that was
+    downloaded successfully.
+    """
+
+    package = get_package_metadata(paths, package_name)
+    (paths.files / package_name).mkdir(parents=True, exist_ok=True)
+
+    if prebuilt is not None:
+        if install_downloaded_prebuilt(paths, package_name, package, prebuilt):
+            return
+
+        log.warn("Prebuilt artifact unavailable, building from source.....")
+
+    if package.needsCompiled:
+        if not package.binname:
+            log.warn(
+                "Package needs compiled but there is no binname for Avalon to install, \
+                assuming installed by compile script....."
+            )
+
+        run_compile_script(paths, package_name, package)
+
+    else:
+        log.warn(
+            "Program does not need to be compiled, moving to installation....."
+        )
+
+    if package.binname and not package.mvBinAfterInstallScript:
+        relink_package_binary(paths, package_name, package)
+
+    if package.installScript:
+        run_install_script(paths, package_name, package)
+
+    if package.toCopy:
+        log.note("Copying files needed by program.....")
+
+        with timings.phase("copy files"):
+            copy_package_files_to_files_dir(
+                paths, package_name, package.toCopy
+            )
+
+    if package.mvBinAfterInstallScript and package.binname:
+        relink_package_binary(paths, package_name, package)
+
+    else:
+        log.warn("No installation script found... Assuming \
+            installation beyond APM's autoinstaller isn't neccessary")
+
+
+def remove_renamed_binary(
+    paths: Paths, package_name: str, old: Package
+) -> None:
+    """Removes the symlink for `old`'s binname if the new version renamed it."""
+
+    new = get_package_metadata(paths, package_name)
+
+    if old.binname and old.binname != new.binname:
+        remove_package_binary_symlink(paths, package_name, old)
@@ -1,22 +1,39 @@
 """
 Functions for interacting with package changelogs using the keepachangelog format.
+
+`keepachangelog` and `semver` are imported where they are used, to keep
+them out of `apm`'s startup.
 """
 
+# pylint: disable=import-outside-toplevel
+
+from __future__ import annotations
+
 import subprocess  # nosec B404
 import re
 import datetime
 import sys
 
 from pathlib import Path
-from typing import Optional, Generator, Dict, List, Any, Tuple, Union, Iterable
-
-import keepachangelog  # type: ignore
-import semver
+from typing import (
+    TYPE_CHECKING,
+    Optional,
+    Generator,
+    Dict,
+    List,
+    Any,
+    Tuple,
+    Union,
+    Iterable,
+)
 
 from apm import path, log
 from .case.case import get_case_insensitive_path
 from .log import debug, error
 
+if TYPE_CHECKING:
+    import semver
+
 # Define a custom type for the changelog data
 Changelog = Dict[str, Union[str, List[str], Dict[str, Optional[int]]]]
 
@@ -60,12 +77,16 @@ def get_parsed_changelog(package_dir: Path) -> Optional[Dict[str, Any]]:
 
         return None
 
+    import keepachangelog  # type: ignore
+
     return keepachangelog.to_dict(changelog_path, show_unreleased=True)  # type: ignore  # noqa
 
 
 def current_version(package_dir: Path) -> Optional[semver.VersionInfo]:
     "Get latest version from `package_dir/CHANGELOG.MD`"
 
+    import semver
+
     chlog = get_parsed_changelog(package_dir)
 
     if not chlog:
@@ -90,6 +111,8 @@ def get_changes_after(
     "Get versions from `package_dir/CHANGELOG.MD` that are later than\
     `compare_version`"
 
+    import semver
+
     chlog = get_parsed_changelog(package_dir)
 
     if not chlog:
@@ -177,6 +200,8 @@ def get_package_versions(
 ) -> List[Tuple[str, semver.VersionInfo]]:
     """Retrieve the latest version for a list of packages."""
 
+    import semver
+
     out = []
 
     for package in packages:
@@ -205,6 +230,8 @@ def display_changelogs_packages(
 def bump_version(part: Optional[str] = None) -> None:
     """Bumps the version in the `CHANGELOG.MD` file based on the `Unreleased` section"""
 
+    import keepachangelog
+
     if not part:
         changelog_path = get_changelog_path(Path("."))
 
@@ -251,6 +278,8 @@ def bump_version(part: Optional[str] = None) -> None:
 def display_all_changelogs(packages: List[str]) -> None:
     """Display all changelogs for a list of packages."""
 
+    import semver
+
     display_changelogs(
         [
             (
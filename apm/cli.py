@@ -1,40 +1,27 @@
 """
 Definition of APM's CommandLine Interface
+
+Commands import what they need when they run, so that starting `apm`
+(e.g. for `apm installed` in a loop) does not import `requests`,
+`semver`, etc. `tests/test_import_time.py` keeps an eye on this.
 """
 
+# pylint: disable=import-outside-toplevel
+
 from pathlib import Path
 
 import os
 import sys
-import semver
+
+from contextlib import contextmanager
+from typing import Any, Iterator
 
 from kazparse import Parse
 import kazparse
 import kazparse.flags
-from apm import path
+from apm import events, path, timings
 from apm.path import Paths
-from .pm_util import (
-    install_package,
-    uninstall_package,
-    redo_symlinks_for_package,
-    update_package,
-    download_package_source,
-)
-from .metadata import (
-    update_metadata_cache,
-    get_installed_repos,
-    list_installed,
-)
 from .version import VERSION, COPYRIGHT_YEAR
-from .changelog import (
-    get_package_versions,
-    display_changelogs_packages,
-    bump_version,
-    get_changelog_path,
-    get_changes_after,
-    display_changelogs,
-    display_all_changelogs,
-)
 from .case.case import get_case_insensitive_path
 
 # Set up some initial information and configurations
@@ -67,25 +54,72 @@ p.flag(
     "machine",
     short="m",
     long="machine",
-    help="Disable user-facing features. Use in scripts and wrappers\
-    or things might break.",
+    help="Disable user-facing features and print one JSON event per line.\
+    Use in scripts and wrappers or things might break.",
+)
+p.flag(
+    "timings",
+    long="timings",
+    help="Print how long each install phase took. Set `AVALON_TRACE` to\
+    also write a Chrome trace.",
 )
+p.flag(
+    "all",
+    long="all",
+    help="Also show packages that do not support this machine (search)",
+)
+
+
+@contextmanager
+def session(
+    flags: kazparse.flags.Flags,
+    paths: Paths,
+    command: str,
+    args: tuple[str, ...],
+) -> Iterator[None]:
+    "Report `--timings`, `--machine` events and metrics for a command."
+
+    from .metrics import session as metrics_session
+    from .network import start_command
+
+    start_command(paths)
+
+    with metrics_session(paths), events.session(flags.machine, command, args):
+        with timings.session(flags.timings):
+            yield
+
+
+def freeze_changelogs(
+    paths: Paths, machine: bool = False
+) -> list[tuple[str, Any]]:
+    "Fetch the versions of all installed packages, to display changes later."
 
-# Fetch the versions of all installed packages and store in 'freeze_changelogs'
-freeze_changelogs = get_package_versions(get_installed_repos(path.paths))
+    if machine:
+        return []
 
+    from .changelog import get_package_versions
+    from .metadata import get_installed_repos
 
-def display_changes(machine: bool = False) -> None:
+    return get_package_versions(get_installed_repos(paths))
+
+
+def display_changes(
+    frozen_changelogs: list[tuple[str, Any]], machine: bool = False
+) -> None:
     "Display changelogs for installed packages"
 
     if not machine:
-        display_changelogs_packages(freeze_changelogs)
+        from .changelog import display_changelogs_packages
+
+        display_changelogs_packages(frozen_changelogs)
 
 
 def create_changelog(changelog_path: str) -> None:
     """Create a changelog file at the specified path (if it doesn't exist)"""
 
-    changelog_path_: Path = get_case_insensitive_path(changelog_path) / "CHANGELOG.MD"
+    changelog_path_: Path = (
+        get_case_insensitive_path(changelog_path) / "CHANGELOG.MD"
+    )
 
     dname = changelog_path_.parent
     chlog = get_case_insensitive_path(dname / "CHANGELOG.MD")
@@ -117,7 +151,9 @@ Versioning](https://semver.org/spec/v2.0.0.html).
 
 # Define a command function for the 'release' submenu
 @p.command("release")
-def release_submenu(_flags: kazparse.flags.Flags, _paths: Paths, *args: str) -> None:
+def release_submenu(
+    _flags: kazparse.flags.Flags, _paths: Paths, *args: str
+) -> None:
     "Submenu for interacting with changelogs"
 
     # Create a new Parse instance for the 'apm release' command with
@@ -130,6 +166,8 @@ def release_submenu(_flags: kazparse.flags.Flags, _paths: Paths, *args: str) ->
         "Bump `CHANGELOG.MD`'s version: major, minor, or patch\nIf \
         `part` not specified, guess based off of `[Unreleased]`"
 
+        from .changelog import bump_version
+
         # Ensure that the 'CHANGELOG.MD' file exists in the current
         # working directory
         create_changelog(os.getcwd())
@@ -140,9 +178,13 @@ def release_submenu(_flags: kazparse.flags.Flags, _paths: Paths, *args: str) ->
 
     # Define a command function 'releaseChange' within the 'release' submenu
     @release_parser.command("change")
-    def release_edit_changelog(_flags: kazparse.flags.Flags, _args: str) -> None:
+    def release_edit_changelog(
+        _flags: kazparse.flags.Flags, _args: str
+    ) -> None:
         "Edit `CHANGELOG.MD` w/ `$VISUAL_EDITOR`"
 
+        from .changelog import get_changelog_path
+
         # Ensure that the 'CHANGELOG.MD' file exists in the current
         # working directory
         create_changelog(os.getcwd())
@@ -172,9 +214,21 @@ def package_view_changes(
     changes <package> [version]
     """
 
+    import semver
+
+    from .changelog import (
+        display_all_changelogs,
+        display_changelogs,
+        display_changelogs_packages,
+        get_changes_after,
+    )
+    from .metadata import get_installed_repos
+
     # If no arguments are provided, show changes since version '0.0.0'
     if len(args) == 0:
-        changes = get_changes_after(Path("."), semver.VersionInfo.parse("0.0.0"))
+        changes = get_changes_after(
+            Path("."), semver.VersionInfo.parse("0.0.0")
+        )
         display_changelogs([("", changes)])
         return
 
@@ -203,26 +257,41 @@ def package_view_changes(
     # that version for the specific package
     package_name = args[0]
     package_path = paths.source / package_name
-    changes = get_changes_after(package_path, semver.VersionInfo.parse("0.0.0"))
+    changes = get_changes_after(
+        package_path, semver.VersionInfo.parse("0.0.0")
+    )
     display_changelogs([(package_name, changes)])
 
 
 # Define a command function for the 'gen' command
 @p.command("gen")
-def generate_package(_flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
+def generate_package(
+    _flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
     "Generate a package using AvalonGen"
-    os.system(str(paths.binaries) + "/avalongen " + " ".join([f'"{i}"' for i in args]))
+    os.system(
+        str(paths.binaries)
+        + "/avalongen "
+        + " ".join([f'"{i}"' for i in args])
+    )
 
 
 # Define a command function for the 'install' command
 @p.command("install")
-def cli_install_package(flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
+def cli_install_package(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
     "Installs a package"
 
-    install_package(flags, paths, list(args))
+    from .pm_util import install_package
+
+    frozen_changelogs = freeze_changelogs(paths, flags.machine)
+
+    with session(flags, paths, "install", args):
+        install_package(flags, paths, list(args))
 
     # Display changelogs for installed packages
-    display_changes(flags.machine)
+    display_changes(frozen_changelogs, flags.machine)
 
 
 # Define a command function for the 'uninstall' command
@@ -232,19 +301,93 @@ def cli_uninstall_package(
 ) -> None:
     "Uninstalls a package"
 
-    uninstall_package(flags, paths, list(args))
+    from .pm_util import uninstall_package
+
+    with session(flags, paths, "uninstall", args):
+        uninstall_package(flags, paths, list(args))
 
 
 # Define a command function for the 'update' command (hidden)
 @p.command("update", hidden=True)
-def cli_update_package(flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
+def cli_update_package(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
     "Update to the newest version of a repo, \
     then recompile + reinstall program"
 
-    update_package(flags, paths, *args)
+    from .pm_util import update_package
+
+    frozen_changelogs = freeze_changelogs(paths, flags.machine)
+
+    with session(flags, paths, "update", args):
+        update_package(flags, paths, *args)
 
     # Display changelogs for installed packages
-    display_changes(flags.machine)
+    display_changes(frozen_changelogs, flags.machine)
+
+
+# Define a command function for the 'rollback' command
+@p.command("rollback")
+def cli_rollback_package(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
+    """
+    Switch a package back to its previous build
+    rollback <package> [generation]
+    """
+
+    from .generations import rollback_package
+
+    with session(flags, paths, "rollback", args):
+        rollback_package(flags, paths, *args)
+
+
+# Define a command function for the 'dedupe' command
+@p.command("dedupe")
+def cli_dedupe_packages(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
+    """
+    Hardlink identical files of installed packages to one copy
+    dedupe
+    """
+
+    from .blobs import dedupe_packages
+
+    with session(flags, paths, "dedupe", args):
+        dedupe_packages(flags, paths, *args)
+
+
+# Define a command function for the 'lock' command
+@p.command("lock")
+def cli_lock_packages(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
+    """
+    Write the installed packages' commits to a lockfile
+    lock [lockfile]
+    """
+
+    from .lockfile import lock_packages
+
+    with session(flags, paths, "lock", args):
+        lock_packages(flags, paths, *args)
+
+
+# Define a command function for the 'sync' command
+@p.command("sync")
+def cli_sync_packages(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
+    """
+    Install exactly the packages in a lockfile
+    sync [lockfile]
+    """
+
+    from .lockfile import sync_packages
+
+    with session(flags, paths, "sync", args):
+        sync_packages(flags, paths, *args)
 
 
 # Define a command function for the 'refresh' command
@@ -254,56 +397,129 @@ def cli_refresh_cache_folder(
 ) -> None:
     "Refresh the main repository cache"
 
-    update_metadata_cache(flags, paths, *args)
+    from .metadata import update_metadata_cache
+
+    with session(flags, paths, "refresh", args):
+        update_metadata_cache(flags, paths, *args)
 
 
 # Define a command function for the 'pack' command
 @p.command("pack")
-def create_apm(_flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
-    "Generate .apm file with AvalonGen"
-    os.system(
-        str(paths.binaries)
-        + "/avalongen "
-        + "package "
-        + " ".join([f'"{i}"' for i in args])
-    )
+def create_apm(flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
+    """
+    Generate .apm file
+    pack [directory] [output]
+    """
+
+    from .packing import pack_package
+
+    with session(flags, paths, "pack", args):
+        pack_package(flags, paths, *args)
 
 
 # Define a command function for the 'unpack' command
 @p.command("unpack")
-def unpack_apm(_flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
-    "Unpack .apm file with AvalonGen"
-    raise NotImplementedError
-    # os.system(
-    #     str(paths["bin"])
-    #     + "/avalongen "
-    #     + "unpack "
-    #     + " ".join([f'"{i}"' for i in args])
-    # )
+def unpack_apm(flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
+    """
+    Unpack .apm file
+    unpack <archive> [directory]
+    """
+
+    from .packing import unpack_package
+
+    with session(flags, paths, "unpack", args):
+        unpack_package(flags, paths, *args)
 
 
 # Define a command function for the 'redobin' command (hidden)
 @p.command("redobin", hidden=True)
-def cli_redo_bin(flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
+def cli_redo_bin(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
     "Regenerate symlinks for a package"
-    redo_symlinks_for_package(flags, paths, *args)
+
+    from .pm_util import redo_symlinks_for_package
+
+    with session(flags, paths, "redobin", args):
+        redo_symlinks_for_package(flags, paths, *args)
 
 
 # Define a command function for the 'installed' command
 @p.command("installed")
-def cli_list_nstalled(flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
+def cli_list_nstalled(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
     "List installed packages"
 
+    from .metadata import list_installed
+
     # Call the 'installed' function to list installed packages
     list_installed(flags, paths, *args)
 
 
+# Define a command function for the 'search' command
+@p.command("search")
+def cli_search_packages(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
+    """
+    Search for packages in the main repository
+    search <term>
+    """
+
+    from .search import search_packages
+
+    search_packages(flags, paths, *args)
+
+
+# Define a command function for the 'transfers' command
+@p.command("transfers")
+def cli_list_transfers(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
+    """
+    List the size and speed of each package's last download, largest first
+    transfers
+    """
+
+    from .transfers import list_transfers
+
+    list_transfers(flags, paths, *args)
+
+
+# Define a command function for the 'daemon' command
+@p.command("daemon")
+def cli_run_daemon(
+    _flags: kazparse.flags.Flags, paths: Paths, *_args: str
+) -> None:
+    """
+    Keep apm's state warm and run other apm commands from a queue
+    daemon
+    """
+
+    from .daemon import run_daemon
+
+    run_daemon(paths, run_command)
+
+
 # Define a command function for the 'src' command
 @p.command("src")
-def cli_download_source(flags: kazparse.flags.Flags, paths: Paths, *args: str) -> None:
+def cli_download_source(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
     "Download a repo into a folder"
 
-    download_package_source(flags, paths, *args)
+    from .pm_util import download_package_source
+
+    with session(flags, paths, "src", args):
+        download_package_source(flags, paths, *args)
+
+
+def run_command(argv: list[str], paths: Paths) -> None:
+    "Run a command the way `apm` itself would."
+
+    sys.argv = ["apm", *argv]
+    p.run(extras=paths)
 
 
 def main() -> None:
@@ -316,4 +532,16 @@ def main() -> None:
     # case, 'paths' contains a dictionary with various paths used by
     # the APM script. This allows the CLI commands to access and
     # utilize these paths as needed during execution
+    command = next(
+        (arg for arg in sys.argv[1:] if not arg.startswith("-")), None
+    )
+
+    if command != "daemon":
+        from .daemon import forward_to_daemon
+
+        status = forward_to_daemon(path.paths, sys.argv[1:])
+
+        if status is not None:
+            sys.exit(status)
+
     p.run(extras=path.paths)
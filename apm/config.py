@@ -0,0 +1,84 @@
+"""
+User configuration, read from `config.json` in the Avalon root.
+"""
+
+import json
+
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+
+from apm import log
+from apm.path import Paths
+
+
+@dataclass
+class Config:  # pylint: disable=too-many-instance-attributes
+    "Options from `config.json`. Every option is optional."
+
+    # Ordered base URLs for `source` repositories, the `metadata`
+    # repository and `raw` metadata files.
+    mirrors: dict[str, list[str]] = field(default_factory=dict)
+    # Seconds before mirrors are probed and ranked again.
+    mirror_ttl: int = 3600
+    # Seconds to wait for a mirror to respond when probing it.
+    mirror_probe_timeout: float = 2.0
+    # Seconds before the metadata repository is refreshed in the background.
+    metadata_ttl: int = 3600
+    # Generations of each package to keep for `apm rollback`.
+    keep_generations: int = 3
+    # Hardlink identical package files to one copy in a blob store.
+    dedupe: bool = False
+    # Packages downloaded at once, by installs and `apm sync`.
+    download_jobs: int = 8
+    # Dependencies compiled at once while installing.
+    build_jobs: int = 1
+    # Prometheus textfile written after each command, e.g. for node_exporter.
+    metrics_file: str | None = None
+    # Seconds that a command's network calls may take in total, 0 for no limit.
+    network_deadline: float = 0
+    # Seconds that one HTTP request may take.
+    network_timeout: float = 10.0
+    # Times a failed HTTP request or git download is retried.
+    network_retries: int = 2
+    # Bytes per second that git must transfer, for `git_low_speed_time`
+    # seconds.
+    git_low_speed_limit: int = 1000
+    git_low_speed_time: int = 60
+
+
+_loaded: dict[Path, Config] = {}
+
+
+def load_config(paths: Paths) -> Config:
+    "Load `config.json`, falling back to the defaults if it is missing."
+
+    config_path = paths.root / "config.json"
+
+    if config_path in _loaded:
+        return _loaded[config_path]
+
+    options = {}
+
+    if config_path.exists():
+        try:
+            with config_path.open("r", encoding="utf-8") as config_file:
+                options = dict(json.load(config_file))
+
+        except json.decoder.JSONDecodeError as exception:
+            log.warn(
+                "Failed to parse config at",
+                config_path,
+                "reason:\n" + str(exception),
+            )
+
+    known = {option.name for option in fields(Config)}
+
+    for unknown in options.keys() - known:
+        log.warn(f"Unknown option `{unknown}` in", config_path)
+
+    config = Config(
+        **{key: value for key, value in options.items() if key in known}
+    )
+    _loaded[config_path] = config
+
+    return config
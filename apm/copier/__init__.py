@@ -4,7 +4,47 @@ Parse include files and check if files match the given patterns.
 Uses gitignore syntax but is functionally the opposite of `.gitignore`s.
 """
 
-from gitignore_parser import parse_gitignore  # type: ignore
+import os
+
+from pathlib import Path
+from typing import Iterator
+
+
+def iter_included_files(src: Path) -> Iterator[Path]:
+    """
+    Yield the files in `src` matched by `src/.avalon/include`.
+
+    Without an include file, everything but `.git` is included.
+    `.avalon/package` is always included.
+    """
+
+    include_file = src / ".avalon/include"
+    matches = None
+
+    if include_file.exists():
+        # pylint: disable-next=import-outside-toplevel
+        from gitignore_parser import parse_gitignore  # type: ignore
+
+        matches = parse_gitignore(include_file, base_dir=src)
+
+    for directory, dirnames, filenames in os.walk(src):
+        dirnames[:] = [name for name in dirnames if matches or name != ".git"]
+
+        links = [
+            name
+            for name in dirnames
+            if os.path.islink(os.path.join(directory, name))
+        ]
+
+        for name in filenames + links:
+            file_path = Path(directory) / name
+
+            if (
+                matches is None
+                or matches(str(file_path))
+                or file_path == src / ".avalon/package"
+            ):
+                yield file_path
 
 
 def copy_files(include_file: str, src: str, dst: str) -> None:
@@ -12,6 +52,9 @@ def copy_files(include_file: str, src: str, dst: str) -> None:
     Copy files from src to dst following the patterns in `include_file`.
     """
 
+    # pylint: disable-next=import-outside-toplevel
+    from gitignore_parser import parse_gitignore
+
     parsed = parse_gitignore(include_file)
 
     # walk files and check if they match parsed
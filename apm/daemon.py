@@ -0,0 +1,381 @@
+"""
+`apm daemon`: a long-running apm that keeps its state warm between
+commands.
+
+While it runs, `apm` forwards each command to it over a Unix socket in
+the Avalon cache, with its working directory, environment and stdin,
+stdout and stderr, so the output appears where `apm` was run. Commands
+run one at a time, in the order they arrived. Without a daemon, `apm`
+runs commands itself as before.
+
+The daemon's paths and mirrors come from its own environment, so a
+command whose environment sets them differently, e.g. another
+`AVALON_BIN` or `XDG_CACHE_HOME`, is refused and `apm` runs it itself.
+
+Between commands the daemon keeps imported modules, parsed metadata
+files (read again only once they change), host facts, dpkg's package
+list and HTTP connections. Anything that only holds for one run, like
+downloaded metadata, is reset before each command, and the run's
+temporary directories are deleted after it.
+"""
+
+import json
+import os
+import queue
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+from apm import log
+from apm.path import Paths, ensure_dir, remove_run_temps
+
+SOCKET_NAME = "daemon.sock"
+# Set to run commands in-process even when a daemon is running. Commands
+# run by the daemon set it too, so that scripts calling `apm` do not wait
+# for the command that is running them.
+NO_DAEMON = "AVALON_NO_DAEMON"
+# The client's stdin, stdout and stderr.
+STDIO = (0, 1, 2)
+# Seconds that a client has to send its command.
+RECEIVE_TIMEOUT = 5.0
+# Variables that `apm.path` and `apm.mirrors` read when they are imported.
+FIXED_VARIABLES = (
+    "HOME",
+    "XDG_CONFIG_HOME",
+    "XDG_CACHE_HOME",
+    "TMPDIR",
+    "TEMP",
+    "TMP",
+    "AVALON_BIN",
+    "AVALON_GIT_URL",
+    "AVALON_RAW_URL",
+)
+
+
+@dataclass
+class Job:
+    "A command sent to the daemon."
+
+    connection: socket.socket
+    request: dict[str, Any]
+    fds: list[int]
+
+
+def get_socket_path(paths: Paths) -> Path:
+    "Where the daemon listens."
+
+    return paths.cache / SOCKET_NAME
+
+
+def receive_line(connection: socket.socket, received: bytes = b"") -> bytes:
+    "Read from `connection` up to the end of the line."
+
+    while not received.endswith(b"\n"):
+        chunk = connection.recv(65536)
+
+        if not chunk:
+            break
+
+        received += chunk
+
+    return received
+
+
+def forward_to_daemon(paths: Paths, argv: list[str]) -> int | None:
+    """
+    Run a command in the daemon, returning its exit status, or None if no
+    daemon is running.
+    """
+
+    socket_path = get_socket_path(paths)
+
+    if os.environ.get(NO_DAEMON) or not socket_path.exists():
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        client.connect(str(socket_path))
+
+    except OSError:
+        client.close()
+        return None
+
+    umask = os.umask(0)
+    os.umask(umask)
+
+    request = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        "umask": umask,
+    }
+
+    with client:
+        socket.send_fds(
+            client, [json.dumps(request).encode() + b"\n"], list(STDIO)
+        )
+        reply = receive_line(client)
+
+    if not reply:
+        log.error("apm daemon exited before the command finished.")
+        return 1
+
+    answer = json.loads(reply)
+
+    if "status" not in answer:
+        log.debug("apm daemon refused the command:", answer["refused"])
+        return None
+
+    return int(answer["status"])
+
+
+def get_fixed_environment(environ: dict[str, str]) -> dict[str, str | None]:
+    "The variables in `environ` that the daemon cannot change per command."
+
+    return {name: environ.get(name) for name in FIXED_VARIABLES}
+
+
+def reset_run_state() -> None:
+    "Forget everything that only holds for one command."
+
+    # pylint: disable=import-outside-toplevel,protected-access
+    from apm import config, metadata, network, requirements, resolver
+
+    log.IS_DEBUG = False
+    log.IS_SILENT = False
+    config._loaded.clear()
+    metadata._repository = None
+    network._deadline = None
+    requirements._checked_graphs.clear()
+    resolver._resolved.clear()
+
+
+def run_job(
+    job: Job, paths: Paths, command: Callable[[list[str], Paths], None]
+) -> int:
+    "Run a job with the client's stdio, directory and environment."
+
+    request = job.request
+    saved_fds = [os.dup(descriptor) for descriptor in STDIO]
+    saved_environ = dict(os.environ)
+    saved_cwd = os.getcwd()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    try:
+        for descriptor, client_fd in zip(STDIO, job.fds):
+            os.dup2(client_fd, descriptor)
+
+        os.environ.clear()
+        os.environ.update(request["env"])
+        os.environ[NO_DAEMON] = "1"
+        os.umask(request["umask"])
+        os.chdir(request["cwd"])
+
+        try:
+            reset_run_state()
+            command(list(request["argv"]), paths)
+            status = 0
+
+        except SystemExit as exit_:
+            if exit_.code is None or isinstance(exit_.code, int):
+                status = exit_.code or 0
+
+            else:
+                print(exit_.code, file=sys.stderr)
+                status = 1
+
+        except Exception:  # pylint: disable=broad-exception-caught
+            traceback.print_exc()
+            status = 1
+
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        for descriptor, saved_fd in zip(STDIO, saved_fds):
+            os.dup2(saved_fd, descriptor)
+            os.close(saved_fd)
+
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        os.chdir(saved_cwd)
+        remove_run_temps()
+
+    return status
+
+
+class Daemon:
+    "Accepts commands on the socket and runs them one at a time."
+
+    def __init__(
+        self,
+        paths: Paths,
+        command: Callable[[list[str], Paths], None],
+    ) -> None:
+        self.paths = paths
+        self.command = command
+        self.jobs: "queue.Queue[Job | None]" = queue.Queue()
+        self.socket_path = get_socket_path(paths)
+        self.environ = get_fixed_environment(dict(os.environ))
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def bind(self) -> None:
+        "Listen on the socket, replacing the socket of a daemon that died."
+
+        if self.socket_path.exists():
+            try:
+                with socket.socket(
+                    socket.AF_UNIX, socket.SOCK_STREAM
+                ) as probe:
+                    probe.connect(str(self.socket_path))
+
+            except OSError:
+                self.socket_path.unlink()
+
+            else:
+                log.fatal_error("apm daemon is already running.")
+
+        ensure_dir(self.socket_path.parent)
+        # Only this user may connect, the socket runs commands as them.
+        old_umask = os.umask(0o177)
+
+        try:
+            self.server.bind(str(self.socket_path))
+
+        finally:
+            os.umask(old_umask)
+
+        self.server.listen()
+
+    def is_same_user(self, connection: socket.socket) -> bool:
+        "Whether the client runs as the daemon's user."
+
+        credentials = connection.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        _pid, uid, _gid = struct.unpack("3i", credentials)
+
+        return int(uid) == os.getuid()
+
+    def accept(self) -> None:
+        "Queue the next command sent to the socket."
+
+        connection, _ = self.server.accept()
+        fds: list[int] = []
+        # A client that never sends its command must not hold up the others.
+        connection.settimeout(RECEIVE_TIMEOUT)
+
+        try:
+            message, fds, _flags, _address = socket.recv_fds(
+                connection, 65536, len(STDIO)
+            )
+
+            if not self.is_same_user(connection) or len(fds) != len(STDIO):
+                raise ValueError("Unexpected client")
+
+            request = json.loads(receive_line(connection, message))
+            connection.settimeout(None)
+
+            if get_fixed_environment(request["env"]) != self.environ:
+                connection.sendall(
+                    json.dumps(
+                        {"refused": "different paths or mirrors"}
+                    ).encode()
+                    + b"\n"
+                )
+                raise ValueError("Different paths or mirrors")
+
+        except (OSError, ValueError, KeyError, TypeError) as exception:
+            log.debug("Rejected a client:", str(exception))
+
+            for descriptor in fds:
+                os.close(descriptor)
+
+            connection.close()
+            return
+
+        self.jobs.put(Job(connection, request, fds))
+
+    def work(self) -> None:
+        "Run queued commands until `None` is queued."
+
+        while (job := self.jobs.get()) is not None:
+            try:
+                status = run_job(job, self.paths, self.command)
+
+                try:
+                    job.connection.sendall(
+                        json.dumps({"status": status}).encode() + b"\n"
+                    )
+
+                except OSError:
+                    log.debug("The client left before its command finished.")
+
+            finally:
+                for descriptor in job.fds:
+                    os.close(descriptor)
+
+                job.connection.close()
+
+    def serve(self) -> None:
+        "Run commands until interrupted or closed."
+
+        worker = threading.Thread(target=self.work, daemon=True)
+        worker.start()
+
+        try:
+            while True:
+                self.accept()
+
+        except OSError:
+            # The socket was closed.
+            pass
+
+        finally:
+            self.close()
+            worker.join()
+
+    def close(self) -> None:
+        "Stop accepting commands, and let the worker finish the queued ones."
+
+        if self.server.fileno() == -1:
+            return
+
+        self.jobs.put(None)
+        self.socket_path.unlink(missing_ok=True)
+
+        try:
+            # Wakes up `accept`, which closing alone does not.
+            self.server.shutdown(socket.SHUT_RDWR)
+
+        except OSError:
+            pass
+
+        self.server.close()
+
+
+def run_daemon(
+    paths: Paths, command: Callable[[list[str], Paths], None]
+) -> None:
+    "Serve `command` to other `apm` processes until interrupted."
+
+    daemon = Daemon(paths, command)
+    daemon.bind()
+    # e.g. from systemd, finishing the queued commands first.
+    signal.signal(signal.SIGTERM, lambda *_: daemon.close())
+    log.note(f"apm daemon listening on {daemon.socket_path}")
+
+    try:
+        daemon.serve()
+
+    except KeyboardInterrupt:
+        log.note("Stopping apm daemon.....")
@@ -0,0 +1,159 @@
+"""
+Events for `--machine`: one JSON object per line on stdout for each step
+of a command, so that wrappers can follow many `apm` runs at once
+without parsing colored text.
+
+Every event has `event`, `time` (seconds since the epoch) and `pid`.
+While they are streamed, messages are `log` events, and anything else
+written to stdout, e.g. by build scripts, goes to stderr instead.
+
+Listeners, e.g. `apm.metrics`, receive every event in-process. When
+nothing streams or listens, `emit` returns straight away.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Sequence
+
+# Whether events are streamed or listened to.
+IS_ENABLED = False
+# Whether events are written to stdout.
+IS_STREAMING = False
+
+Listener = Callable[[dict[str, Any]], None]
+
+# The original stdout, which events are written to.
+_fd: int | None = None
+_listeners: list[Listener] = []
+_in_session: bool = False
+_lock = threading.Lock()
+
+
+def emit(event: str, **fields: Any) -> None:
+    "Write an event and pass it to the listeners, if events are enabled."
+
+    if not IS_ENABLED:
+        return
+
+    record = {
+        "event": event,
+        "time": time.time(),
+        "pid": os.getpid(),
+        **fields,
+    }
+
+    with _lock:
+        for listener in _listeners:
+            listener(record)
+
+        if _fd is not None:
+            data = (json.dumps(record, default=str) + "\n").encode()
+
+            while data:
+                data = data[os.write(_fd, data) :]
+
+
+@contextmanager
+def listen(listener: Listener) -> Iterator[None]:
+    "Pass every event emitted in the enclosed block to `listener`."
+
+    global IS_ENABLED  # pylint: disable=global-statement
+
+    with _lock:
+        _listeners.append(listener)
+        IS_ENABLED = True
+
+    try:
+        yield
+
+    finally:
+        with _lock:
+            _listeners.remove(listener)
+            IS_ENABLED = IS_STREAMING or bool(_listeners)
+
+
+def emit_command(command: str | list[str], status: int, start: float) -> None:
+    """
+    Emit that `command` exited with `status`, having started at `start`
+    (from `time.perf_counter`).
+    """
+
+    emit(
+        "command",
+        command=command,
+        status=status,
+        seconds=round(time.perf_counter() - start, 6),
+    )
+
+
+def get_exit_status(exit_: SystemExit) -> int:
+    "The exit status that `exit_` exits with."
+
+    if exit_.code is None or isinstance(exit_.code, int):
+        return exit_.code or 0
+
+    return 1
+
+
+@contextmanager
+def session(stream: bool, command: str, args: Sequence[str]) -> Iterator[None]:
+    """
+    Emit events for the enclosed command, from `start` to its `result`,
+    even when it exits through `fatal_error`. They are written to stdout
+    if `stream` is set.
+    """
+
+    # pylint: disable-next=global-statement
+    global IS_ENABLED, IS_STREAMING, _fd, _in_session
+
+    if _in_session or not (stream or _listeners):
+        yield
+        return
+
+    _in_session = True
+
+    if stream:
+        sys.stdout.flush()
+        _fd = os.dup(1)
+        os.dup2(2, 1)
+        IS_STREAMING = True
+
+    IS_ENABLED = True
+    start = time.perf_counter()
+    result: dict[str, Any] = {"status": 0}
+    emit("start", command=command, args=list(args))
+
+    try:
+        yield
+
+    except SystemExit as exit_:
+        result["status"] = get_exit_status(exit_)
+        raise
+
+    except BaseException as exception:
+        result = {"status": 1, "error": repr(exception)}
+        raise
+
+    finally:
+        emit(
+            "result",
+            command=command,
+            ok=not result["status"],
+            seconds=round(time.perf_counter() - start, 6),
+            **result,
+        )
+        _in_session = False
+
+        if _fd is not None:
+            sys.stdout.flush()
+            IS_STREAMING = False
+            os.dup2(_fd, 1)
+            os.close(_fd)
+            _fd = None
+
+        IS_ENABLED = bool(_listeners)
@@ -0,0 +1,193 @@
+"""
+Helpers for syncing, unpacking and linking package files.
+"""
+
+import json
+import os
+import shutil
+import tarfile
+
+from pathlib import Path
+from typing import IO, Any, Callable
+
+from apm import log
+from apm.log import fatal_error
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def get_ignore_matcher(src: Path) -> Callable[[Path], bool]:
+    "Return a function that checks whether a path in `src` is ignored by git."
+
+    gitignore = src / ".gitignore"
+
+    if not gitignore.exists():
+        return lambda path: path.name == ".git"
+
+    # pylint: disable-next=import-outside-toplevel
+    from gitignore_parser import parse_gitignore  # type: ignore
+
+    matches = parse_gitignore(gitignore, base_dir=src)
+
+    return lambda path: path.name == ".git" or bool(matches(str(path)))
+
+
+def _is_same_file(src: os.stat_result, dst: os.stat_result) -> bool:
+    return src.st_size == dst.st_size and src.st_mtime_ns == dst.st_mtime_ns
+
+
+def _sync_file(src_file: Path, dst_file: Path) -> bool:
+    "Copy `src_file` over `dst_file` unless it is unchanged."
+
+    try:
+        if _is_same_file(src_file.lstat(), dst_file.lstat()):
+            return False
+
+    except FileNotFoundError:
+        pass
+
+    log.debug("Copying", src_file, "to", dst_file)
+
+    if dst_file.is_dir() and not dst_file.is_symlink():
+        shutil.rmtree(dst_file)
+
+    elif dst_file.is_symlink() or dst_file.exists():
+        os.remove(dst_file)
+
+    if src_file.is_symlink():
+        os.symlink(os.readlink(src_file), dst_file)
+
+    else:
+        shutil.copy2(src_file, dst_file)
+
+    return True
+
+
+def sync_directory(src: Path, dst: Path, manifest_path: Path) -> bool:
+    """
+    Make `dst` match `src`, copying only files that changed and skipping
+    `.git` and anything ignored by `src/.gitignore`.
+
+    The files that were synced are recorded in `manifest_path`, so files
+    that disappeared from `src` can be removed from `dst` next time, while
+    files that only exist in `dst`, like build output, are left alone.
+
+    Returns whether anything was changed.
+    """
+
+    src = src.resolve()
+    is_ignored = get_ignore_matcher(src)
+    synced: set[str] = set()
+    changed = False
+
+    for directory, dirnames, filenames in os.walk(src):
+        src_dir = Path(directory)
+        dst_dir = dst / src_dir.relative_to(src)
+
+        # Symlinks to directories are copied as symlinks, not walked.
+        filenames += [
+            name for name in dirnames if (src_dir / name).is_symlink()
+        ]
+        dirnames[:] = [
+            name
+            for name in dirnames
+            if not (src_dir / name).is_symlink()
+            and not is_ignored(src_dir / name)
+        ]
+
+        if dst_dir.is_symlink() or dst_dir.is_file():
+            os.remove(dst_dir)
+
+        dst_dir.mkdir(parents=True, exist_ok=True)
+
+        for name in filenames:
+            src_file = src_dir / name
+
+            if is_ignored(src_file):
+                continue
+
+            synced.add(str(src_file.relative_to(src)))
+            changed |= _sync_file(src_file, dst_dir / name)
+
+    previous: set[str] = set()
+
+    if manifest_path.exists():
+        previous = set(json.loads(manifest_path.read_text(encoding="utf-8")))
+
+    for stale in previous - synced:
+        log.debug("Removing", dst / stale)
+        changed = True
+
+        if (dst / stale).is_symlink() or (dst / stale).is_file():
+            os.remove(dst / stale)
+
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    manifest_path.write_text(json.dumps(sorted(synced)), encoding="utf-8")
+
+    return changed
+
+
+def _open_tarball(archive: IO[bytes]) -> tarfile.TarFile:
+    "Open a tarball for streaming: plain, gzip, bzip2, xz or zstd."
+
+    if archive.read(4) == ZSTD_MAGIC:
+        archive.seek(0)
+
+        try:
+            # pylint: disable-next=import-outside-toplevel
+            import zstandard  # type: ignore
+
+        except ImportError:
+            fatal_error(
+                "Unpacking zstd packages requires the `zstandard` module:",
+                "python3 -m pip install zstandard",
+            )
+
+        return tarfile.open(
+            fileobj=zstandard.ZstdDecompressor().stream_reader(archive),
+            mode="r|",
+        )
+
+    archive.seek(0)
+
+    return tarfile.open(fileobj=archive, mode="r|*")
+
+
+def extract_tarball(tarball: Path, destination: Path) -> None:
+    "Stream-extract `tarball` into `destination` without a temporary copy."
+
+    with tarball.open("rb") as archive, _open_tarball(archive) as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(destination, filter="data")
+
+        else:
+            tar.extractall(destination)  # nosec B202
+
+
+def read_json_cache(path: Path) -> dict[str, Any]:
+    "The object in the cache file `path`, or an empty one if it is unusable."
+
+    try:
+        with path.open("r", encoding="utf-8") as cache:
+            return dict(json.load(cache))
+
+    except (OSError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def write_json_cache(path: Path, data: dict[str, Any]) -> None:
+    "Atomically replace the cache file `path` with `data`."
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f"{path.name}.{os.getpid()}")
+    temporary.write_text(json.dumps(data), encoding="utf-8")
+    os.replace(temporary, path)
+
+
+def replace_link(link: Path, target: str | Path) -> None:
+    "Point the symlink `link` at `target`, atomically replacing it."
+
+    temporary = link.with_name(f".{link.name}.{os.getpid()}")
+    temporary.unlink(missing_ok=True)
+    os.symlink(target, temporary)
+    os.replace(temporary, link)
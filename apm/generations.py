@@ -0,0 +1,464 @@
+"""
+Generations of installed packages.
+
+`paths.files/<user>/<repo>` is a symlink to a numbered generation in
+`paths.files/.generations/<user>__<repo>/`. Every build adds a generation,
+with the files that did not change hardlinked to the previous one, and
+switching generations only repoints symlinks. `<n>.json` next to each
+generation records the binaries it installed and the commit and
+`.avalon/package` it was built from, which are reported as the installed
+version, and binaries that are not symlinks are kept in `<n>.bin/`.
+
+A build installs straight into its generation's directory, so absolute
+paths that it records stay valid. The directory only counts as a
+generation once its record is written.
+"""
+
+import filecmp
+import json
+import os
+import shutil
+import stat
+import time
+
+from pathlib import Path
+from typing import Any
+
+from apm import log
+from apm.config import load_config
+from apm.files import replace_link
+from apm.locks import package_lock
+from apm.log import fatal_error
+from apm.path import Paths, ensure_dir
+
+GENERATIONS_DIR = ".generations"
+
+
+def get_generations_dir(paths: Paths, package_name: str) -> Path:
+    "Where a package's generations are kept."
+
+    return paths.files / GENERATIONS_DIR / package_name.replace("/", "__")
+
+
+def list_generation_dirs(paths: Paths, package_name: str) -> list[int]:
+    "A package's generation directories, including unpublished ones."
+
+    generations_dir = get_generations_dir(paths, package_name)
+
+    if not generations_dir.exists():
+        return []
+
+    return sorted(
+        int(entry.name)
+        for entry in generations_dir.iterdir()
+        if entry.name.isdigit() and entry.is_dir()
+    )
+
+
+def list_generations(paths: Paths, package_name: str) -> list[int]:
+    "A package's generations, oldest first."
+
+    generations_dir = get_generations_dir(paths, package_name)
+
+    return [
+        generation
+        for generation in list_generation_dirs(paths, package_name)
+        if (generations_dir / f"{generation}.json").exists()
+    ]
+
+
+def get_next_generation(paths: Paths, package_name: str) -> int:
+    "The number of a package's next generation."
+
+    return max(list_generation_dirs(paths, package_name), default=0) + 1
+
+
+def get_current_generation(paths: Paths, package_name: str) -> int | None:
+    "The generation `paths.files/<package>` points to, if any."
+
+    try:
+        target = os.readlink(paths.files / package_name)
+
+    except OSError:
+        return None
+
+    name = Path(target).name
+
+    return int(name) if name.isdigit() else None
+
+
+def read_record(
+    paths: Paths, package_name: str, generation: int
+) -> dict[str, Any]:
+    "What was recorded about a generation when it was published."
+
+    record_path = (
+        get_generations_dir(paths, package_name) / f"{generation}.json"
+    )
+
+    try:
+        with record_path.open("r", encoding="utf-8") as record:
+            return dict(json.load(record))
+
+    except (OSError, json.decoder.JSONDecodeError):
+        return {"binaries": {}}
+
+
+def get_built(paths: Paths, package_name: str, field: str) -> str | None:
+    "What the current generation recorded under `field`, if anything."
+
+    current = get_current_generation(paths, package_name)
+
+    if current is None:
+        return None
+
+    value = read_record(paths, package_name, current).get(field)
+
+    return str(value) if value else None
+
+
+def get_built_commit(paths: Paths, package_name: str) -> str | None:
+    "The commit that the current generation was built from, if known."
+
+    return get_built(paths, package_name, "commit")
+
+
+def get_built_metadata(paths: Paths, package_name: str) -> str | None:
+    "The `.avalon/package` that the current generation was built with."
+
+    return get_built(paths, package_name, "metadata")
+
+
+def read_source_metadata(paths: Paths, package_name: str) -> str | None:
+    "The `.avalon/package` in a package's source, if there is one."
+
+    try:
+        return (
+            (paths.source / package_name / ".avalon/package")
+            .read_bytes()
+            .decode()
+        )
+
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def write_record(
+    paths: Paths, package_name: str, generation: int, record: dict[str, Any]
+) -> None:
+    "Record what a generation installed."
+
+    record_path = (
+        get_generations_dir(paths, package_name) / f"{generation}.json"
+    )
+    record_path.write_text(json.dumps(record), encoding="utf-8")
+
+
+def link_unchanged_files(previous: Path, new: Path) -> int:
+    """
+    Replace files in `new` that are identical to the same file in
+    `previous` with hardlinks to it. Returns how many were linked.
+    """
+
+    linked = 0
+
+    for directory, _dirnames, filenames in os.walk(new):
+        for name in filenames:
+            new_file = Path(directory) / name
+            old_file = previous / new_file.relative_to(new)
+
+            try:
+                new_stat = new_file.lstat()
+                old_stat = old_file.lstat()
+
+            except FileNotFoundError:
+                continue
+
+            if (
+                not stat.S_ISREG(new_stat.st_mode)
+                or not stat.S_ISREG(old_stat.st_mode)
+                or new_stat.st_size != old_stat.st_size
+                or new_stat.st_mode != old_stat.st_mode
+                or not filecmp.cmp(old_file, new_file, shallow=False)
+            ):
+                continue
+
+            temporary = new_file.with_name(f".{name}.{os.getpid()}")
+            os.link(old_file, temporary)
+            os.replace(temporary, new_file)
+            linked += 1
+
+    return linked
+
+
+def find_binaries_in(paths: Paths, files_dir: Path) -> dict[str, str]:
+    "Symlinks in `paths.binaries` that point into `files_dir`."
+
+    if not paths.binaries.exists():
+        return {}
+
+    return {
+        entry.name: os.readlink(entry)
+        for entry in paths.binaries.iterdir()
+        if entry.is_symlink()
+        and Path(os.readlink(entry)).is_relative_to(files_dir)
+    }
+
+
+def adopt_files_directory(paths: Paths, package_name: str) -> int:
+    """
+    Turn a files directory installed before generations existed into the
+    first generation.
+    """
+
+    live_dir = paths.files / package_name
+    generation = get_next_generation(paths, package_name)
+    generation_dir = ensure_dir(
+        get_generations_dir(paths, package_name)
+    ) / str(generation)
+
+    log.debug("Adopting", live_dir, "as generation", str(generation))
+    binaries = find_binaries_in(paths, live_dir)
+    os.rename(live_dir, generation_dir)
+    write_record(
+        paths,
+        package_name,
+        generation,
+        {"binaries": binaries, "time": time.time()},
+    )
+    replace_link(live_dir, os.path.relpath(generation_dir, live_dir.parent))
+
+    return generation
+
+
+def activate_generation(
+    paths: Paths, package_name: str, generation: int, previous: int | None
+) -> None:
+    "Point a package's files directory and binaries at `generation`."
+
+    live_dir = paths.files / package_name
+    generation_dir = get_generations_dir(paths, package_name) / str(generation)
+
+    ensure_dir(live_dir.parent)
+    replace_link(live_dir, os.path.relpath(generation_dir, live_dir.parent))
+
+    binaries = read_record(paths, package_name, generation)["binaries"]
+    old_binaries = {}
+
+    if previous is not None:
+        old_binaries = read_record(paths, package_name, previous)["binaries"]
+
+    ensure_dir(paths.binaries)
+
+    for name, target in binaries.items():
+        replace_link(paths.binaries / name, target)
+
+    for name, target in old_binaries.items():
+        link = paths.binaries / name
+
+        if (
+            name not in binaries
+            and link.is_symlink()
+            and os.readlink(link) == target
+        ):
+            link.unlink()
+
+
+def collect_garbage(paths: Paths, package_name: str) -> None:
+    "Delete the oldest generations beyond `keep_generations`, but the current."
+
+    keep = max(load_config(paths).keep_generations, 1)
+    current = get_current_generation(paths, package_name)
+    generations_dir = get_generations_dir(paths, package_name)
+
+    for generation in list_generations(paths, package_name)[:-keep]:
+        if generation == current:
+            continue
+
+        log.debug("Deleting generation", str(generation), "of", package_name)
+        shutil.rmtree(generations_dir / str(generation), ignore_errors=True)
+        shutil.rmtree(
+            generations_dir / f"{generation}.bin", ignore_errors=True
+        )
+        (generations_dir / f"{generation}.json").unlink(missing_ok=True)
+
+    # Left by builds that were killed.
+    for generation in set(list_generation_dirs(paths, package_name)) - set(
+        list_generations(paths, package_name)
+    ):
+        discard_generation(paths, package_name, generation)
+
+
+def allocate_generation(paths: Paths, package_name: str) -> Path:
+    """
+    Create the directory of a package's next generation for a build to
+    install into. It is published with `publish_generation`.
+    """
+
+    live_dir = paths.files / package_name
+
+    # Numbered before the new build, as it is older.
+    if (
+        get_current_generation(paths, package_name) is None
+        and live_dir.is_dir()
+        and not live_dir.is_symlink()
+    ):
+        adopt_files_directory(paths, package_name)
+
+    generation_dir = ensure_dir(
+        get_generations_dir(paths, package_name)
+    ) / str(get_next_generation(paths, package_name))
+    generation_dir.mkdir()
+
+    return generation_dir
+
+
+def discard_generation(
+    paths: Paths, package_name: str, generation: int
+) -> None:
+    "Delete a generation directory, unless it was published."
+
+    generations_dir = get_generations_dir(paths, package_name)
+
+    if not (generations_dir / f"{generation}.json").exists():
+        shutil.rmtree(generations_dir / str(generation), ignore_errors=True)
+        shutil.rmtree(
+            generations_dir / f"{generation}.bin", ignore_errors=True
+        )
+
+
+def publish_generation(
+    paths: Paths, staged: Paths, package_name: str, commit: str | None = None
+) -> int:
+    """
+    Turn a staged build of `commit` into a new generation and switch to
+    it. The staged files directory is either moved into place, or a link
+    to a directory from `allocate_generation`. Returns the new
+    generation's number.
+    """
+
+    live_dir = paths.files / package_name
+    staged_dir = staged.files / package_name
+    current = get_current_generation(paths, package_name)
+
+    if current is None and live_dir.is_dir() and not live_dir.is_symlink():
+        current = adopt_files_directory(paths, package_name)
+
+    generations_dir = ensure_dir(get_generations_dir(paths, package_name))
+
+    if staged_dir.is_symlink():
+        generation_dir = staged_dir.resolve()
+        generation = int(generation_dir.name)
+
+    else:
+        generation = get_next_generation(paths, package_name)
+        generation_dir = generations_dir / str(generation)
+        os.rename(ensure_dir(staged_dir), generation_dir)
+
+    if current is not None:
+        linked = link_unchanged_files(
+            generations_dir / str(current), generation_dir
+        )
+        log.debug(f"{linked} files are unchanged since generation {current}.")
+
+    binaries = {}
+
+    if staged.binaries.exists():
+        for entry in staged.binaries.iterdir():
+            if not entry.is_symlink():
+                binary = (
+                    ensure_dir(generations_dir / f"{generation}.bin")
+                    / entry.name
+                )
+                os.rename(entry, binary)
+                binaries[entry.name] = str(binary)
+                continue
+
+            target = Path(os.readlink(entry))
+
+            if target.is_relative_to(staged.files):
+                target = paths.files / target.relative_to(staged.files)
+
+            binaries[entry.name] = str(target)
+
+    write_record(
+        paths,
+        package_name,
+        generation,
+        {
+            "binaries": binaries,
+            "commit": commit,
+            "metadata": read_source_metadata(paths, package_name),
+            "time": time.time(),
+        },
+    )
+    activate_generation(paths, package_name, generation, current)
+    collect_garbage(paths, package_name)
+
+    return generation
+
+
+def remove_generations(paths: Paths, package_name: str) -> None:
+    "Delete all of a package's generations and the binaries they installed."
+
+    current = get_current_generation(paths, package_name)
+
+    if current is not None:
+        for name, target in read_record(paths, package_name, current)[
+            "binaries"
+        ].items():
+            link = paths.binaries / name
+
+            if link.is_symlink() and os.readlink(link) == target:
+                link.unlink()
+
+    (paths.files / package_name).unlink(missing_ok=True)
+    shutil.rmtree(get_generations_dir(paths, package_name), ignore_errors=True)
+
+
+def rollback_package(_flags: Any, paths: Paths, *args: str) -> None:
+    """
+    Switch a package back to its previous generation, or to the given
+    one, without downloading or building anything.
+    """
+
+    if not args:
+        fatal_error("Usage: apm rollback <package> [generation]")
+
+    package_name = args[0].lower()
+
+    with package_lock(paths, package_name):
+        current = get_current_generation(paths, package_name)
+        generations = list_generations(paths, package_name)
+
+        if current is None:
+            fatal_error(f"{package_name} has no generations to roll back to.")
+
+        if len(args) > 1:
+            if not args[1].isdigit() or int(args[1]) not in generations:
+                fatal_error(
+                    f"{package_name} has no generation {args[1]}, it has:",
+                    ", ".join(map(str, generations)),
+                )
+
+            generation = int(args[1])
+
+        else:
+            older = [
+                generation
+                for generation in generations
+                if generation < current
+            ]
+
+            if not older:
+                fatal_error(
+                    f"{package_name} has no generation before {current}."
+                )
+
+            generation = older[-1]
+
+        activate_generation(paths, package_name, generation, current)
+        log.success(
+            f"Rolled {package_name} back from generation {current} to "
+            f"{generation}."
+        )
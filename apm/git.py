@@ -0,0 +1,84 @@
+"""
+Helpers for running git.
+"""
+
+import subprocess  # nosec B404
+import time
+
+from pathlib import Path
+
+from apm import events, log
+
+# Exit status of a git command that was stopped by its timeout, as `timeout`.
+TIMED_OUT = 124
+
+
+def git(
+    *args: str | Path, cwd: Path | None = None, timeout: float | None = None
+) -> int:
+    """
+    Run git with `args` in `cwd`, returning its exit status. It is stopped
+    after `timeout` seconds, if given.
+    """
+
+    command = ["git", *map(str, args)]
+    log.debug(" ".join(command))
+    start = time.perf_counter()
+
+    try:
+        status = subprocess.run(  # nosec B603
+            command, cwd=cwd, check=False, timeout=timeout
+        ).returncode
+
+    except subprocess.TimeoutExpired:
+        log.warn(f"git {args[0]} did not finish before the network deadline.")
+        status = TIMED_OUT
+
+    events.emit_command(command, status, start)
+
+    return status
+
+
+def git_output(
+    *args: str | Path, cwd: Path | None = None, timeout: float | None = None
+) -> str | None:
+    """
+    Run git with `args` in `cwd`, returning its output, or None if it
+    failed or took longer than `timeout` seconds.
+    """
+
+    command = ["git", *map(str, args)]
+    log.debug(" ".join(command))
+
+    start = time.perf_counter()
+
+    try:
+        process = subprocess.run(  # nosec B603
+            command,
+            cwd=cwd,
+            check=False,
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+
+    except subprocess.TimeoutExpired:
+        log.debug(f"git {args[0]} did not finish before the network deadline.")
+        events.emit_command(command, TIMED_OUT, start)
+        return None
+
+    events.emit_command(command, process.returncode, start)
+
+    if process.returncode:
+        log.debug(process.stderr)
+        return None
+
+    return process.stdout
+
+
+def is_full_commit_hash(commit: str) -> bool:
+    "Whether `commit` is a full hash, which can be fetched on its own."
+
+    return len(commit) in (40, 64) and all(
+        character in "0123456789abcdef" for character in commit.lower()
+    )
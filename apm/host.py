@@ -0,0 +1,105 @@
+"""
+Facts about the host: Linux distribution, CPU architecture and package
+manager.
+
+They cannot change without a reboot, so they are worked out once per boot
+and cached in the Avalon cache.
+"""
+
+import json
+import os
+import platform
+
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from apm import events, log
+from apm.path import Paths, ensure_dir
+
+BOOT_ID = Path("/proc/sys/kernel/random/boot_id")
+
+
+@dataclass
+class HostFacts:
+    "What packages' requirements are checked against."
+
+    distro: str
+    arch: str
+    package_manager: str | None
+
+
+_facts: HostFacts | None = None
+
+
+def get_boot_id() -> str | None:
+    "An identifier that changes on every boot, if the kernel provides one."
+
+    try:
+        return BOOT_ID.read_text(encoding="utf-8").strip()
+
+    except OSError:
+        return None
+
+
+def detect_package_manager() -> str | None:
+    "The system package manager that dependencies can be installed with."
+
+    if os.path.exists("/usr/bin/apt") and not os.path.exists(
+        "/usr/libexec/eselect-java/run-java-tool.bash"
+    ):
+        return "apt"
+
+    if os.path.exists("/etc/portage"):
+        return "portage"
+
+    return None
+
+
+def detect_host_facts() -> HostFacts:
+    "Work out the host facts from scratch."
+
+    import distro  # pylint: disable=import-outside-toplevel
+
+    return HostFacts(
+        distro.linux_distribution()[0],
+        platform.machine(),
+        detect_package_manager(),
+    )
+
+
+def get_host_facts(paths: Paths) -> HostFacts:
+    "The host facts, from memory, the per-boot cache or detected afresh."
+
+    global _facts  # pylint: disable=global-statement
+
+    if _facts is not None:
+        return _facts
+
+    cache_path = paths.cache / "host.json"
+    boot_id = get_boot_id()
+
+    try:
+        cached = json.loads(cache_path.read_text(encoding="utf-8"))
+
+        if boot_id is not None and cached.pop("boot_id") == boot_id:
+            _facts = HostFacts(**cached)
+            events.emit("cache", cache="host", hit=True)
+            return _facts
+
+    except (OSError, KeyError, TypeError, json.decoder.JSONDecodeError):
+        pass
+
+    _facts = detect_host_facts()
+    events.emit("cache", cache="host", hit=False)
+    log.debug("Host facts:", str(_facts))
+
+    if boot_id is not None:
+        ensure_dir(paths.cache)
+        temporary = cache_path.with_name(f"host.json.{os.getpid()}")
+        temporary.write_text(
+            json.dumps({"boot_id": boot_id, **asdict(_facts)}),
+            encoding="utf-8",
+        )
+        os.replace(temporary, cache_path)
+
+    return _facts
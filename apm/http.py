@@ -0,0 +1,24 @@
+"""
+One HTTP session for all of apm's requests, so that connections to the
+same host are reused, including across jobs of `apm daemon`.
+"""
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+_session: "requests.Session | None" = None
+
+
+def get_session() -> "requests.Session":
+    "The shared session, created on first use."
+
+    global _session  # pylint: disable=global-statement
+
+    if _session is None:
+        import requests  # pylint: disable=import-outside-toplevel
+
+        _session = requests.Session()
+
+    return _session
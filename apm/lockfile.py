@@ -0,0 +1,430 @@
+"""
+Lockfiles: the exact commit of every installed package, so that other
+hosts can be provisioned with the same packages.
+
+`apm lock` writes one from what is installed. `apm sync` makes a host
+match one, without resolving dependencies again. Builds are cached by
+commit and metadata hash, so going back to a locked state that was built
+before does not compile anything.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass, field, replace
+from graphlib import CycleError, TopologicalSorter
+from pathlib import Path
+
+import kazparse.flags
+
+from apm import events, log, timings
+from apm.archive import pack
+from apm.config import load_config
+from apm.generations import get_built_commit, get_built_metadata
+from apm.git import git_output
+from apm.locks import package_lock
+from apm.log import fatal_error
+from apm.package import parse_requirement
+from apm.path import Paths, ensure_dir, get_run_temp
+from .metadata import (
+    download_metadata_repository,
+    get_installed_package_metadata,
+    get_installed_repos,
+    get_metadata_repository,
+    get_package_metadata,
+    is_avalon_package,
+    is_in_metadata_repository,
+    move_metadata_to_dot_avalon_folder,
+)
+from .build import compile_package
+from .mirrors import try_mirrors
+from .pm_util import uninstall_package
+from .prebuilt import start_prebuilt_download
+from .sources import download_package, remove_package_source
+from .system_dependencies import install_system_dependencies
+
+LOCKFILE_VERSION = 1
+DEFAULT_LOCKFILE = "avalon.lock"
+
+
+@dataclass
+class LockedPackage:
+    "A package as it is installed."
+
+    commit: str | None
+    version: str | None
+    # `sha256:<hex>` of the package's `.avalon/package`.
+    metadata: str | None
+    dependencies: list[str] = field(default_factory=list)
+
+
+def hash_metadata(paths: Paths, package_name: str) -> str | None:
+    "The hash of the `.avalon/package` a package was built with."
+
+    built = get_built_metadata(paths, package_name)
+
+    if built is not None:
+        return "sha256:" + hashlib.sha256(built.encode()).hexdigest()
+
+    try:
+        data = (paths.source / package_name / ".avalon/package").read_bytes()
+
+    except OSError:
+        return None
+
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def get_installed_state(paths: Paths, package_name: str) -> LockedPackage:
+    """
+    What is currently installed for `package_name`: its current
+    generation's, which after a rollback is older than its source.
+    """
+
+    output = get_built_commit(paths, package_name) or git_output(
+        "rev-parse", "HEAD", cwd=paths.source / package_name
+    )
+    package = get_installed_package_metadata(paths, package_name)
+    dependencies = []
+
+    if package is not None:
+        dependencies = sorted(
+            {
+                parse_requirement(dep.lower()).name
+                for dep in (package.deps or {}).get("avalon") or []
+            }
+        )
+
+    return LockedPackage(
+        output.strip() if output else None,
+        package.version if package else None,
+        hash_metadata(paths, package_name),
+        dependencies,
+    )
+
+
+def read_lockfile(lockfile: Path) -> dict[str, LockedPackage]:
+    "Read the packages in a lockfile."
+
+    try:
+        with lockfile.open("r", encoding="utf-8") as lock:
+            data = json.load(lock)
+
+    except (OSError, json.decoder.JSONDecodeError) as exception:
+        fatal_error(f"Failed to read {lockfile}:", str(exception))
+
+    if data.get("version") != LOCKFILE_VERSION:
+        fatal_error(
+            f"{lockfile} is not a version {LOCKFILE_VERSION} lockfile."
+        )
+
+    return {
+        name: LockedPackage(**locked)
+        for name, locked in data["packages"].items()
+    }
+
+
+def write_lockfile(lockfile: Path, packages: dict[str, LockedPackage]) -> None:
+    "Write `packages` to a lockfile."
+
+    lockfile.write_text(
+        json.dumps(
+            {
+                "version": LOCKFILE_VERSION,
+                "packages": {
+                    name: asdict(packages[name]) for name in sorted(packages)
+                },
+            },
+            indent=4,
+        )
+        + "\n",
+        encoding="utf-8",
+    )
+
+
+def get_build_cache_path(
+    paths: Paths, package_name: str, locked: LockedPackage
+) -> Path:
+    "Where the build of that commit and metadata is cached."
+
+    metadata_hash = (locked.metadata or "").removeprefix("sha256:")[:16]
+
+    name = package_name.replace("/", "__")
+
+    return (
+        paths.cache / "builds" / f"{name}-{locked.commit}-{metadata_hash}.apm"
+    )
+
+
+def store_build(
+    paths: Paths, package_name: str, locked: LockedPackage
+) -> None:
+    "Cache a package's files directory after building it."
+
+    files_dir = paths.files / package_name
+    cache_path = get_build_cache_path(paths, package_name, locked)
+    ensure_dir(cache_path.parent)
+
+    files = []
+
+    for directory, dirnames, filenames in os.walk(files_dir):
+        for name in filenames + [
+            name
+            for name in dirnames
+            if os.path.islink(os.path.join(directory, name))
+        ]:
+            files.append(Path(directory) / name)
+
+    temporary = cache_path.with_name(f"{cache_path.name}.{os.getpid()}")
+    pack(files_dir, temporary, files)
+    os.replace(temporary, cache_path)
+    prune_builds(paths, package_name)
+
+
+def prune_builds(paths: Paths, package_name: str) -> None:
+    "Delete a package's oldest cached builds beyond `keep_generations`."
+
+    keep = max(load_config(paths).keep_generations, 1)
+    # `<package>-<commit>-<metadata hash>.apm`, not another package's.
+    pattern = re.compile(
+        re.escape(package_name.replace("/", "__"))
+        + r"-[0-9a-f]+-[0-9a-f]*\.apm"
+    )
+    builds = []
+
+    with os.scandir(paths.cache / "builds") as entries:
+        for entry in entries:
+            if pattern.fullmatch(entry.name):
+                builds.append((entry.stat().st_mtime, Path(entry.path)))
+
+    for _mtime, build in sorted(builds, reverse=True)[keep:]:
+        log.debug("Deleting cached build", build)
+        build.unlink(missing_ok=True)
+
+
+def restore_build(
+    paths: Paths, package_name: str, locked: LockedPackage
+) -> "Future[Path | None] | None":
+    """
+    A cached build of the package, as a finished prebuilt download for
+    `compile_package`, or None if it was never built.
+    """
+
+    cache_path = get_build_cache_path(paths, package_name, locked)
+    hit = cache_path.exists()
+    events.emit("cache", cache="build", package=package_name, hit=hit)
+
+    if not hit:
+        return None
+
+    # The least recently used builds are pruned first.
+    os.utime(cache_path)
+    # `compile_package` deletes the artifact after installing it.
+    artifact_path = get_run_temp(paths) / cache_path.name
+
+    try:
+        artifact_path.unlink(missing_ok=True)
+        os.link(cache_path, artifact_path)
+
+    except OSError:
+        shutil.copyfile(cache_path, artifact_path)
+
+    future: "Future[Path | None]" = Future()
+    future.set_result(artifact_path)
+
+    return future
+
+
+def lock_packages(
+    _flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
+    "Write the installed packages' commits to a lockfile"
+
+    lockfile = Path(args[0] if args else DEFAULT_LOCKFILE)
+    packages = {}
+
+    for package_name in get_installed_repos(paths):
+        locked = get_installed_state(paths, package_name)
+
+        if locked.commit is None:
+            log.warn(
+                package_name,
+                "was not installed from git, it cannot be synced to other "
+                "hosts.",
+            )
+
+        packages[package_name] = locked
+
+    write_lockfile(lockfile, packages)
+    log.success(f"Locked {len(packages)} packages in {lockfile}")
+
+
+def download_locked_package(
+    paths: Paths, package_name: str, locked: LockedPackage
+) -> bool:
+    "Download the locked commit of a package's source."
+
+    def download_from(mirror: str) -> bool:
+        remove_package_source(paths, package_name)
+
+        return download_package(
+            paths,
+            f"{mirror}/{package_name}",
+            package_name,
+            commit=locked.commit,
+        )
+
+    return try_mirrors(paths, "source", download_from)
+
+
+def build_locked_package(
+    flags: kazparse.flags.Flags,
+    paths: Paths,
+    package_name: str,
+    locked: LockedPackage,
+) -> None:
+    """
+    Install a package whose locked source has been downloaded, from the
+    build cache if it was built before.
+    """
+
+    get_metadata_repository(paths).invalidate(package_name)
+
+    if is_in_metadata_repository(
+        package_name, paths
+    ) and not is_avalon_package(paths, package_name):
+        move_metadata_to_dot_avalon_folder(package_name, paths)
+
+    metadata_hash = hash_metadata(paths, package_name)
+
+    if locked.metadata and metadata_hash != locked.metadata:
+        if not flags.force:
+            fatal_error(
+                f"The metadata of {package_name} does not match the lockfile."
+            )
+
+        log.warn(
+            f"The metadata of {package_name} does not match the lockfile."
+        )
+
+    locked = replace(locked, metadata=metadata_hash)
+    package = get_package_metadata(paths, package_name)
+    install_system_dependencies(paths, package_name, package)
+
+    prebuilt = restore_build(paths, package_name, locked)
+    cached = prebuilt is not None
+
+    if prebuilt is None:
+        prebuilt = start_prebuilt_download(paths, package_name, package)
+
+    with timings.phase("compile", package=package_name):
+        compile_package(package_name, paths, flags, prebuilt)
+
+    if not cached:
+        store_build(paths, package_name, locked)
+
+
+def sync_packages(
+    flags: kazparse.flags.Flags, paths: Paths, *args: str
+) -> None:
+    "Make the installed packages match a lockfile"
+
+    log.IS_DEBUG = flags.debug
+
+    lockfile = Path(args[0] if args else DEFAULT_LOCKFILE)
+    wanted = read_lockfile(lockfile)
+    installed = set(get_installed_repos(paths))
+
+    changed = {
+        package_name: locked
+        for package_name, locked in wanted.items()
+        if package_name not in installed
+        or get_installed_state(paths, package_name).commit != locked.commit
+        or hash_metadata(paths, package_name) != locked.metadata
+    }
+    extra = sorted(installed - wanted.keys())
+
+    if not changed and not extra:
+        log.success("Already in sync.")
+        return
+
+    unsyncable = [
+        name for name, locked in changed.items() if locked.commit is None
+    ]
+
+    if unsyncable:
+        fatal_error("No commit is locked for", ", ".join(unsyncable))
+
+    with ExitStack() as stack:
+        # Locked in a fixed order, so that two syncs cannot deadlock.
+        for package_name in sorted(changed.keys() | extra):
+            stack.enter_context(package_lock(paths, package_name))
+
+        apply_sync(flags, paths, changed, extra)
+
+    log.success(
+        f"Synced {len(changed)} packages and removed {len(extra)} from "
+        f"{lockfile}."
+    )
+
+
+def apply_sync(
+    flags: kazparse.flags.Flags,
+    paths: Paths,
+    changed: dict[str, LockedPackage],
+    extra: list[str],
+) -> None:
+    "Download and build the changed packages and remove the extra ones."
+
+    with timings.phase("metadata repository"):
+        download_metadata_repository(paths)
+
+    log.note(f"Downloading {len(changed)} packages.....")
+    jobs = max(load_config(paths).download_jobs, 1)
+
+    with timings.phase("download"), ThreadPoolExecutor(jobs) as pool:
+        downloads = {
+            package_name: pool.submit(
+                download_locked_package, paths, package_name, locked
+            )
+            for package_name, locked in changed.items()
+        }
+
+    failed = [
+        name for name, download in downloads.items() if not download.result()
+    ]
+
+    if failed:
+        fatal_error("Failed to download", ", ".join(failed))
+
+    try:
+        order = list(
+            TopologicalSorter(
+                {
+                    package_name: [
+                        dep for dep in locked.dependencies if dep in changed
+                    ]
+                    for package_name, locked in changed.items()
+                }
+            ).static_order()
+        )
+
+    except CycleError as exception:
+        fatal_error(
+            "Locked dependencies form a cycle:", " -> ".join(exception.args[1])
+        )
+
+    for package_name in order:
+        log.note(
+            "Installing", package_name, "at", str(changed[package_name].commit)
+        )
+        build_locked_package(flags, paths, package_name, changed[package_name])
+
+    for package_name in extra:
+        log.note("Uninstalling", package_name)
+        uninstall_package(flags, paths, [package_name])
@@ -0,0 +1,110 @@
+"""
+Locks that let several `apm` processes share one Avalon tree.
+
+Each package has a lock held while it is downloaded, built, installed or
+removed, so unrelated packages can be installed in parallel. Short
+global locks (`METADATA`, `STATE`, `BLOBS`) protect the metadata
+repository, small state files and the blob store.
+
+They are `fcntl` record locks, so the kernel reports a deadlock between
+two processes instead of hanging. Locks are re-entrant within a thread,
+and exclusive between threads of one process.
+"""
+
+import errno
+import fcntl
+import threading
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import IO, ContextManager, Iterator
+
+from apm import log
+from apm.log import fatal_error
+from apm.path import Paths, ensure_dir
+
+METADATA = ".metadata"
+STATE = ".state"
+BLOBS = ".blobs"
+
+
+@dataclass
+class _HeldLock:
+    "A lock file opened by this process and how deeply it is held."
+
+    thread_lock: threading.RLock
+    depth: int = 0
+    file: IO[str] | None = None
+
+
+_held: dict[str, _HeldLock] = {}
+_guard = threading.Lock()
+
+
+def _lock_file(lock_file: IO[str], name: str, shared: bool) -> None:
+    "Take the lock, saying what is being waited for if it is busy."
+
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+
+    try:
+        fcntl.lockf(lock_file, operation | fcntl.LOCK_NB)
+        return
+
+    except OSError as exception:
+        if exception.errno not in (errno.EACCES, errno.EAGAIN):
+            raise
+
+    log.note(f"Waiting for another apm to finish with {name.lstrip('.')}.....")
+
+    try:
+        fcntl.lockf(lock_file, operation)
+
+    except OSError as exception:
+        if exception.errno != errno.EDEADLK:
+            raise
+
+        fatal_error(
+            f"Waiting for {name.lstrip('.')} would deadlock another apm."
+        )
+
+
+@contextmanager
+def lock(paths: Paths, name: str, shared: bool = False) -> Iterator[None]:
+    "Hold the lock called `name`, e.g. a package name or `STATE`."
+
+    with _guard:
+        held = _held.setdefault(name, _HeldLock(threading.RLock()))
+
+    with held.thread_lock:
+        if held.depth == 0:
+            lock_path = ensure_dir(paths.cache / "locks") / (
+                name.replace("/", "__") + ".lock"
+            )
+            held.file = lock_path.open("a+", encoding="utf-8")
+
+            try:
+                _lock_file(held.file, name, shared)
+
+            except BaseException:
+                held.file.close()
+                held.file = None
+                raise
+
+        held.depth += 1
+
+        try:
+            yield
+
+        finally:
+            held.depth -= 1
+
+            if held.depth == 0 and held.file is not None:
+                # Closing the file releases the lock.
+                held.file.close()
+                held.file = None
+
+
+def package_lock(paths: Paths, package_name: str) -> ContextManager[None]:
+    "Hold a package's lock while changing its source, files or binaries."
+
+    return lock(paths, package_name.lower())
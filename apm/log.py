@@ -9,6 +9,8 @@ from enum import Enum
 from pathlib import Path
 from typing import NoReturn
 
+from apm import events
+
 IS_SILENT = False
 IS_DEBUG = False
 
@@ -23,12 +25,25 @@ class Colors(Enum):
     DEBUG = 5  # Purple, by default
 
 
+# The `level` of `--machine` log events.
+LEVELS = {
+    Colors.OK: "note",
+    Colors.WARN: "warning",
+    Colors.SUCCESS: "success",
+    Colors.FAIL: "error",
+    Colors.DEBUG: "debug",
+}
+
+
 def colorprint(*text: str | Path, color: Colors = Colors.OK) -> str:
     "Print `text` with the color `color` using `tput`"
 
     joined_text = " ".join(map(str, text))
 
-    if not IS_SILENT:
+    if events.IS_STREAMING:
+        events.emit("log", level=LEVELS[color], message=joined_text)
+
+    elif not IS_SILENT:
         os.system(
             f"tput setaf {color.value}"
         )  # Set the text color using `tput`  # nosec
@@ -5,8 +5,13 @@ Functions for retrieving and interacting with package metadata.
 import json
 import os
 import shutil
+import subprocess  # nosec B404
+import sys
+import threading
+import time
+
+from pathlib import Path
 
-import requests
 from apm.path import Paths
 import kazparse
 import kazparse.flags
@@ -15,6 +20,20 @@ from apm import log
 from apm.log import fatal_error
 from apm.package import Package
 from .case.case import get_case_insensitive_path
+from .config import load_config
+from .generations import get_built_metadata
+from .git import git
+from .locks import METADATA, lock
+from .mirrors import demote_mirror, get_ranked_mirrors, try_mirrors
+from .network import get_remaining, request
+
+# Kept in the metadata repository's `.git`, so `git status` stays clean.
+REFRESHED_STAMP = "avalon-refreshed"
+# Seconds before another background refresh may be started.
+REFRESH_RETRY = 600
+
+# Metadata files that were parsed, with their modification time.
+_parsed: dict[Path, tuple[int, Package]] = {}
 
 
 def get_local_package_metadata(paths: Paths, package_name: str) -> Package | None:
@@ -26,12 +45,22 @@ def get_local_package_metadata(paths: Paths, package_name: str) -> Package | Non
     ]
 
     for location in locations:
-        if not location.exists():
+        try:
+            mtime = location.stat().st_mtime_ns
+
+        except OSError:
             continue
 
+        if location in _parsed and _parsed[location][0] == mtime:
+            return _parsed[location][1]
+
         try:
             with location.open("r") as metadata_file:
-                return Package(**dict(json.load(metadata_file)))
+                package = Package(**dict(json.load(metadata_file)))
+
+            _parsed[location] = (mtime, package)
+
+            return package
 
         except json.decoder.JSONDecodeError as exception:
             log.warn(
@@ -45,55 +74,150 @@ def get_local_package_metadata(paths: Paths, package_name: str) -> Package | Non
 
 
 def get_remote_package_metadata(
-    package_name: str, commit: str | None = None, branch: str | None = None
+    paths: Paths,
+    package_name: str,
+    commit: str | None = None,
+    branch: str | None = None,
 ) -> Package | None:
-    "Attempt to retrive metadata from GitHub, if possible."
+    "Attempt to retrive metadata from GitHub (or a raw mirror), if possible."
 
-    package_url = "https://raw.githubusercontent.com/{package}/{branch}/.avalon/package"
+    import requests  # pylint: disable=import-outside-toplevel
 
+    package_url = "{package}/{branch}/.avalon/package"
+
+    # The requested commit or branch's own metadata comes first, so that
+    # e.g. a tagged version is not described by the default branch's. A
+    # commit on a branch is described by the commit's.
     package_urls = [
-        f"https://raw.githubusercontent.com/R2Boyo25/AvalonPMPackages/master/{package_name}/package",  # pylint: disable=C0301
+        package_url.format(package=package_name, branch=ref)
+        for ref in (commit, branch)
+        if ref
+    ] + [
+        f"R2Boyo25/AvalonPMPackages/master/{package_name}/package",
         package_url.format(package=package_name, branch="main"),
         package_url.format(package=package_name, branch="master"),
     ]
 
-    if branch and commit:
-        raise NotImplementedError(
-            "Branch and commit cannot be specified, fix this later."
-        )
+    mirrors = get_ranked_mirrors(paths, "raw")
 
-    if branch:
-        package_urls.append(package_url.format(package=package_name, branch=branch))
+    for package_path in package_urls:
+        for mirror in mirrors:
+            url = f"{mirror}/{package_path}"
+            log.debug("Trying URL:", url)
 
-    if commit:
-        package_urls.append(package_url.format(package=package_name, branch=commit))
+            try:
+                result = request(paths, "GET", url)
 
-    for url in package_urls:
-        log.debug("Trying URL:", url)
+            except requests.RequestException as exception:
+                log.debug("Request failed:", str(exception))
+                demote_mirror(paths, "raw", mirror)
+                continue
 
-        result = requests.get(
-            url,
-            timeout=10,
-        )
+            log.debug(result.text)
 
-        log.debug(result.text)
+            if result.status_code >= 500:
+                demote_mirror(paths, "raw", mirror)
+                continue
 
-        if result.status_code == 404:
-            continue
+            if result.status_code == 404:
+                break
 
-        try:
-            return Package(**dict(result.json()))
+            try:
+                return Package(**dict(result.json()))
 
-        except json.decoder.JSONDecodeError as exception:
-            log.warn(
-                "Failed to parse package metadata at",
-                url,
-                "reason:\n" + str(exception),
-            )
+            except json.decoder.JSONDecodeError as exception:
+                log.warn(
+                    "Failed to parse package metadata at",
+                    url,
+                    "reason:\n" + str(exception),
+                )
+                break
 
     return None
 
 
+class MetadataRepository:
+    """
+    Package metadata for one run, keyed by package name, commit and branch,
+    so that each package's metadata is read (or downloaded) only once.
+
+    Anything that changes a package's source or `.avalon` folder must call
+    `invalidate` for it. It may be used from several threads at once.
+    """
+
+    def __init__(self, paths: Paths) -> None:
+        self.paths = paths
+        self._packages: dict[tuple[str, str | None, str | None], Package | None] = {}
+        # How often each package was invalidated, so that metadata read
+        # while it was being replaced is not kept.
+        self._invalidations: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        package_name: str,
+        commit: str | None = None,
+        branch: str | None = None,
+    ) -> Package | None:
+        "The package's local metadata, or its remote metadata if there is none."
+
+        key = (package_name, commit, branch)
+
+        with self._lock:
+            if key in self._packages:
+                return self._packages[key]
+
+            invalidations = self._invalidations.get(package_name, 0)
+
+        # Read without the lock, downloading can take a while.
+        log.debug("Getting package info for:", package_name)
+
+        info = get_local_package_metadata(self.paths, package_name)
+
+        if info is None:
+            info = get_remote_package_metadata(
+                self.paths, package_name, commit=commit, branch=branch
+            )
+
+        with self._lock:
+            if self._invalidations.get(package_name, 0) == invalidations:
+                self._packages[key] = info
+
+        return info
+
+    def invalidate(self, package_name: str) -> None:
+        "Forget the package's metadata, so that it is read again."
+
+        with self._lock:
+            self._invalidations[package_name] = (
+                self._invalidations.get(package_name, 0) + 1
+            )
+
+            for key in [key for key in self._packages if key[0] == package_name]:
+                del self._packages[key]
+
+
+_repository: MetadataRepository | None = None
+_repository_lock = threading.Lock()
+
+
+def get_metadata_repository(paths: Paths) -> MetadataRepository:
+    "The metadata repository for `paths` for this run."
+
+    global _repository  # pylint: disable=global-statement
+
+    with _repository_lock:
+        # Staged builds use other files and binaries directories, but the
+        # same metadata.
+        if _repository is None or (
+            _repository.paths.source,
+            _repository.paths.metadata,
+        ) != (paths.source, paths.metadata):
+            _repository = MetadataRepository(paths)
+
+        return _repository
+
+
 def get_package_metadata(
     paths: Paths,
     package_name: str,
@@ -102,12 +226,7 @@ def get_package_metadata(
 ) -> Package:
     "Attempt to retrive the package's metadata"
 
-    log.debug("Getting package info for:", package_name)
-
-    info = get_local_package_metadata(paths, package_name)
-
-    if info is None:
-        info = get_remote_package_metadata(package_name, commit=commit, branch=branch)
+    info = get_metadata_repository(paths).get(package_name, commit, branch)
 
     if info is None:
         fatal_error("No valid metadata available for", package_name)
@@ -127,34 +246,159 @@ def is_in_metadata_repository(package_name: str, paths: Paths) -> bool:
     return status
 
 
+def get_metadata_repository_age(paths: Paths) -> float | None:
+    "Seconds since the metadata repository was last refreshed, if ever."
+
+    stamp = paths.metadata / ".git" / REFRESHED_STAMP
+
+    try:
+        return time.time() - stamp.stat().st_mtime
+
+    except FileNotFoundError:
+        return None
+
+
+def mark_metadata_repository_refreshed(paths: Paths) -> None:
+    "Record that the metadata repository was just refreshed."
+
+    (paths.metadata / ".git" / REFRESHED_STAMP).touch()
+
+
+def refresh_metadata_repository_in_background(paths: Paths) -> None:
+    """
+    Pull the metadata repository in a detached process, so that the
+    current command does not wait for it. At most one refresh is started
+    every `REFRESH_RETRY` seconds.
+    """
+
+    started = paths.metadata / ".git" / "avalon-refresh-started"
+
+    try:
+        if time.time() - started.stat().st_mtime < REFRESH_RETRY:
+            return
+
+    except FileNotFoundError:
+        pass
+
+    started.touch()
+    log.debug("Refreshing the metadata repository in the background.")
+
+    subprocess.Popen(  # pylint: disable=consider-using-with  # nosec B603
+        [
+            sys.executable,
+            "-m",
+            "apm.metadata",
+            str(paths.metadata),
+            str(paths.cache),
+        ],
+        # So that `-m` finds this copy of apm.
+        cwd=Path(__file__).resolve().parents[1],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def refresh_metadata_repository(paths: Paths) -> None:
+    """
+    Pull the metadata repository while holding its lock, so that no other
+    apm reads or pulls it halfway through. Run by background refreshes.
+    """
+
+    with lock(paths, METADATA):
+        if not git("pull", "-q", "--ff-only", cwd=paths.metadata):
+            mark_metadata_repository_refreshed(paths)
+
+
 def download_metadata_repository(paths: Paths, do_not_update: bool = True) -> None:
-    "Download the metadata repository using git. If if_missing"
+    """
+    Download the metadata repository using git if it is missing.
+
+    If `do_not_update` is False, pull it and wait for that. Otherwise it is
+    left alone while it is younger than `metadata_ttl`, and refreshed in
+    the background once it is older.
+    """
+
+    if (paths.metadata / ".git").exists():
+        if not do_not_update:
+            with lock(paths, METADATA):
+                if git("pull", "-q", cwd=paths.metadata, timeout=get_remaining()):
+                    log.warn("Failed to refresh the metadata repository.")
+
+                else:
+                    mark_metadata_repository_refreshed(paths)
+
+            return
+
+        age = get_metadata_repository_age(paths)
+        log.debug(f"The metadata repository was refreshed {age} seconds ago.")
+
+        if age is None or age > load_config(paths).metadata_ttl:
+            refresh_metadata_repository_in_background(paths)
 
-    if not do_not_update and (paths.metadata / "R2Boyo25").exists():
-        os.system(log.debug(f"cd {paths.metadata}; git pull"))
         return
 
-    os.system(
-        log.debug(
-            f'git clone --depth 1 https://github.com/r2boyo25/AvalonPMPackages "{paths.metadata}" -q'  # pylint: disable=C0301
+    def clone(mirror: str) -> bool:
+        return not git(
+            "clone",
+            "-q",
+            "--depth",
+            "1",
+            f"{mirror}/r2boyo25/AvalonPMPackages",
+            paths.metadata,
+            timeout=get_remaining(),
         )
-    )
+
+    with lock(paths, METADATA):
+        # Another apm may have cloned it while this one was waiting.
+        if (paths.metadata / ".git").exists():
+            return
+
+        if not try_mirrors(paths, "metadata", clone):
+            log.warn("Failed to download the metadata repository from every mirror.")
+            return
+
+        mark_metadata_repository_refreshed(paths)
 
 
 def get_installed_repos(paths: Paths) -> list[str]:
     "Get all installed programs"
 
+    if not paths.files.exists():
+        return []
+
+    # Dot directories hold staged builds, not packages.
     return [
         f"{user}/{repo}"
         for user in os.listdir(paths.files)
+        if not user.startswith(".")
         for repo in os.listdir(paths.files / user)
     ]
 
 
+def get_installed_package_metadata(paths: Paths, package_name: str) -> Package | None:
+    """
+    The metadata that the installed generation was built with. After a
+    rollback, it is older than the source's.
+    """
+
+    built = get_built_metadata(paths, package_name)
+
+    if built is not None:
+        try:
+            return Package(**dict(json.loads(built)))
+
+        except (json.decoder.JSONDecodeError, TypeError, ValueError):
+            pass
+
+    return get_local_package_metadata(paths, package_name)
+
+
 def get_package_version(paths: Paths, repo: str) -> str | None:
     "Get version of package"
 
-    package = get_local_package_metadata(paths, repo)
+    package = get_installed_package_metadata(paths, repo)
 
     if package is None or package.version is None:
         return None
@@ -196,6 +440,7 @@ def move_metadata_to_dot_avalon_folder(package_name: str, paths: Paths) -> None:
     shutil.rmtree(
         log.debug(paths.source / package_name / ".avalon"), ignore_errors=True
     )
+    get_metadata_repository(paths).invalidate(package_name)
 
     if is_in_metadata_repository(package_name, paths):
         log.debug(
@@ -224,3 +469,9 @@ def list_installed(flags: kazparse.flags.Flags, paths: Paths, *_args: str) -> No
     log.IS_DEBUG = flags.debug
 
     print("\n".join(get_installed_packages_and_versions(paths)).title())
+
+
+if __name__ == "__main__":
+    refresh_metadata_repository(
+        Paths(metadata=Path(sys.argv[1]), cache=Path(sys.argv[2]))
+    )
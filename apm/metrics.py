@@ -0,0 +1,356 @@
+"""
+Prometheus metrics for node_exporter's textfile collector.
+
+Set `metrics_file` in `config.json` to a `.prom` file in the collector's
+directory, and it is rewritten after every command that changes
+packages. Counters and histograms add up across runs in `metrics.json`
+in the Avalon cache. The file is replaced with a rename, so node_exporter
+never reads half of it.
+"""
+
+import json
+import os
+import re
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator
+
+from apm import events, log
+from apm.config import load_config
+from apm.locks import STATE, lock
+from apm.path import Paths, ensure_dir
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# A label in a series, e.g. `cache="build"`. Only simple values are parsed.
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+# Type and help text of each metric, in the order they are written.
+METRICS = {
+    "apm_runs_total": ("counter", "Commands run, by command and status."),
+    "apm_run_duration_seconds": ("histogram", "How long commands took."),
+    "apm_phase_duration_seconds": (
+        "histogram",
+        "How long each phase took, e.g. apt, pip or compile.",
+    ),
+    "apm_package_results_total": (
+        "counter",
+        "Packages built successfully or not, by package.",
+    ),
+    "apm_fetched_bytes_total": (
+        "counter",
+        "Bytes downloaded by git clones and fetches of package sources.",
+    ),
+    "apm_cache_lookups_total": (
+        "counter",
+        "Cache lookups, by cache and whether they hit.",
+    ),
+    "apm_cache_hit_ratio": (
+        "gauge",
+        "Share of cache lookups that hit, by cache.",
+    ),
+    "apm_last_run_timestamp_seconds": (
+        "gauge",
+        "When a command last finished, by command.",
+    ),
+}
+
+
+def escape(value: Any) -> str:
+    "Escape a label value for the text format."
+
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def get_series(name: str, **labels: Any) -> str:
+    'A metric and its labels, e.g. `apm_runs_total{command="install"}`.'
+
+    if not labels:
+        return name
+
+    inner = ",".join(
+        f'{key}="{escape(value)}"' for key, value in sorted(labels.items())
+    )
+
+    return f"{name}{{{inner}}}"
+
+
+def format_value(value: float) -> str:
+    "A sample value, without losing the precision of large counters."
+
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def split_series(series: str) -> tuple[str, str]:
+    "A series' metric name and the inside of its labels."
+
+    name, _, labels = series.partition("{")
+
+    return name, labels.removesuffix("}")
+
+
+@dataclass
+class Metrics:
+    "Counters, histograms and gauges, by series."
+
+    counters: dict[str, float] = field(default_factory=dict)
+    histograms: dict[str, dict[str, Any]] = field(default_factory=dict)
+    gauges: dict[str, float] = field(default_factory=dict)
+
+    def count(self, series: str, value: float = 1) -> None:
+        "Add `value` to a counter."
+
+        self.counters[series] = self.counters.get(series, 0) + value
+
+    def observe(self, series: str, value: float) -> None:
+        "Add an observation to a histogram."
+
+        histogram = self.histograms.setdefault(
+            series, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        )
+
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram["buckets"][index] += 1
+                break
+
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def merge(self, other: "Metrics") -> None:
+        "Add the counters and histograms of `other`, and take its gauges."
+
+        for series, value in other.counters.items():
+            self.count(series, value)
+
+        for series, histogram in other.histograms.items():
+            mine = self.histograms.setdefault(
+                series, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+            )
+            mine["buckets"] = [
+                count + new
+                for count, new in zip(mine["buckets"], histogram["buckets"])
+            ]
+            mine["sum"] += histogram["sum"]
+            mine["count"] += histogram["count"]
+
+        self.gauges.update(other.gauges)
+
+
+class Collector:  # pylint: disable=too-few-public-methods
+    "Turns the events of a command into metrics."
+
+    def __init__(self) -> None:
+        self.metrics = Metrics()
+        # Whether each package that was worked on has succeeded so far.
+        self.packages: dict[str, bool] = {}
+
+    def __call__(self, event: dict[str, Any]) -> None:
+        kind = event["event"]
+
+        if kind == "phase_end":
+            self.metrics.observe(
+                get_series("apm_phase_duration_seconds", phase=event["phase"]),
+                event["seconds"],
+            )
+
+            if "package" in event:
+                if not event["ok"]:
+                    self.packages[event["package"]] = False
+
+                elif event["phase"] == "compile":
+                    self.packages.setdefault(event["package"], True)
+
+        elif kind == "transfer":
+            self.metrics.count(
+                get_series(
+                    "apm_fetched_bytes_total", operation=event["operation"]
+                ),
+                event["bytes"],
+            )
+
+        elif kind == "cache":
+            self.metrics.count(
+                get_series(
+                    "apm_cache_lookups_total",
+                    cache=event["cache"],
+                    result="hit" if event["hit"] else "miss",
+                )
+            )
+
+        elif kind == "result":
+            command = event["command"]
+            status = "success" if event["ok"] else "failure"
+            self.metrics.count(
+                get_series("apm_runs_total", command=command, status=status)
+            )
+            self.metrics.observe(
+                get_series("apm_run_duration_seconds", command=command),
+                event["seconds"],
+            )
+            self.metrics.gauges[
+                get_series("apm_last_run_timestamp_seconds", command=command)
+            ] = event["time"]
+
+            for package, succeeded in self.packages.items():
+                self.metrics.count(
+                    get_series(
+                        "apm_package_results_total",
+                        package=package,
+                        result="success" if succeeded else "failure",
+                    )
+                )
+
+            self.packages.clear()
+
+
+def get_hit_ratios(metrics: Metrics) -> dict[str, float]:
+    "The share of lookups that hit, by `apm_cache_hit_ratio` series."
+
+    lookups: dict[str, tuple[float, float]] = {}
+
+    for series, value in metrics.counters.items():
+        name, labels = split_series(series)
+
+        if name != "apm_cache_lookups_total":
+            continue
+
+        labels_by_name = dict(LABEL.findall(labels))
+        cache, result = labels_by_name["cache"], labels_by_name["result"]
+        hits, total = lookups.get(cache, (0, 0))
+        lookups[cache] = (
+            hits + (value if result == "hit" else 0),
+            total + value,
+        )
+
+    return {
+        get_series("apm_cache_hit_ratio", cache=cache): hits / total
+        for cache, (hits, total) in lookups.items()
+        if total
+    }
+
+
+def format_metrics(metrics: Metrics) -> str:
+    "Format `metrics` in the Prometheus text format."
+
+    values: dict[str, list[str]] = {name: [] for name in METRICS}
+
+    for series, value in sorted(metrics.counters.items()):
+        values[split_series(series)[0]].append(
+            f"{series} {format_value(value)}"
+        )
+
+    for series, value in sorted(
+        {**metrics.gauges, **get_hit_ratios(metrics)}.items()
+    ):
+        values[split_series(series)[0]].append(
+            f"{series} {format_value(value)}"
+        )
+
+    for series, histogram in sorted(metrics.histograms.items()):
+        name, labels = split_series(series)
+        prefix = labels + "," if labels else ""
+        cumulative = 0
+
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            cumulative += count
+            values[name].append(
+                f'{name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}'
+            )
+
+        values[name] += [
+            f'{name}_bucket{{{prefix}le="+Inf"}} {histogram["count"]}',
+            f"{name}_sum{{{labels}}} {format_value(histogram['sum'])}",
+            f"{name}_count{{{labels}}} {histogram['count']}",
+        ]
+
+    lines = []
+
+    for name, (kind, description) in METRICS.items():
+        if values[name]:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            lines += values[name]
+
+    return "\n".join(lines) + "\n"
+
+
+def read_metrics(paths: Paths) -> Metrics:
+    "The metrics of every run so far."
+
+    try:
+        with (paths.cache / "metrics.json").open(
+            "r", encoding="utf-8"
+        ) as state:
+            return Metrics(**json.load(state))
+
+    except (OSError, TypeError, json.decoder.JSONDecodeError):
+        return Metrics()
+
+
+def replace_file(path: Path, text: str) -> None:
+    "Write `text` to `path` through a rename, so it is never half written."
+
+    # Not `.prom`, which the textfile collector would read.
+    temporary = ensure_dir(path.parent) / f".{path.name}.{os.getpid()}.tmp"
+    temporary.write_text(text, encoding="utf-8")
+    os.replace(temporary, path)
+
+
+def save_metrics(paths: Paths, metrics_file: Path, metrics: Metrics) -> None:
+    "Add `metrics` to those of earlier runs and write them to `metrics_file`."
+
+    with lock(paths, STATE):
+        total = read_metrics(paths)
+        total.merge(metrics)
+        replace_file(
+            paths.cache / "metrics.json",
+            json.dumps(
+                {
+                    "counters": total.counters,
+                    "histograms": total.histograms,
+                    "gauges": total.gauges,
+                }
+            ),
+        )
+        replace_file(metrics_file, format_metrics(total))
+
+
+@contextmanager
+def session(paths: Paths) -> Iterator[None]:
+    """
+    Collect metrics from the events of the enclosed command and write them
+    once it finishes, if `metrics_file` is set.
+    """
+
+    metrics_file = load_config(paths).metrics_file
+
+    if not metrics_file:
+        yield
+        return
+
+    collector = Collector()
+
+    try:
+        with events.listen(collector):
+            yield
+
+    finally:
+        try:
+            save_metrics(
+                paths, Path(metrics_file).expanduser(), collector.metrics
+            )
+
+        except OSError as exception:
+            log.warn(
+                "Failed to write metrics to",
+                metrics_file + ":",
+                str(exception),
+            )
@@ -0,0 +1,193 @@
+"""
+Mirrors for package sources, the metadata repository and raw metadata.
+
+Mirrors are listed in `config.json`. When there is more than one, they
+are probed concurrently and ranked by latency, and the ranking is cached
+in the Avalon cache for `mirror_ttl` seconds. Mirrors that fail while in
+use are demoted to the end of the cached ranking.
+"""
+
+import os
+import socket
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Literal
+from urllib.parse import urlsplit
+
+from apm import events, log
+from apm.config import load_config
+from apm.files import read_json_cache, write_json_cache
+from apm.http import get_session
+from apm.locks import STATE, lock
+from apm.network import get_host, is_available
+from apm.path import Paths
+
+# Overridable so that apm can be pointed at local fixtures or a mirror.
+GIT_URL = os.environ.get("AVALON_GIT_URL", "https://github.com").rstrip("/")
+RAW_URL = os.environ.get(
+    "AVALON_RAW_URL", "https://raw.githubusercontent.com"
+).rstrip("/")
+
+MirrorKind = Literal["source", "metadata", "raw"]
+
+DEFAULT_MIRRORS: dict[MirrorKind, list[str]] = {
+    "source": [GIT_URL],
+    "metadata": [GIT_URL],
+    "raw": [RAW_URL],
+}
+
+
+def get_configured_mirrors(paths: Paths, kind: MirrorKind) -> list[str]:
+    "The mirrors for `kind` in the order they were configured."
+
+    configured = load_config(paths).mirrors.get(kind)
+
+    if not configured:
+        return DEFAULT_MIRRORS[kind]
+
+    return [mirror.rstrip("/") for mirror in configured]
+
+
+def probe_mirror(mirror: str, timeout: float) -> float | None:
+    "Return how long `mirror` took to respond, or None if it is unhealthy."
+
+    import requests  # pylint: disable=import-outside-toplevel
+
+    url = urlsplit(mirror)
+    start = time.perf_counter()
+
+    try:
+        if url.scheme == "file":
+            if not Path(url.path).exists():
+                return None
+
+        elif url.scheme in ("http", "https"):
+            if get_session().head(mirror, timeout=timeout).status_code >= 500:
+                return None
+
+        else:
+            port = url.port or {"ssh": 22, "git": 9418}.get(url.scheme, 22)
+
+            with socket.create_connection(
+                (url.hostname, port), timeout=timeout
+            ):
+                pass
+
+    except (OSError, requests.RequestException) as exception:
+        log.debug("Mirror", mirror, "is unhealthy:", str(exception))
+        return None
+
+    return time.perf_counter() - start
+
+
+def rank_mirrors(mirrors: list[str], timeout: float) -> list[str]:
+    """
+    Order `mirrors` by latency. Unhealthy mirrors are kept, in their
+    configured order, as a last resort.
+    """
+
+    with ThreadPoolExecutor(max_workers=len(mirrors)) as executor:
+        latencies = list(
+            executor.map(lambda mirror: probe_mirror(mirror, timeout), mirrors)
+        )
+
+    for mirror, latency in zip(mirrors, latencies):
+        log.debug("Mirror", mirror, "latency:", str(latency))
+
+    healthy = sorted(
+        (latency, index)
+        for index, latency in enumerate(latencies)
+        if latency is not None
+    )
+    unhealthy = [
+        index for index, latency in enumerate(latencies) if latency is None
+    ]
+
+    return [mirrors[index] for _, index in healthy] + [
+        mirrors[index] for index in unhealthy
+    ]
+
+
+def _read_ranking_cache(paths: Paths) -> dict[str, dict[str, object]]:
+    return read_json_cache(paths.cache / "mirrors.json")
+
+
+def _write_ranking_cache(
+    paths: Paths, cache: dict[str, dict[str, object]]
+) -> None:
+    write_json_cache(paths.cache / "mirrors.json", cache)
+
+
+def get_ranked_mirrors(paths: Paths, kind: MirrorKind) -> list[str]:
+    "The mirrors for `kind`, fastest first."
+
+    mirrors = get_configured_mirrors(paths, kind)
+
+    if len(mirrors) == 1:
+        return mirrors
+
+    config = load_config(paths)
+    cache = _read_ranking_cache(paths)
+    entry = cache.get(kind, {})
+    age = time.time() - float(entry.get("time", 0))  # type: ignore
+    hit = entry.get("configured") == mirrors and age < config.mirror_ttl
+    events.emit("cache", cache="mirrors", kind=kind, hit=hit)
+
+    if hit:
+        return list(entry["ranked"])  # type: ignore
+
+    ranked = rank_mirrors(mirrors, config.mirror_probe_timeout)
+
+    with lock(paths, STATE):
+        cache = _read_ranking_cache(paths)
+        cache[kind] = {
+            "configured": mirrors,
+            "ranked": ranked,
+            "time": time.time(),
+        }
+        _write_ranking_cache(paths, cache)
+
+    return ranked
+
+
+def demote_mirror(paths: Paths, kind: MirrorKind, mirror: str) -> None:
+    "Move `mirror` to the end of the cached ranking after it failed."
+
+    with lock(paths, STATE):
+        cache = _read_ranking_cache(paths)
+        entry = cache.get(kind)
+
+        if not entry or mirror not in entry.get("ranked", []):  # type: ignore
+            return
+
+        ranked: list[str] = list(entry["ranked"])  # type: ignore
+        ranked.remove(mirror)
+        ranked.append(mirror)
+        entry["ranked"] = ranked
+        _write_ranking_cache(paths, cache)
+
+
+def try_mirrors(
+    paths: Paths, kind: MirrorKind, attempt: Callable[[str], bool]
+) -> bool:
+    """
+    Call `attempt` with each mirror's base URL, fastest first, until one
+    succeeds. Mirrors whose host keeps failing are tried last. Returns
+    whether any of them did.
+    """
+
+    mirrors = sorted(
+        get_ranked_mirrors(paths, kind),
+        key=lambda mirror: not is_available(get_host(mirror)),
+    )
+
+    for mirror in mirrors:
+        if attempt(mirror):
+            return True
+
+        log.debug("Mirror", mirror, "failed, trying the next one.")
+        demote_mirror(paths, kind, mirror)
+
+    return False
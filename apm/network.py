@@ -0,0 +1,276 @@
+"""
+One policy for apm's network calls.
+
+Each attempt has a timeout (`network_timeout`), and a command can have
+an overall deadline (`network_deadline`) that cuts attempts short and
+stops retries. Failed attempts are retried after a jittered, exponential
+backoff. Each host has a circuit breaker: after `BREAKER_THRESHOLD`
+failures in a row it is skipped for `BREAKER_COOLDOWN` seconds, then a
+single attempt is let through while other callers keep skipping it.
+
+git gets low-speed limits, so that a stalled clone fails instead of
+hanging, and never prompts for credentials.
+"""
+
+import os
+import random
+import threading
+import time
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+from urllib.parse import urlsplit
+
+from apm import events, log
+from apm.config import load_config
+from apm.http import get_session
+from apm.path import Paths
+
+if TYPE_CHECKING:
+    import requests
+
+# Failures in a row before a host is skipped.
+BREAKER_THRESHOLD = 3
+# Seconds that a host is skipped for.
+BREAKER_COOLDOWN = 60.0
+# Seconds before the first retry, and at most between retries.
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+# Parts of git's error messages about failures worth retrying.
+TRANSIENT_GIT_ERRORS = (
+    "could not resolve host",
+    "failed to connect",
+    "couldn't connect",
+    "timed out",
+    "operation too slow",
+    "connection reset",
+    "connection refused",
+    "early eof",
+    "rpc failed",
+    "the remote end hung up unexpectedly",
+    "unexpected disconnect",
+    "returned error: 429",
+    "returned error: 5",
+)
+
+
+@dataclass
+class Breaker:
+    "A host's recent failures."
+
+    failures: int = 0
+    opened: float | None = None
+    # When the one attempt allowed after the cooldown started.
+    probing: float | None = None
+
+
+_breakers: dict[str, Breaker] = {}
+_breakers_lock = threading.Lock()
+# When the current command's network deadline passes, from `time.monotonic`.
+_deadline: float | None = None
+
+
+def start_command(paths: Paths) -> None:
+    "Start the deadline of a command, and set git's limits for it."
+
+    global _deadline  # pylint: disable=global-statement
+
+    config = load_config(paths)
+    _deadline = (
+        time.monotonic() + config.network_deadline
+        if config.network_deadline > 0
+        else None
+    )
+
+    # Set by the user, they win.
+    os.environ.setdefault(
+        "GIT_HTTP_LOW_SPEED_LIMIT", str(config.git_low_speed_limit)
+    )
+    os.environ.setdefault(
+        "GIT_HTTP_LOW_SPEED_TIME", str(config.git_low_speed_time)
+    )
+    os.environ.setdefault("GIT_TERMINAL_PROMPT", "0")
+
+
+def get_remaining() -> float | None:
+    "Seconds left until the deadline, or None if there is none."
+
+    if _deadline is None:
+        return None
+
+    return max(_deadline - time.monotonic(), 0.0)
+
+
+def get_attempt_timeout(paths: Paths) -> float:
+    "The timeout of one attempt, cut short by the deadline."
+
+    timeout = load_config(paths).network_timeout
+    remaining = get_remaining()
+
+    return timeout if remaining is None else min(timeout, remaining)
+
+
+def get_host(url: str) -> str:
+    "The host of a URL, or of an scp-like git address (`git@host:path`)."
+
+    if "://" in url:
+        return urlsplit(url).netloc.rpartition("@")[2]
+
+    return url.partition(":")[0].rpartition("@")[2]
+
+
+def _is_available(breaker: Breaker | None, now: float) -> bool:
+    if breaker is None or breaker.opened is None:
+        return True
+
+    if now - breaker.opened < BREAKER_COOLDOWN:
+        return False
+
+    # After the cooldown, one attempt at a time, unless it never finished.
+    return breaker.probing is None or now - breaker.probing >= BREAKER_COOLDOWN
+
+
+def is_available(host: str) -> bool:
+    "Whether `host` may be tried, i.e. its circuit is not open."
+
+    with _breakers_lock:
+        return _is_available(_breakers.get(host), time.monotonic())
+
+
+def start_attempt(host: str) -> bool:
+    """
+    Whether an attempt on `host` may start. After the cooldown, only one
+    is let through until `record_success` or `record_failure`.
+    """
+
+    now = time.monotonic()
+
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+
+        if not _is_available(breaker, now):
+            return False
+
+        if breaker is not None and breaker.opened is not None:
+            breaker.probing = now
+
+        return True
+
+
+def record_success(host: str) -> None:
+    "Close `host`'s circuit."
+
+    with _breakers_lock:
+        _breakers.pop(host, None)
+
+
+def record_failure(host: str) -> None:
+    "Count a failure of `host`, opening its circuit after too many."
+
+    with _breakers_lock:
+        breaker = _breakers.setdefault(host, Breaker())
+        breaker.failures += 1
+        breaker.probing = None
+
+        if breaker.failures < BREAKER_THRESHOLD:
+            return
+
+        breaker.opened = time.monotonic()
+        failures = breaker.failures
+
+    log.debug(f"{host} failed {failures} times in a row, skipping it.")
+    events.emit("circuit_open", host=host, failures=failures)
+
+
+def get_backoff(attempt: int) -> float:
+    "Seconds to wait before retry number `attempt` (from 0), with jitter."
+
+    delay = min(BACKOFF_CAP, BACKOFF_BASE * 2.0**attempt)
+
+    return delay * random.uniform(0.5, 1.0)  # nosec B311
+
+
+def wait_before_retry(host: str, attempt: int) -> bool:
+    """
+    Wait before retrying, unless `host` is skipped or the wait would run
+    past the deadline. Returns whether to retry.
+    """
+
+    delay = get_backoff(attempt)
+    remaining = get_remaining()
+
+    if not is_available(host) or (
+        remaining is not None and remaining <= delay
+    ):
+        return False
+
+    log.debug(f"Retrying {host} in {delay:.1f} seconds.")
+    events.emit("retry", host=host, attempt=attempt + 1, delay=round(delay, 3))
+    time.sleep(delay)
+
+    return True
+
+
+def is_transient_git_error(messages: list[str]) -> bool:
+    "Whether git's error `messages` describe a failure worth retrying."
+
+    text = "\n".join(messages).lower()
+
+    return any(error in text for error in TRANSIENT_GIT_ERRORS)
+
+
+def request(
+    paths: Paths, method: str, url: str, **kwargs: Any
+) -> "requests.Response":
+    """
+    Send an HTTP request with the shared session, retrying connection
+    errors, timeouts, 429s and 5xx responses.
+
+    Raises `requests.ConnectionError` if the host is skipped, and
+    `requests.Timeout` if the deadline has passed. After the last retry,
+    an error response is returned.
+    """
+
+    import requests  # pylint: disable=import-outside-toplevel
+
+    host = get_host(url)
+    retries = max(load_config(paths).network_retries, 0)
+    attempt = 0
+
+    while True:
+        if not start_attempt(host):
+            raise requests.ConnectionError(
+                f"Skipping {host} after repeated failures."
+            )
+
+        timeout = get_attempt_timeout(paths)
+
+        if timeout <= 0:
+            raise requests.Timeout(
+                f"The network deadline passed before {url}."
+            )
+
+        try:
+            response = get_session().request(
+                method, url, timeout=timeout, **kwargs
+            )
+
+        except requests.RequestException:
+            record_failure(host)
+
+            if attempt >= retries or not wait_before_retry(host, attempt):
+                raise
+
+        else:
+            if response.status_code != 429 and response.status_code < 500:
+                record_success(host)
+                return response
+
+            record_failure(host)
+
+            if attempt >= retries or not wait_before_retry(host, attempt):
+                return response
+
+            response.close()
+
+        attempt += 1
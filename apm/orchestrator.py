@@ -0,0 +1,241 @@
+"""
+Installs a package's missing Avalon dependencies as a pipeline of asyncio
+tasks.
+
+Each dependency is downloaded, then built once the dependencies it needs
+are installed, so later packages download while earlier ones compile.
+Downloads run `download_jobs` at a time and builds `build_jobs` at a
+time, and apt and pip (which lock the system) install for one package at
+a time.
+"""
+
+import asyncio
+import threading
+
+from concurrent.futures import Future
+from pathlib import Path
+
+import kazparse.flags
+
+from apm import log, timings
+from apm.config import load_config
+from apm.locks import package_lock
+from apm.log import fatal_error
+from apm.path import Paths
+from .metadata import get_local_package_metadata, get_package_metadata
+from .build import compile_package, remove_renamed_binary
+from .prebuilt import start_prebuilt_download
+from .requirements import check_for_satisfied_package_requirements
+from .resolver import Candidate, get_requirements, get_resolved_candidate
+from .sources import fetch_package
+from .system_dependencies import install_system_dependencies
+
+
+class Orchestrator:  # pylint: disable=too-many-instance-attributes
+    "Installs dependencies concurrently, each after its own dependencies."
+
+    def __init__(
+        self, flags: kazparse.flags.Flags, paths: Paths, package_name: str
+    ) -> None:
+        config = load_config(paths)
+        self.flags = flags
+        self.paths = paths
+        self.downloads = asyncio.Semaphore(max(config.download_jobs, 1))
+        self.builds = asyncio.Semaphore(max(config.build_jobs, 1))
+        self.system = asyncio.Lock()
+        self.tasks: dict[str, asyncio.Task[None]] = {}
+        # What each package waits for, to catch dependency cycles.
+        self.requires: dict[str, set[str]] = {package_name: set()}
+        # Threads holding package locks, and what tells them to release.
+        self.holders: list[tuple[threading.Thread, Future[None]]] = []
+        self.release = threading.Event()
+
+    def depends_on(self, name: str, other: str) -> bool:
+        "Whether `name` waits for `other`, directly or not."
+
+        pending = [name]
+        seen = set()
+
+        while pending:
+            current = pending.pop()
+
+            if current == other:
+                return True
+
+            if current not in seen:
+                seen.add(current)
+                pending += self.requires.get(current, ())
+
+        return False
+
+    def schedule(
+        self, required_by: str, name: str
+    ) -> "asyncio.Task[None] | None":
+        """
+        Start installing `name` for `required_by`, unless it is installed
+        or already being installed.
+        """
+
+        if self.depends_on(name, required_by):
+            fatal_error(f"{required_by} and {name} depend on each other.")
+
+        self.requires.setdefault(required_by, set()).add(name)
+
+        if name in self.tasks:
+            return self.tasks[name]
+
+        candidate = get_resolved_candidate(name)
+
+        if candidate is None:
+            fatal_error("No version of", name, "was resolved.")
+
+        if candidate.installed:
+            return None
+
+        self.tasks[name] = asyncio.create_task(self.install(candidate))
+
+        return self.tasks[name]
+
+    async def lock(self, name: str) -> None:
+        """
+        Take a package's lock until `close`, in a thread of its own, so that
+        waiting for another apm does not hold up the event loop.
+        """
+
+        locked: Future[None] = Future()
+
+        def hold() -> None:
+            try:
+                with package_lock(self.paths, name):
+                    locked.set_result(None)
+                    self.release.wait()
+
+            # pylint: disable-next=broad-exception-caught
+            except BaseException as exception:
+                if not locked.done():
+                    locked.set_exception(exception)
+
+        holder = threading.Thread(target=hold, daemon=True)
+        holder.start()
+        self.holders.append((holder, locked))
+        await asyncio.wrap_future(locked)
+
+    def close(self) -> None:
+        "Release the package locks."
+
+        self.release.set()
+
+        # Not those still waiting for another apm, e.g. after an error.
+        for holder, locked in self.holders:
+            if locked.done():
+                holder.join()
+
+    async def wait_for(self, required_by: str, names: list[str]) -> None:
+        "Install `names` for `required_by` and wait until they are installed."
+
+        tasks = [self.schedule(required_by, name) for name in names]
+        await asyncio.gather(*[task for task in tasks if task is not None])
+
+    def fetch(self, candidate: Candidate) -> None:
+        "Download the candidate's source."
+
+        commit = None if candidate.ref else candidate.commit
+        package = get_package_metadata(
+            self.paths, candidate.name, commit=commit, branch=candidate.ref
+        )
+        fetch_package(
+            self.paths,
+            candidate.name,
+            package,
+            branch=candidate.ref,
+            commit=commit,
+        )
+
+    def build(
+        self, package_name: str, prebuilt: Future[Path | None] | None
+    ) -> None:
+        "Compile and install a package whose dependencies are installed."
+
+        with timings.phase("compile", package=package_name):
+            compile_package(package_name, self.paths, self.flags, prebuilt)
+
+    async def install(self, candidate: Candidate) -> None:
+        "Download, then build and install, a dependency."
+
+        name = candidate.name
+        await self.lock(name)
+        old = get_local_package_metadata(self.paths, name)
+
+        async with self.downloads:
+            log.note("Downloading", str(candidate))
+            await asyncio.to_thread(self.fetch, candidate)
+
+        package = get_package_metadata(self.paths, name)
+        await self.wait_for(
+            name,
+            [
+                requirement.name
+                for requirement in get_requirements(package, name)
+            ],
+        )
+
+        (
+            satisfied,
+            constraint,
+            unsupported,
+        ) = check_for_satisfied_package_requirements(
+            self.paths, name, self.flags.force
+        )
+
+        if not satisfied:
+            fatal_error(
+                f'{constraint} "{unsupported}" is not supported by {name}.'
+            )
+
+        prebuilt = None
+
+        if not self.flags.noinstall:
+            prebuilt = start_prebuilt_download(self.paths, name, package)
+
+        async with self.system:
+            await asyncio.to_thread(
+                install_system_dependencies, self.paths, name, package
+            )
+
+        if self.flags.noinstall:
+            return
+
+        async with self.builds:
+            log.note("Building", str(candidate))
+            await asyncio.to_thread(self.build, name, prebuilt)
+
+        if old is not None:
+            remove_renamed_binary(self.paths, name, old)
+
+        log.note("Installed", str(candidate))
+
+    async def run(self, package_name: str, names: list[str]) -> None:
+        "Install `names`, the dependencies of `package_name`."
+
+        await self.wait_for(package_name, names)
+
+
+def install_dependencies(
+    flags: kazparse.flags.Flags,
+    paths: Paths,
+    package_name: str,
+    names: list[str],
+) -> None:
+    """
+    Install the versions resolved for `names`, the Avalon dependencies of
+    `package_name`, and everything they depend on.
+    """
+
+    orchestrator = Orchestrator(flags, paths, package_name)
+
+    try:
+        asyncio.run(orchestrator.run(package_name, names))
+
+    finally:
+        # Only once every dependency is done, as the others may need them.
+        orchestrator.close()
@@ -2,7 +2,10 @@
 Contains NPackage.
 """
 
+import re
+
 from dataclasses import dataclass
+from typing import Any
 
 
 @dataclass
@@ -10,6 +13,7 @@ class Package:
     author: str | None = None
     repo: str | None = None
     version: str | None = None
+    description: str | None = None
     binname: str | None = None
     binfile: str | None = None
 
@@ -22,6 +26,60 @@ class Package:
     uninstallScript: str | None = None
 
     toCopy: list[str] | None = None
+    sparseCheckout: bool | None = None  # pylint: disable=invalid-name
+    sparsePaths: list[str] | None = None  # pylint: disable=invalid-name
 
     needsCompiled: bool | None = None
     mvBinAfterInstallScript: bool | None = None
+
+    prebuilt: list[dict[str, Any]] | None = None
+
+
+def parse_package_spec(spec: str) -> tuple[str, str | None, str | None]:
+    """
+    Splits `user/repo[/branch][:commit]` into the package name, branch and
+    commit.
+    """
+
+    commit = None
+
+    if ":" in spec:
+        spec, commit = spec.rsplit(":", 1)
+
+    parts = spec.split("/")
+
+    return "/".join(parts[:2]), "/".join(parts[2:]) or None, commit
+
+
+# Where the version constraint in a dependency starts.
+CONSTRAINT_START = re.compile(r"\s*[<>=!^~]")
+
+
+@dataclass(frozen=True)
+class Requirement:
+    "An entry of `deps.avalon`: a package, maybe pinned or constrained."
+
+    name: str
+    branch: str | None = None
+    commit: str | None = None
+    constraint: str | None = None
+    required_by: str | None = None
+
+
+def parse_requirement(
+    spec: str, required_by: str | None = None
+) -> Requirement:
+    """
+    Parses `user/repo[/branch][:commit][constraint]`, where `constraint`
+    is comma-separated semver comparisons like `>=1.2.0,<2.0.0`, `^1.2` or
+    `~1.2.3`.
+    """
+
+    constraint = None
+
+    if match := CONSTRAINT_START.search(spec):
+        spec, constraint = spec[: match.start()], spec[match.start() :].strip()
+
+    name, branch, commit = parse_package_spec(spec.strip())
+
+    return Requirement(name, branch, commit, constraint, required_by)
@@ -0,0 +1,106 @@
+"""
+Packing and unpacking of `.apm` archives.
+"""
+
+import json
+
+from pathlib import Path
+
+import kazparse.flags
+
+from apm import log
+from apm.log import fatal_error
+from .archive import Archive, ArchiveError, pack
+from .package import Package
+from .path import Paths
+from .requirements import check_package_requirements
+
+
+def read_package_file(package_file_path: Path) -> Package:
+    """Reads a `.avalon/package` file, checking that it names the package."""
+
+    if not package_file_path.exists():
+        fatal_error(f"{package_file_path} does not exist")
+
+    with package_file_path.open("r", encoding="utf-8") as package_file:
+        package = Package(**json.load(package_file))
+
+    if not package.author:
+        fatal_error("Package's metadata must contain `author`.")
+
+    if not package.repo:
+        fatal_error("Package's metadata must contain `repo`.")
+
+    return package
+
+
+def unpack_archive(
+    flags: kazparse.flags.Flags, archive_path: Path, staging: Path
+) -> Package:
+    """
+    Checks the requirements of the package in an `.apm` archive, using
+    only its `.avalon/package`, then extracts it into `staging`.
+    """
+
+    try:
+        with Archive(archive_path) as archive:
+            package = Package(**json.loads(archive.read(".avalon/package")))
+
+            satisfied, constraint, unsupported = check_package_requirements(
+                package, flags.force
+            )
+
+            if not satisfied:
+                fatal_error(
+                    f'{constraint} "{unsupported}" is not supported by {archive_path}.'
+                )
+
+            archive.extract(staging)
+
+    except KeyError:
+        fatal_error(f"{archive_path} does not contain `.avalon/package`")
+
+    except ArchiveError as exception:
+        fatal_error(str(exception))
+
+    return package
+
+
+def pack_package(
+    _flags: kazparse.flags.Flags, _paths: Paths, *args: str
+) -> None:
+    "Pack a package directory into an `.apm` archive"
+
+    package_dir = Path(args[0] if args else ".")
+    package = read_package_file(package_dir / ".avalon/package")
+    archive_path = Path(args[1] if len(args) > 1 else f"{package.repo}.apm")
+
+    log.note("Packing", package_dir, "into", archive_path)
+    pack(package_dir, archive_path)
+    log.success("Done!")
+
+
+def unpack_package(
+    _flags: kazparse.flags.Flags, _paths: Paths, *args: str
+) -> None:
+    "Unpack an `.apm` archive into a directory"
+
+    if not args:
+        fatal_error("Usage: apm unpack <archive> [directory]")
+
+    archive_path = Path(args[0])
+    out_dir = Path(args[1] if len(args) > 1 else archive_path.stem)
+
+    if out_dir.exists() and any(out_dir.iterdir()):
+        fatal_error(f"{out_dir} is not empty")
+
+    log.note("Unpacking", archive_path, "into", out_dir)
+
+    try:
+        with Archive(archive_path) as archive:
+            archive.extract(out_dir)
+
+    except ArchiveError as exception:
+        fatal_error(str(exception))
+
+    log.success("Done!")
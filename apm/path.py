@@ -2,8 +2,10 @@
 XDG-relative paths for various purposes.
 """
 
+import atexit
 import os
-from dataclasses import dataclass, fields
+
+from dataclasses import dataclass
 from pathlib import Path
 
 # https://specifications.freedesktop.org/basedir-spec/basedir-spec-latest#variables
@@ -24,16 +26,64 @@ avalon_cache = xdg_cache_dir / "avalonpm"
 
 
 @dataclass
-class Paths:
+class Paths:  # pylint: disable=too-many-instance-attributes
     root: Path = avalon_root
+    cache: Path = avalon_cache
     source: Path = avalon_cache / "src"
     binaries: Path = Path(os.environ.get("AVALON_BIN", avalon_root / "bin"))
     metadata: Path = avalon_cache / "cache"
     files: Path = avalon_root / "files"
+    # Content-addressed store for `dedupe`, on the same filesystem as `files`.
+    blobs: Path = avalon_root / "files" / ".blobs"
     temp: Path = temp_dir / "avalonpm"
 
 
 paths = Paths()
 
-for field in fields(paths):
-    getattr(paths, field.name).mkdir(parents=True, exist_ok=True)
+
+def ensure_dir(directory: Path) -> Path:
+    """
+    Create `directory` if it does not exist yet, and return it.
+
+    Directories are only created right before something is written to
+    them, so that read-only commands do not touch the filesystem.
+    """
+
+    directory.mkdir(parents=True, exist_ok=True)
+
+    return directory
+
+
+_run_temps: dict[Path, Path] = {}
+
+
+# pylint: disable-next=redefined-outer-name
+def get_run_temp(paths: Paths) -> Path:
+    """
+    A directory in `paths.temp` that only this run of `apm` uses, so that
+    concurrent runs never clean up each other's files. It is deleted when
+    `apm` exits.
+    """
+
+    import tempfile  # pylint: disable=import-outside-toplevel
+
+    if paths.temp not in _run_temps:
+        prefix = f"run-{os.getpid()}-"
+        run_temp = Path(
+            tempfile.mkdtemp(prefix=prefix, dir=ensure_dir(paths.temp))
+        )
+        _run_temps[paths.temp] = run_temp
+
+    return _run_temps[paths.temp]
+
+
+@atexit.register
+def remove_run_temps() -> None:
+    "Delete the directories of this run from `get_run_temp`."
+
+    import shutil  # pylint: disable=import-outside-toplevel
+
+    for run_temp in _run_temps.values():
+        shutil.rmtree(run_temp, ignore_errors=True)
+
+    _run_temps.clear()
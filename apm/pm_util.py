@@ -1,85 +1,56 @@
 """
 Main utilities for the package manager.
-
-TODO: separate into smaller files
 """
 
 import os
 import shutil
-import json
-import getpass
-import filecmp
-import subprocess  # nosec B404
+import tarfile
+import tempfile
 
+from contextlib import ExitStack
 from pathlib import Path
 
 import kazparse
 import kazparse.flags
 
-from apm import log
+from apm import log, timings
 from apm.log import fatal_error
-from .path import Paths
-from .package import Package
+from .archive import is_archive
+from .build import (
+    compile_package,
+    relink_package_binary,
+    remove_package_binary_symlink,
+    remove_renamed_binary,
+    run_script,
+)
+from .locks import package_lock
+from .files import extract_tarball, sync_directory
+from .generations import get_built_commit, remove_generations
+from .path import Paths, ensure_dir
+from .package import Package, parse_package_spec, parse_requirement
+from .packing import read_package_file, unpack_archive
 from .metadata import (
+    get_metadata_repository,
     is_in_metadata_repository,
     get_package_metadata,
     download_metadata_repository,
     is_avalon_package,
     move_metadata_to_dot_avalon_folder,
 )
-from .requirements import check_for_satisfied_package_requirements
-
-
-def copy_file(src: Path, dst: Path) -> None:
-    """Copy a file only if files are not the same or the destination does not exist"""
-    if not os.path.dirname(dst).strip() == "":
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-
-    if os.path.isfile(src):
-        if not os.path.exists(dst) or not filecmp.cmp(src, dst):
-            shutil.copy2(src, dst)
-    else:
-        if os.path.exists(src):
-            for file in os.listdir(src):
-                copy_file(src / file, dst / file)
-
-
-def download_package(
-    paths: Paths,
-    package_url: str,
-    package_name: str | None = None,
-    branch: str | None = None,
-    commit: str | None = None,
-) -> None:
-    """Downloads a specfic commit and branch of a package."""
-
-    if not package_name:
-        package_name = package_url.lstrip("https://github.com/")
-
-    log.debug(package_name)
-    os.chdir(paths.source)
-
-    if commit and branch:
-        os.system("git clone " + package_url + " " + package_name + " -q")
-        os.system(f"cd {package_name}; git reset --hard {commit}")
-
-    elif branch:
-        package_name = "/".join(package_name.split(":")[:-1])
-        os.system(
-            "git clone --depth 1 "
-            + package_url
-            + " "
-            + package_name
-            + " -q -b "
-            + branch
-        )
-
-    elif commit:
-        os.system("git clone " + package_url + " " + package_name + " -q")
-        os.system(f"cd {package_name}; git reset --hard {commit}")
-
-    else:
-        os.system("git clone --depth 1 " + package_url + " " + package_name + " -q")
+from .mirrors import try_mirrors
+from .prebuilt import start_prebuilt_download
+from .resolver import Candidate, resolve_dependencies
+from .sources import (
+    fetch_package,
+    get_sync_path,
+    pull_package,
+    remove_package_source,
+)
+from .system_dependencies import install_system_dependencies, system
+from .requirements import (
+    check_dependency_graph_requirements,
+    check_for_satisfied_package_requirements,
+)
 
 
 def delete_package(
@@ -99,161 +70,35 @@ def delete_package(
         )
 
     else:
-        remove_package_binary_symlink(paths, package_name, branch=branch, commit=commit)
+        remove_package_binary_symlink(
+            paths, package_name, branch=branch, commit=commit
+        )
 
     remove_package_files(paths, package_name)
 
 
-def remove_package_source(paths: Paths, package_name: str) -> None:
-    """Deletes the source code of a package."""
-
-    if (paths.source / package_name).exists():
-        shutil.rmtree(paths.source / package_name, ignore_errors=True)
-
-
-def remove_package_binary_symlink(
-    paths: Paths,
-    package_name: str,
-    package: Package | None = None,
-    commit: str | None = None,
-    branch: str | None = None,
-) -> None:
-    """Deletes the symlink for a package."""
-
-    log.debug("Removing symlink for:", package_name)
-
-    if package is None:
-        package = get_package_metadata(paths, package_name, commit, branch)
-
-    if package.binname:
-        package_bin_dir = paths.binaries / package.binname
-
-        if package_bin_dir.exists():
-            log.debug("Deleting", package_bin_dir)
-            os.remove(package_bin_dir)
-
-
-def remove_package_files(paths: Paths, package_name: str) -> None:
-    """Remove's a package's installed files."""
-
-    if (package_files_dir := paths.files / package_name).exists():
-        shutil.rmtree(package_files_dir, ignore_errors=True)
-
-
-def symlink_binary_for_package(
-    paths: Paths, package_name: str, bin_file: str, bin_name: Path
-) -> None:
-    """Symlinks a binary for the package."""
+def get_installed_directory(paths: Paths, package_name: str) -> Path | None:
+    "The directory a package was installed from, if it was."
 
     try:
-        shutil.copyfile(
-            paths.source / package_name / bin_file,
-            paths.files / package_name / bin_name,
-        )
-
-    except shutil.Error:
-        log.warn(f"Failed to copy binary to {paths.files}")
-
-    if (paths.binaries / bin_name).exists():
-        os.remove(paths.binaries / bin_name)
-
-    os.symlink(paths.files / package_name / bin_file, paths.binaries / bin_name)
-
-    (paths.files / package_name / bin_name).chmod(0o755)
-
-
-def copy_package_files_to_files_dir(
-    paths: Paths, package_name: str, files: list[str] | None = None
-) -> None:
-    """Copies a package's files from its source directory to its files directory."""
-
-    if files in (["all"], None):
-        files = os.listdir(paths.source / package_name)
-
-    log.debug("Copying files", str(files), "from src to files for", package_name)
-
-    for file in files:
-        copy_file(
-            paths.source / package_name / file,
-            paths.files / package_name / file,
-        )
-
-
-def get_installed_apt_packages() -> list[str]:
-    """Returns a list of the installed apt packages"""
-
-    aptinstalled = []
-
-    dpkg_output = subprocess.check_output("dpkg -l".split()).decode()  # nosec B603
-
-    for i in dpkg_output.split("\n"):
-        if i.strip() != "" and i.startswith("ii"):
-            try:
-                i = i.split("  ")[1]
-
-                if i.strip() not in aptinstalled:
-                    aptinstalled.append(i.strip())
-
-            except IndexError:
-                fatal_error(i)
-
-    return aptinstalled
-
-
-def apt_filter_uninstalled(deps: list[str]) -> list[str]:
-    """Filter out installed packages"""
-    aptinstalled = get_installed_apt_packages()
-
-    return list(filter(lambda dep: dep not in aptinstalled, deps))
-
-
-def am_not_root() -> bool:
-    """Returns whether the user needs to use `sudo`."""
-
-    username = getpass.getuser()
-
-    return username != "root" and not username.startswith("u0_a")
-
-
-def install_apt_dependencies(deps: dict[str, list[str]]) -> None:
-    """Installs a package's apt dependencies."""
-
-    if "apt" not in deps:
-        return
-
-    if deps["apt"] is None:
-        return
-
-    filtered_deps = apt_filter_uninstalled(deps["apt"])
-
-    if len(filtered_deps) > 0:
-        log.note(
-            "Found apt dependencies, installing..... (this will require your password)"
+        return Path(
+            get_sync_path(paths, package_name, ".origin").read_text(
+                encoding="utf-8"
+            )
         )
 
-        joined_deps = " ".join(filtered_deps)
-        sudo = "sudo " if am_not_root() else ""
+    except FileNotFoundError:
+        return None
 
-        if os.system(log.debug(f"{sudo}apt install -y {joined_deps}")):
-            fatal_error("apt subprocess encountered an error.")
 
+def remove_package_files(paths: Paths, package_name: str) -> None:
+    """Remove's a package's installed files."""
 
-def install_apt_build_dep_dependencies(deps: dict[str, list[str]]) -> None:
-    """Install's a packages `apt build-dep` dependencies."""
-
-    if "build-dep" not in deps:
-        return
-
-    if deps["build-dep"]:
-        log.note(
-            "Found build-dep (apt) dependencies, installing..... (this will require your password)"
-        )
-
-        joined_deps = " ".join(deps["build-dep"])
-        sudo = "sudo " if am_not_root() else ""
+    if (package_files_dir := paths.files / package_name).is_symlink():
+        remove_generations(paths, package_name)
 
-        if os.system(log.debug(f"{sudo}apt build-dep -y {joined_deps}")):
-            fatal_error("apt subprocess encountered an error.")
+    elif package_files_dir.exists():
+        shutil.rmtree(package_files_dir, ignore_errors=True)
 
 
 def install_avalon_dependencies(
@@ -262,7 +107,14 @@ def install_avalon_dependencies(
     args: list[str],
     deps: dict[str, list[str]],
 ) -> None:
-    """Installs a package's Avalon dependencies."""
+    """
+    Installs the versions resolved for a package's Avalon dependencies,
+    downloading some while others compile.
+    """
+
+    from .orchestrator import (  # pylint: disable=import-outside-toplevel
+        install_dependencies,
+    )
 
     if "avalon" not in deps:
         return
@@ -270,57 +122,14 @@ def install_avalon_dependencies(
     if deps["avalon"] is None:
         return
 
-    args = args.copy()
-
     log.note("Found avalon dependencies, installing.....")
 
-    for dep in deps["avalon"]:
-        if not (paths.files / dep.lower()).exists() or flags.update:
-            log.note("Installing", dep)
-            log.IS_SILENT = True
-            args[0] = dep
-            install_package(flags, paths, args)
-            log.IS_SILENT = False
-            log.note("Installed", dep)
-
-
-def install_pip_dependencies(deps: dict[str, list[str]]) -> None:
-    """Installs a package's `pip` dependencies."""
-
-    if "pip" not in deps:
-        return
-
-    if deps["pip"] is None:
-        return
-
-    log.note("Found pip dependencies, installing.....")
-    joined_deps = " ".join(deps["pip"])
-
-    on_gentoo = os.path.exists("/etc/portage")
-    user_flag = " --user" if on_gentoo else ""
-
-    os.system(log.debug(f"python3 -m pip install{user_flag} {joined_deps}"))
-
-
-def install_requirements_dot_txt(package_name: str, paths: Paths) -> None:
-    """Installs a package's pip depdencies as specified in `requirements.txt`."""
-
-    log.debug(paths.source / package_name / "requirements.txt")
-    log.debug(os.curdir)
-
-    if (paths.source / package_name / "requirements.txt").exists():
-        log.note("Requirements.txt found, installing.....")
-
-        on_gentoo = os.path.exists("/etc/portage")
-        user_flag = " --user" if on_gentoo else ""
-
-        req_txt = paths.source / package_name / "requirements.txt"
-
-        os.system(
-            log.debug(
-                f"python3 -m pip --disable-pip-version-check -q install{user_flag} -r {req_txt}"
-            )
-        )
+    install_dependencies(
+        flags,
+        paths,
+        args[0],
+        [parse_requirement(dep.lower()).name for dep in deps["avalon"]],
+    )
 
 
 def install_package_dependencies(
@@ -332,292 +141,230 @@ def install_package_dependencies(
 
     if package.deps:
         log.note("Found dependencies, installing.....")
-        dependencies = package.deps
 
-        if os.path.exists("/usr/bin/apt") and not os.path.exists(
-            "/usr/libexec/eselect-java/run-java-tool.bash"
-        ):
-            install_apt_dependencies(dependencies)
-            install_apt_build_dep_dependencies(dependencies)
+        with timings.phase("avalon"):
+            install_avalon_dependencies(flags, paths, args, package.deps)
 
-        install_avalon_dependencies(flags, paths, args, dependencies)
-        install_pip_dependencies(dependencies)
+    install_system_dependencies(paths, args[0], package)
 
-    install_requirements_dot_txt(args[0], paths)
-    # TODO: install_poetry_dependencies
 
-
-def run_script(script_file: Path, *args: str | Path) -> int:
-    """Runs a script with its specific interpreter based on the extension."""
-
-    langs = {".py": "python3", ".sh": "bash"}
-
-    if os.path.exists("/etc/portage"):
-        with open(script_file, "r", encoding="utf-8") as script:
-            contents = script.read()
-
-            with open(script_file, "w", encoding="utf-8") as script_write:
-                script_write.write(
-                    contents.replace("pip3 install", "pip3 install --user").replace(
-                        "pip install", "pip install --user"
-                    )
-                )
-
-    joined_args = " ".join([str(arg) for arg in args])
-
-    if script_file.suffix.lower() in langs:
-        return os.system(
-            log.debug(
-                f"{langs[script_file.suffix.lower()]} {script_file} {joined_args}"
-            )
-        )
-
-    return os.system(log.debug(f'{langs[".sh"]} {script_file} {joined_args}'))
-
-
-def compile_package(
-    package_name: str,
+def build_and_install_package(
+    flags: kazparse.flags.Flags,
     paths: Paths,
-    _flags: kazparse.flags.Flags,
+    args: list[str],
+    resolved: dict[str, Candidate] | None = None,
 ) -> None:
-    """Compiles a package."""
-
-    package = get_package_metadata(paths, package_name)
-    os.chdir(paths.source / package_name)
-
-    (paths.files / package_name).mkdir(parents=True, exist_ok=True)
-
-    if package.needsCompiled:
-        if not package.binname:
-            log.warn(
-                "Package needs compiled but there is no binname for Avalon to install, \
-                assuming installed by compile script....."
-            )
-
-        if package.compileScript:
-            log.note("Compile script found, compiling.....")
+    """
+    Checks requirements, installs dependencies, then compiles and installs
+    a package whose source has been downloaded. A matching prebuilt
+    artifact is downloaded while the dependencies are installed, and used
+    instead of compiling. Its dependencies are resolved unless `resolved`
+    is given.
+    """
+
+    package_name = args[0]
+
+    with timings.phase("requirements"):
+        (
+            satisfied,
+            constraint,
+            unsupported,
+        ) = check_for_satisfied_package_requirements(
+            paths, package_name, flags.force
+        )
 
-            if run_script(
-                paths.source / package_name / package.compileScript,
-                f'"{paths.source / package_name}" "{package.binname}" \
-                "{paths.files / package_name}"',
-            ):
-                fatal_error("Compile script failed!")
+    if not satisfied:
+        fatal_error(
+            f'{constraint} "{unsupported}" is not supported by {package_name}.'
+        )
 
-        else:
-            fatal_error(
-                "Program needs compiling but no compilation script found... exiting....."
+    if resolved is None:
+        with timings.phase("resolve"):
+            resolve_dependencies(
+                paths,
+                package_name,
+                get_package_metadata(paths, package_name),
+                flags.update,
             )
 
-    else:
-        log.warn("Program does not need to be compiled, moving to installation.....")
-
-    if package.binname and not package.mvBinAfterInstallScript:
-        remove_package_binary_symlink(paths, package_name)
+    prebuilt = None
 
-        symlink_binary_for_package(
-            paths,
-            package_name,
-            package.binfile or package.binname,
-            Path(package.binname),
+    if not flags.noinstall:
+        prebuilt = start_prebuilt_download(
+            paths, package_name, get_package_metadata(paths, package_name)
         )
 
-    if package.installScript:
-        log.note("Installing.....")
-
-        if (package.needsCompiled or package.compileScript) and package.binname:
-            if run_script(
-                paths.source / package_name / package.installScript,
-                f'"{paths.files / package_name / package.binname}" \
-                "{paths.files / package_name}" \
-                "{paths.binaries}" "{paths.source}"',
-            ):
-                fatal_error("Install script failed!")
-
-        else:
-            if run_script(
-                paths.source / package_name / package.installScript,
-                f'"{paths.files / package_name}" "{paths.source}" "{package_name}"',
-            ):
-                fatal_error("Install script failed!")
+    with timings.phase("dependencies", package=package_name):
+        install_package_dependencies(flags, paths, args)
 
-    if package.toCopy:
-        log.note("Copying files needed by program.....")
-        copy_package_files_to_files_dir(paths, package_name, package.toCopy)
+    if not flags.noinstall:
+        log.note("Beginning compilation/installation.....")
 
-    if package.mvBinAfterInstallScript and package.binname:
-        remove_package_binary_symlink(paths, package_name)
+        with timings.phase("compile", package=package_name):
+            compile_package(package_name, paths, flags, prebuilt)
 
-        symlink_binary_for_package(
-            paths,
-            package_name,
-            package.binfile or package.binname,
-            Path(package.binname),
-        )
+        log.success("Done!")
 
     else:
-        log.warn(
-            "No installation script found... Assuming \
-            installation beyond APM's autoinstaller isn't neccessary"
-        )
+        log.warn("--noinstall specified, skipping installation/compilation")
 
 
 def install_package_from_directory(
     flags: kazparse.flags.Flags, paths: Paths, args: list[str]
 ) -> None:
-    """Installs a package from a local directory."""
-
-    tmppath = paths.temp
-    package_dir = args[0]
+    """Installs a package from a local directory, tarball or `.apm` archive."""
 
-    shutil.rmtree(tmppath)
-
-    if not os.path.exists(tmppath):
-        os.mkdir(tmppath)
+    package_dir = Path(args[0])
 
     log.IS_DEBUG = flags.debug
 
-    log.note("Unpacking package.....")
-
-    if not os.path.exists(package_dir):
+    if not package_dir.exists():
         fatal_error(f"{package_dir} does not exist")
 
-    elif os.path.isdir(package_dir):
-        if os.system(log.debug(f"cp -r {package_dir}/./ {tmppath}")):
-            fatal_error("Failed to copy files")
+    pending: Path | None = None
 
-    else:
-        if os.system(log.debug(f"tar -xf {package_dir} -C {tmppath}")):
-            fatal_error("Error unpacking package, not a tar.gz file")
+    with ExitStack() as stack:
+        if package_dir.is_dir():
+            package = read_package_file(package_dir / ".avalon/package")
+            package_name = args[0] = f"{package.author}/{package.repo}".lower()
+            stack.enter_context(package_lock(paths, package_name))
 
-    with (tmppath / ".avalon/package").open("r", encoding="utf-8") as package_file:
-        package = Package(**json.load(package_file))
+            with timings.phase("requirements"):
+                check_dependency_graph_requirements(
+                    paths, package_name, package, flags.force, flags.update
+                )
 
-    if not package.author:
-        fatal_error("Package's metadata must contain `author`.")
+            log.note("Syncing package files.....")
 
-    if not package.repo:
-        fatal_error("Package's metadata must contain `repo`.")
+            with timings.phase("sync source", package=package_name):
+                changed = sync_directory(
+                    package_dir,
+                    paths.source / package_name,
+                    get_sync_path(paths, package_name, ".json"),
+                )
 
-    package_name = args[0] = (package.author + "/" + package.repo).lower()
+            get_metadata_repository(paths).invalidate(package_name)
+            get_sync_path(paths, package_name, ".origin").write_text(
+                str(package_dir.resolve()), encoding="utf-8"
+            )
+            pending = get_sync_path(paths, package_name, ".pending")
 
-    log.note("Deleting old binaries and source files.....")
-    delete_package(paths, package_name, package)
+            # Until it is built, e.g. if the last build failed.
+            if changed:
+                pending.touch()
 
-    log.note("Copying package files....")
+            if (
+                not (pending.exists() or flags.fresh)
+                and (paths.files / package_name).exists()
+            ):
+                log.success(f"{package_name} is already up to date.")
+                return
 
-    if os.system(log.debug(f"mkdir -p {paths.source / package_name}")):
-        fatal_error("Failed to make src folder")
+        else:
+            log.note("Unpacking package.....")
+            staging = Path(
+                tempfile.mkdtemp(
+                    prefix=".unpack-", dir=ensure_dir(paths.source)
+                )
+            )
 
-    if os.system(log.debug(f"cp -a {tmppath}/. {paths.source / package_name}")):
-        fatal_error("Failed to copy files from temp folder to src folder")
+            try:
+                with timings.phase("unpack"):
+                    if is_archive(package_dir):
+                        unpack_archive(flags, package_dir, staging)
+
+                    else:
+                        try:
+                            extract_tarball(package_dir, staging)
+
+                        except tarfile.TarError:
+                            fatal_error(
+                                "Error unpacking package, not a tarball"
+                            )
+
+                package = read_package_file(staging / ".avalon/package")
+                package_name = args[0] = (
+                    f"{package.author}/{package.repo}".lower()
+                )
+                stack.enter_context(package_lock(paths, package_name))
 
-    shutil.rmtree(tmppath)
+                with timings.phase("requirements"):
+                    check_dependency_graph_requirements(
+                        paths, package_name, package, flags.force, flags.update
+                    )
 
-    (
-        satisfied,
-        constraint,
-        unsupported,
-    ) = check_for_satisfied_package_requirements(paths, package_name, flags.force)
+                log.note("Deleting old source files.....")
+                remove_package_source(paths, package_name)
 
-    if not satisfied:
-        fatal_error(f'{constraint} "{unsupported}" is not supported by {package_name}.')
+                (paths.source / package_name).parent.mkdir(
+                    parents=True, exist_ok=True
+                )
+                os.rename(staging, paths.source / package_name)
+                get_metadata_repository(paths).invalidate(package_name)
 
-    install_package_dependencies(flags, paths, args)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
 
-    if not flags.noinstall:
-        log.note("Beginning compilation/installation.....")
-        compile_package(package_name, paths, flags)
-        log.success("Done!")
+        build_and_install_package(flags, paths, args)
 
-    else:
-        log.warn("-ni specified, skipping installation/compilation")
+        if pending is not None and not flags.noinstall:
+            pending.unlink(missing_ok=True)
 
 
-def install_package(flags: kazparse.flags.Flags, paths: Paths, args: list[str]) -> None:
+def install_package(
+    flags: kazparse.flags.Flags, paths: Paths, args: list[str]
+) -> None:
     """Installs a package."""
 
     if os.path.exists(args[0]):
         install_package_from_directory(flags, paths, args)
         return
 
-    package_name = args[0].lower()
-
-    if os.path.exists(f"{paths.source / package_name}") and not flags.fresh:
-        update_package(flags, paths, *args)
-        return
-
-    log.IS_DEBUG = flags.debug
-
-    download_metadata_repository(paths)
-
-    if ":" in package_name:  # commit
-        branch = None
-        commit = package_name.split(":")[-1]
-        package_name = package_name.split(":")[0]
-
-    elif package_name.count("/") > 1:  # branch
-        branch = package_name.split("/")[-1]
-        package_name = "/".join(package_name.split(":")[:-1])
-        commit = None
+    package_name, branch, commit = parse_package_spec(args[0].lower())
 
-    elif (":" in package_name) and (package_name.count("/") > 1):  # branch and commit
-        commit = package_name.split(":")[-1]
-        package_name = package_name.split(":")[0]
-        branch = package_name.split("/")[-1]
-        package_name = "/".join(package_name.split(":")[:-1])
+    with package_lock(paths, package_name):
+        # A specific branch or commit (e.g. a resolved version) is installed
+        # afresh instead of pulling the current one.
+        if (
+            os.path.exists(f"{paths.source / package_name}")
+            and not flags.fresh
+            and not (branch or commit)
+        ):
+            update_package(flags, paths, *args)
+            return
 
-    else:  # no branch or commit specified
-        branch = None
-        commit = None
+        log.IS_DEBUG = flags.debug
 
-    args[0] = package_name
+        with timings.phase("metadata repository"):
+            download_metadata_repository(paths)
 
-    log.note("Deleting old binaries and source files.....")
-    delete_package(paths, package_name, branch=branch, commit=commit)
-    log.note("Downloading from github.....")
-    log.debug("Downloading https://github.com/" + package_name, "to", paths.source)
-    download_package(
-        paths,
-        "https://github.com/" + package_name,
-        package_name,
-        branch=branch,
-        commit=commit,
-    )
+        args[0] = package_name
 
-    if is_in_metadata_repository(package_name, paths) and not is_avalon_package(
-        paths, package_name
-    ):
-        log.note(
-            "Package is not an Avalon package, but it is \
-            in the main repository... installing from there....."
+        package = get_package_metadata(
+            paths, package_name, commit=commit, branch=branch
         )
-        move_metadata_to_dot_avalon_folder(package_name, paths)
-
-    else:
-        log.debug("Not in the main repo")
-
-    (
-        satisfied,
-        constraint,
-        unsupported,
-    ) = check_for_satisfied_package_requirements(paths, package_name, flags.force)
 
-    if not satisfied:
-        fatal_error(f'{constraint} "{unsupported}" is not supported by {package_name}.')
+        with timings.phase("requirements"):
+            check_dependency_graph_requirements(
+                paths, package_name, package, flags.force, flags.update
+            )
 
-    install_package_dependencies(flags, paths, args)
+        with timings.phase("resolve"):
+            resolved = resolve_dependencies(
+                paths, package_name, package, flags.update
+            )
 
-    if not flags.noinstall:
-        log.note("Beginning compilation/installation.....")
-        compile_package(package_name, paths, flags)
-        log.success("Done!")
+        fetch_package(
+            paths, package_name, package, branch=branch, commit=commit
+        )
 
-    else:
-        log.warn("--noinstall specified, skipping installation/compilation")
+        build_and_install_package(flags, paths, args, resolved)
+        remove_renamed_binary(paths, package_name, package)
 
 
-def update_package(flags: kazparse.flags.Flags, paths: Paths, *args_: str) -> None:
+def update_package(
+    flags: kazparse.flags.Flags, paths: Paths, *args_: str
+) -> None:
     "Update to newest version of a repo, then recompile + reinstall program"
 
     args: list[str] = list(args_)
@@ -625,46 +372,60 @@ def update_package(flags: kazparse.flags.Flags, paths: Paths, *args_: str) -> No
     if len(args) == 0:
         args.append("r2boyo25/avalonpackagemanager")
 
-    download_metadata_repository(paths)
+    with timings.phase("metadata repository"):
+        download_metadata_repository(paths)
 
     log.IS_DEBUG = flags.debug
 
     package_name = args[0] = args[0].lower()
 
-    log.note("Pulling from github.....")
+    with package_lock(paths, package_name):
+        directory = get_installed_directory(paths, package_name)
 
-    if os.system(f"cd {paths.source / package_name}; git pull"):
-        if os.system(f"cd {paths.source / package_name}; git reset --hard; git pull"):
-            fatal_error("Git error")
+        if directory is not None:
+            if not directory.is_dir():
+                fatal_error(
+                    f"{package_name} was installed from {directory},",
+                    "which no longer exists.",
+                )
 
-    if is_in_metadata_repository(package_name, paths):
-        log.note(
-            "Package is not an Avalon package, but it is in \
-            the main repository... installing from there....."
-        )
-        move_metadata_to_dot_avalon_folder(package_name, paths)
+            install_package_from_directory(flags, paths, [str(directory)])
+            return
 
-    else:
-        log.debug("Not in the main repo")
+        if not (paths.source / package_name).exists():
+            fatal_error(f"{package_name} is not installed.")
 
-    (
-        satisfied,
-        constraint,
-        unsupported,
-    ) = check_for_satisfied_package_requirements(paths, package_name, flags.force)
+        if not (paths.source / package_name / ".git").exists():
+            fatal_error(
+                f"{package_name} was not installed from git or a directory,",
+                "install it again to update it.",
+            )
 
-    if not satisfied:
-        fatal_error(f'{constraint} "{unsupported}" is not supported by {package_name}.')
+        log.note("Checking for updates.....")
 
-    install_package_dependencies(flags, paths, args)
+        with timings.phase("pull", package=package_name):
+            commit = pull_package(paths, package_name)
 
-    if not flags.noinstall:
-        log.note("Beginning compilation/installation.....")
-        compile_package(package_name, paths, flags)
-        log.success("Done!")
+        # Not only if the source is, a build of it may have failed.
+        if (
+            not flags.fresh
+            and (paths.files / package_name).exists()
+            and get_built_commit(paths, package_name) == commit
+        ):
+            log.success(f"{package_name} is already up to date.")
+            return
 
-    else:
-        log.warn("-ni specified, skipping installation/compilation")
+        get_metadata_repository(paths).invalidate(package_name)
+
+        if is_in_metadata_repository(package_name, paths):
+            log.note("Package is not an Avalon package, but it is in \
+                the main repository... installing from there.....")
+            move_metadata_to_dot_avalon_folder(package_name, paths)
+
+        else:
+            log.debug("Not in the main repo")
+
+        build_and_install_package(flags, paths, args)
 
 
 def redo_symlinks_for_package(
@@ -684,14 +445,7 @@ def redo_symlinks_for_package(
         )
 
     log.debug(package_name, paths.binaries, paths.source, str(package))
-    remove_package_binary_symlink(paths, package_name, package=package)
-
-    symlink_binary_for_package(
-        paths,
-        package_name,
-        package.binfile or package.binname,
-        Path(package.binname),
-    )
+    relink_package_binary(paths, package_name, package)
 
 
 def uninstall_package(
@@ -703,72 +457,91 @@ def uninstall_package(
 
     package_name = args[0] = args[0].lower()
 
-    download_metadata_repository(paths)
-
-    if is_in_metadata_repository(package_name, paths) and not is_avalon_package(
-        paths, package_name
-    ):
-        log.note(
-            "Package is not an Avalon package, but it is in \
-            the main repository... uninstalling from there....."
-        )
-        move_metadata_to_dot_avalon_folder(package_name, paths)
-
-    (
-        satisfied,
-        constraint,
-        unsupported,
-    ) = check_for_satisfied_package_requirements(paths, package_name, flags.force)
+    with package_lock(paths, package_name):
+        download_metadata_repository(paths)
+
+        if is_in_metadata_repository(
+            package_name, paths
+        ) and not is_avalon_package(paths, package_name):
+            log.note("Package is not an Avalon package, but it is in \
+                the main repository... uninstalling from there.....")
+            move_metadata_to_dot_avalon_folder(package_name, paths)
+
+        with timings.phase("requirements"):
+            (
+                satisfied,
+                constraint,
+                unsupported,
+            ) = check_for_satisfied_package_requirements(
+                paths, package_name, flags.force
+            )
 
-    if not satisfied:
-        fatal_error(f'{constraint} "{unsupported}" is not supported by {package_name}.')
+        if not satisfied:
+            fatal_error(
+                f'{constraint} "{unsupported}" is not supported by {package_name}.'
+            )
 
-    package = get_package_metadata(paths, package_name)
-    log.note("Uninstalling.....")
+        package = get_package_metadata(paths, package_name)
+        log.note("Uninstalling.....")
 
-    if not package.uninstallScript:
-        log.warn(
-            "Uninstall script not found... Assuming uninstall not required and deleting files....."
-        )
-        delete_package(paths, package_name)
+        if not package.uninstallScript:
+            log.warn(
+                "Uninstall script not found... Assuming uninstall not required \
+                and deleting files....."
+            )
+            delete_package(paths, package_name)
 
-    else:
-        log.note("Uninstall script found, running.....")
-        os.chdir(paths.binaries)
+        else:
+            log.note("Uninstall script found, running.....")
 
-        if not package.binname:
-            log.fatal_error(
-                "Cannot uninstall package that lacks `binname` field in metadata."
-            )
+            if not package.binname:
+                log.fatal_error(
+                    "Cannot uninstall package that lacks `binname` field in metadata."
+                )
 
-        if run_script(
-            paths.source / package_name / package.uninstallScript,
-            paths.source,
-            paths.binaries,
-            package_name,
-            package.binname,
-            paths.files / package_name,
-        ):
-            log.error("Uninstall script failed! Deleting files anyways.....")
+            if run_script(
+                paths.source / package_name / package.uninstallScript,
+                paths.source,
+                paths.binaries,
+                package_name,
+                package.binname,
+                paths.files / package_name,
+                cwd=ensure_dir(paths.binaries),
+            ):
+                log.error(
+                    "Uninstall script failed! Deleting files anyways....."
+                )
 
-        delete_package(paths, package_name)
+            delete_package(paths, package_name)
 
-    log.success("Successfully uninstalled package!")
+        log.success("Successfully uninstalled package!")
 
 
 def download_package_source(
-    _flags: kazparse.flags.Flags, _paths: Paths, *args: str
+    _flags: kazparse.flags.Flags, paths: Paths, *args: str
 ) -> None:
     "Download repo into folder"
 
     package_name = args[0].lower()
-    out_dir = args[1]
 
     if len(args) == 1:
-        os.system(f"git clone https://github.com/{package_name}")
+        try_mirrors(
+            paths,
+            "source",
+            lambda mirror: not system(f"git clone {mirror}/{package_name}"),
+        )
 
     elif len(args) == 2:
-        os.system(f"git clone https://github.com/{package_name} {out_dir}")
+        out_dir = args[1]
+
+        try_mirrors(
+            paths,
+            "source",
+            lambda mirror: not system(
+                f"git clone {mirror}/{package_name} {out_dir}"
+            ),
+        )
 
     else:
-        os.system("git pull")  # nosec: B607, B605
+        if system("git pull"):
+            fatal_error("Git error")
@@ -0,0 +1,126 @@
+"""
+Prebuilt artifacts, so that hosts do not have to compile every package.
+
+A package's metadata can list artifacts in `prebuilt`, each with a `url`,
+its `sha256` and the `arches` and `distros` it was built for. An artifact
+is an `.apm` archive or a tarball of the package's files directory.
+"""
+
+import hashlib
+import tempfile
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from apm import log
+from apm.archive import Archive, is_archive
+from apm.files import extract_tarball
+from apm.network import request
+from apm.package import Package
+from apm.path import Paths, get_run_temp
+from .requirements import get_architecture, get_linux_distribution
+
+
+def find_prebuilt_artifact(package: Package) -> dict[str, Any] | None:
+    "Find the first artifact that was built for this host's arch and distro."
+
+    for artifact in package.prebuilt or []:
+        arches = artifact.get("arches") or ["all"]
+        distros = artifact.get("distros") or ["all"]
+
+        if (get_architecture() in arches or arches == ["all"]) and (
+            get_linux_distribution() in distros or distros == ["all"]
+        ):
+            return artifact
+
+    return None
+
+
+def download_prebuilt_artifact(
+    paths: Paths, package_name: str, artifact: dict[str, Any]
+) -> Path | None:
+    """
+    Download `artifact` and check its checksum, returning where it was
+    saved, or None if it could not be downloaded or verified.
+    """
+
+    import requests  # pylint: disable=import-outside-toplevel
+
+    if "url" not in artifact or "sha256" not in artifact:
+        log.warn(
+            f"Prebuilt artifact for {package_name} needs `url` and `sha256`."
+        )
+        return None
+
+    checksum = hashlib.sha256()
+
+    with tempfile.NamedTemporaryFile(
+        dir=get_run_temp(paths), prefix="prebuilt-", delete=False
+    ) as artifact_file:
+        artifact_path = Path(artifact_file.name)
+
+        try:
+            with request(
+                paths, "GET", artifact["url"], stream=True
+            ) as response:
+                response.raise_for_status()
+
+                for block in response.iter_content(1024 * 1024):
+                    checksum.update(block)
+                    artifact_file.write(block)
+
+        except requests.RequestException as exception:
+            log.warn(
+                f"Failed to download prebuilt artifact for {package_name}:",
+                str(exception),
+            )
+            artifact_path.unlink()
+            return None
+
+    if checksum.hexdigest() != artifact["sha256"].lower():
+        log.warn(f"Prebuilt artifact for {package_name} failed verification.")
+        artifact_path.unlink()
+        return None
+
+    return artifact_path
+
+
+def start_prebuilt_download(
+    paths: Paths, package_name: str, package: Package
+) -> Future[Path | None] | None:
+    """
+    Start downloading a matching prebuilt artifact in the background, so
+    that it downloads while dependencies are installed.
+
+    Returns None if no artifact matches this host.
+    """
+
+    artifact = find_prebuilt_artifact(package)
+
+    if artifact is None:
+        log.debug("No prebuilt artifact for", package_name)
+        return None
+
+    log.note("Downloading prebuilt artifact.....")
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(
+        download_prebuilt_artifact, paths, package_name, artifact
+    )
+    executor.shutdown(wait=False)
+
+    return future
+
+
+def unpack_prebuilt_artifact(artifact_path: Path, files_dir: Path) -> None:
+    "Unpack a downloaded artifact into the package's files directory."
+
+    files_dir.mkdir(parents=True, exist_ok=True)
+
+    if is_archive(artifact_path):
+        with Archive(artifact_path) as archive:
+            archive.extract(files_dir)
+
+    else:
+        extract_tarball(artifact_path, files_dir)
@@ -2,20 +2,21 @@
 Functions for checking that Linux distributions and CPU architectures are supported.
 """
 
-import platform
-
-import distro
-
-from apm import log
-from apm.package import Package
+from apm import log, path
+from apm.host import get_host_facts
+from apm.log import fatal_error
+from apm.package import Package, parse_requirement
 from apm.path import Paths
-from .metadata import get_package_metadata
+from .metadata import get_metadata_repository, get_package_metadata
+
+# Packages whose dependency graphs have been checked during this run.
+_checked_graphs: set[str] = set()
 
 
 def get_linux_distribution() -> str:
     """Returns the name of the current Linux distribution."""
 
-    return distro.linux_distribution()[0]
+    return get_host_facts(path.paths).distro
 
 
 def linux_distribution_is_supported(package: Package) -> bool:
@@ -37,7 +38,7 @@ def linux_distribution_is_supported(package: Package) -> bool:
 def get_architecture() -> str:
     """Returns the current CPU architecture."""
 
-    return platform.machine()
+    return get_host_facts(path.paths).arch
 
 
 def architecture_is_supported(package: Package) -> bool:
@@ -60,7 +61,14 @@ def check_for_satisfied_package_requirements(
     paths: Paths, package_name: str, force: bool
 ) -> tuple[bool, str | None, str | None]:
     """Checks that the package's requirements are satisfied"""
-    package = get_package_metadata(paths, package_name)
+
+    return check_package_requirements(get_package_metadata(paths, package_name), force)
+
+
+def check_package_requirements(
+    package: Package, force: bool
+) -> tuple[bool, str | None, str | None]:
+    """Checks that the requirements in `package`'s metadata are satisfied"""
 
     if force:
         if not architecture_is_supported(package):
@@ -84,3 +92,110 @@ def check_for_satisfied_package_requirements(
         return False, "Linux distribution", get_linux_distribution()
 
     return True, None, None
+
+
+def find_unsupported_requirement(package: Package) -> tuple[str, str] | None:
+    """
+    Returns the requirement of `package` that this host does not meet and
+    this host's value for it, without warning about missing requirements.
+    """
+
+    if package.arches and package.arches != ["all"]:
+        if get_architecture() not in package.arches:
+            return "CPU Architecture", get_architecture()
+
+    if package.distros and package.distros != ["all"]:
+        if get_linux_distribution() not in package.distros:
+            return "Linux distribution", get_linux_distribution()
+
+    return None
+
+
+def _get_new_dependencies(
+    paths: Paths,
+    package: Package,
+    seen: set[str],
+    update: bool,
+    problems: list[str],
+) -> list[tuple[str, Package]]:
+    """
+    The Avalon dependencies of `package` that are not in `seen` yet, with
+    their metadata, adding them to `seen`. Installed dependencies are
+    skipped unless `update` is set, and those without metadata are added
+    to `problems`.
+    """
+
+    dependencies = []
+
+    for dep in (package.deps or {}).get("avalon") or []:
+        requirement = parse_requirement(dep.lower())
+        dep_name = requirement.name
+        installed = (paths.files / dep_name).exists()
+
+        if dep_name in seen or (installed and not update):
+            continue
+
+        seen.add(dep_name)
+        log.debug("Checking requirements of", dep_name)
+
+        dep_package = get_metadata_repository(paths).get(
+            dep_name, requirement.commit, requirement.branch
+        )
+
+        if dep_package is None:
+            problems.append(f"No valid metadata available for {dep_name}.")
+            continue
+
+        dependencies.append((dep_name, dep_package))
+
+    return dependencies
+
+
+def check_dependency_graph_requirements(
+    paths: Paths,
+    package_name: str,
+    package: Package,
+    force: bool,
+    update: bool,
+) -> None:
+    """
+    Checks the requirements of `package` and every Avalon dependency it
+    pulls in, using local or remote metadata, so that an unsupported
+    dependency is found before anything is downloaded. Dependencies that
+    are installed already are skipped unless `update` is set, like
+    `install_avalon_dependencies` does.
+
+    Every problem is reported at once. Exits unless `force` is set.
+    """
+
+    if package_name in _checked_graphs:
+        return
+
+    problems: list[str] = []
+    seen = {package_name}
+    stack: list[tuple[str, Package]] = [(package_name, package)]
+
+    while stack:
+        name, node = stack.pop()
+        _checked_graphs.add(name)
+
+        if (unsupported := find_unsupported_requirement(node)) is not None:
+            constraint, value = unsupported
+            problems.append(
+                f'{constraint} "{value}" is not supported by {name}.'
+            )
+
+        stack.extend(
+            _get_new_dependencies(paths, node, seen, update, problems)
+        )
+
+    if not problems:
+        return
+
+    if force:
+        for problem in problems:
+            log.warn(problem, "Continuing anyway due to forced mode.")
+
+        return
+
+    fatal_error("\n".join(problems))
@@ -0,0 +1,423 @@
+"""
+Picks a version of every Avalon dependency that satisfies every package
+depending on it.
+
+Dependencies in `deps.avalon` can be constrained (`user/repo>=1.2,<2`) or
+pinned to a branch or commit (`user/repo/branch`, `user/repo:commit`).
+Versions come from the installed package, the default branch's metadata
+and the repository's semver tags. The newest acceptable version is tried
+first, backtracking to older ones when a choice leads to a conflict.
+"""
+
+import re
+
+from dataclasses import dataclass
+from typing import Iterator
+
+import semver
+
+from apm import events, log
+from apm.log import fatal_error
+from apm.package import Package, Requirement, parse_requirement
+from apm.path import Paths
+from .changelog import current_version
+from .git import git_output
+from .metadata import (
+    get_local_package_metadata,
+    get_remote_package_metadata,
+)
+from .mirrors import try_mirrors
+from .network import get_remaining
+
+
+@dataclass(frozen=True)
+class Candidate:
+    "A version of a package that could be installed."
+
+    name: str
+    version: semver.Version | None
+    # Tag or branch to install, None for the default branch.
+    ref: str | None = None
+    commit: str | None = None
+    installed: bool = False
+
+    def spec(self) -> str:
+        "How to pass this version to `install_package`."
+
+        return (
+            self.name
+            + (f"/{self.ref}" if self.ref else "")
+            + (f":{self.commit}" if self.commit and not self.ref else "")
+        )
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name} {self.version or self.ref or self.commit or 'HEAD'}"
+        )
+
+
+# Name, ref, commit and whether it is the installed version.
+MetadataKey = tuple[str, str | None, str | None, bool]
+
+COMPARISON = re.compile(r"(?P<operator><=|>=|==|!=|<|>|=|)(?P<version>.+)")
+
+# Versions picked so far during this run, by package name.
+_resolved: dict[str, Candidate] = {}
+
+
+def parse_version(text: str) -> semver.Version | None:
+    "Parse `1.2.3`, `v1.2` etc., or return None if it is not a version."
+
+    try:
+        return semver.Version.parse(
+            text.removeprefix("v"), optional_minor_and_patch=True
+        )
+
+    except (ValueError, TypeError):
+        return None
+
+
+def expand_constraint(constraint: str) -> list[str]:
+    """
+    Split a constraint into comparisons `semver.Version.match` understands,
+    turning `^1.2` into `>=1.2.0` and `<2.0.0`, and `~1.2` into `>=1.2.0`
+    and `<1.3.0`.
+    """
+
+    comparisons = []
+
+    for part in constraint.split(","):
+        part = part.strip().replace(" ", "")
+
+        if part[:1] in ("^", "~"):
+            version = parse_version(part[1:])
+
+            if version is None:
+                raise ValueError(f"Invalid version in `{part}`")
+
+            if part[0] == "~" or version.major == 0:
+                upper = version.bump_minor()
+
+            else:
+                upper = version.bump_major()
+
+            comparisons += [f">={version}", f"<{upper}"]
+            continue
+
+        match = COMPARISON.fullmatch(part)
+
+        if (
+            match is None
+            or (version := parse_version(match["version"])) is None
+        ):
+            raise ValueError(f"Invalid version in `{part}`")
+
+        operator = match["operator"]
+        comparisons.append(
+            f"{'==' if operator in ('', '=') else operator}{version}"
+        )
+
+    return comparisons
+
+
+def satisfies(candidate: Candidate, requirement: Requirement) -> bool:
+    "Whether `candidate` is a version that `requirement` accepts."
+
+    if requirement.commit and not (
+        candidate.commit and candidate.commit.startswith(requirement.commit)
+    ):
+        return False
+
+    if requirement.branch and candidate.ref != requirement.branch:
+        return False
+
+    if not requirement.constraint:
+        return True
+
+    if candidate.version is None:
+        return False
+
+    return all(
+        candidate.version.match(comparison)
+        for comparison in expand_constraint(requirement.constraint)
+    )
+
+
+class Resolver:
+    "Resolves requirements, remembering every tag and metadata lookup."
+
+    def __init__(self, paths: Paths, update: bool) -> None:
+        self.paths = paths
+        self.update = update
+        self._tags: dict[str, list[Candidate]] = {}
+        self._metadata: dict[MetadataKey, Package | None] = {}
+        self._dependencies: dict[Candidate, tuple[Requirement, ...]] = {}
+        self.conflicts: dict[str, tuple[Requirement, ...]] = {}
+
+    def get_tags(self, name: str) -> list[Candidate]:
+        "The repository's semver tags, newest first."
+
+        if name not in self._tags:
+            output = ""
+
+            def list_tags(mirror: str) -> bool:
+                nonlocal output
+                output = (
+                    git_output(
+                        "ls-remote",
+                        "--tags",
+                        f"{mirror}/{name}",
+                        timeout=get_remaining(),
+                    )
+                    or ""
+                )
+                return bool(output)
+
+            try_mirrors(self.paths, "source", list_tags)
+            commits = {}
+
+            for line in output.splitlines():
+                commit, ref = line.split("\t")
+                tag = ref.removeprefix("refs/tags/")
+
+                # Annotated tags are listed again, peeled to their commit.
+                if tag.endswith("^{}") or tag not in commits:
+                    commits[tag.removesuffix("^{}")] = commit
+
+            versions = {
+                tag: version
+                for tag in commits
+                if (version := parse_version(tag)) is not None
+            }
+            self._tags[name] = [
+                Candidate(name, version, ref=tag, commit=commits[tag])
+                for tag, version in sorted(
+                    versions.items(), key=lambda item: item[1], reverse=True
+                )
+            ]
+
+        return self._tags[name]
+
+    def get_metadata(self, candidate: Candidate) -> Package | None:
+        "The metadata of that version of the package."
+
+        key = (
+            candidate.name,
+            candidate.ref,
+            candidate.commit,
+            candidate.installed,
+        )
+
+        if key not in self._metadata:
+            if candidate.installed:
+                package = get_local_package_metadata(
+                    self.paths, candidate.name
+                )
+
+            elif candidate.ref or candidate.commit:
+                package = get_remote_package_metadata(
+                    self.paths,
+                    candidate.name,
+                    commit=None if candidate.ref else candidate.commit,
+                    branch=candidate.ref,
+                )
+
+            else:
+                # Not the installed source's, which may be older.
+                package = get_remote_package_metadata(
+                    self.paths, candidate.name
+                )
+
+            self._metadata[key] = package
+
+        return self._metadata[key]
+
+    def get_dependencies(
+        self, candidate: Candidate
+    ) -> tuple[Requirement, ...]:
+        "What that version of the package depends on."
+
+        if candidate not in self._dependencies:
+            package = self.get_metadata(candidate)
+            self._dependencies[candidate] = get_requirements(
+                package, str(candidate)
+            )
+
+        return self._dependencies[candidate]
+
+    def iter_candidates(self, requirement: Requirement) -> Iterator[Candidate]:
+        """
+        Versions of the required package in order of preference: the
+        installed one (unless updating), the default branch, then tags.
+        """
+
+        name = requirement.name
+
+        if requirement.branch or requirement.commit:
+            pinned = Candidate(
+                name, None, ref=requirement.branch, commit=requirement.commit
+            )
+            package = self.get_metadata(pinned)
+            version = (
+                package and package.version and parse_version(package.version)
+            )
+
+            yield Candidate(
+                name,
+                version or None,
+                ref=requirement.branch,
+                commit=requirement.commit,
+            )
+            return
+
+        if (self.paths.files / name).exists() and not self.update:
+            package = get_local_package_metadata(self.paths, name)
+
+            if package and package.version:
+                version = parse_version(package.version)
+
+            else:
+                version = current_version(self.paths.source / name)
+
+            yield Candidate(name, version, installed=True)
+
+        package = self.get_metadata(Candidate(name, None))
+
+        if package is not None:
+            version = (
+                parse_version(package.version) if package.version else None
+            )
+            yield Candidate(name, version)
+
+        yield from self.get_tags(name)
+
+    def resolve(
+        self,
+        pending: tuple[Requirement, ...],
+        chosen: dict[str, Candidate],
+        active: dict[str, tuple[Requirement, ...]],
+    ) -> dict[str, Candidate] | None:
+        """
+        Choose a version for each pending requirement and everything it
+        depends on, consistent with `chosen`. Returns None, recording the
+        requirements that could not be met in `conflicts`, if there is no
+        such choice.
+        """
+
+        if not pending:
+            return chosen
+
+        requirement, rest = pending[0], pending[1:]
+        name = requirement.name
+        requirements = active.get(name, ()) + (requirement,)
+        active = {**active, name: requirements}
+
+        if name in chosen:
+            if satisfies(chosen[name], requirement):
+                return self.resolve(rest, chosen, active)
+
+            self.conflicts[name] = requirements
+            return None
+
+        for candidate in self.iter_candidates(requirement):
+            if not all(satisfies(candidate, other) for other in requirements):
+                continue
+
+            if self.get_metadata(candidate) is None:
+                log.debug("No metadata for", str(candidate))
+                continue
+
+            log.debug("Trying", str(candidate))
+
+            result = self.resolve(
+                rest + self.get_dependencies(candidate),
+                {**chosen, name: candidate},
+                active,
+            )
+
+            if result is not None:
+                return result
+
+        self.conflicts[name] = requirements
+        return None
+
+
+def get_requirements(
+    package: Package | None, required_by: str
+) -> tuple[Requirement, ...]:
+    "The Avalon dependencies of `package`."
+
+    if package is None:
+        return ()
+
+    return tuple(
+        parse_requirement(dep.lower(), required_by)
+        for dep in (package.deps or {}).get("avalon") or []
+    )
+
+
+def describe_conflicts(conflicts: dict[str, tuple[Requirement, ...]]) -> str:
+    "Explain which requirements could not be satisfied together."
+
+    lines = []
+
+    for name, requirements in conflicts.items():
+        lines.append(f"No version of {name} satisfies all of:")
+
+        for requirement in requirements:
+            wanted = (
+                requirement.constraint
+                or requirement.commit
+                or requirement.branch
+                or "any version"
+            )
+            lines.append(f"  {wanted} (required by {requirement.required_by})")
+
+    return "\n".join(lines)
+
+
+def resolve_dependencies(
+    paths: Paths, package_name: str, package: Package, update: bool
+) -> dict[str, Candidate]:
+    """
+    Pick versions for all of `package`'s Avalon dependencies, keeping the
+    versions picked earlier in this run. Exits if they conflict.
+    """
+
+    resolver = Resolver(paths, update)
+
+    try:
+        resolved = resolver.resolve(
+            get_requirements(package, package_name), dict(_resolved), {}
+        )
+
+    except ValueError as exception:
+        fatal_error(
+            "Invalid dependency of", package_name + ":", str(exception)
+        )
+
+    if resolved is None:
+        fatal_error(describe_conflicts(resolver.conflicts))
+
+    for name, candidate in resolved.items():
+        if name not in _resolved:
+            log.debug("Resolved", str(candidate))
+            events.emit(
+                "resolved",
+                package=name,
+                required_by=package_name,
+                version=candidate.version and str(candidate.version),
+                ref=candidate.ref,
+                commit=candidate.commit,
+                installed=candidate.installed,
+            )
+
+    _resolved.update(resolved)
+
+    return resolved
+
+
+def get_resolved_candidate(name: str) -> Candidate | None:
+    "The version picked for the package, if it has been resolved."
+
+    return _resolved.get(name)
@@ -0,0 +1,318 @@
+"""
+`apm search`: fuzzy search over the packages in the metadata repository.
+
+Searching uses a trigram index of each package's author, repo, binname
+and description, kept in an SQLite database in the Avalon cache. The
+index is brought up to date before each search, re-reading only the
+metadata files that changed since it was last built.
+"""
+
+import json
+import os
+import re
+import sqlite3
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from apm import log
+from apm.path import Paths, ensure_dir
+
+INDEX_VERSION = 1
+# Fields of the metadata that are searched.
+FIELDS = ["author", "repo", "binname", "description"]
+# Fraction of the term's trigrams that a package must contain to match.
+MIN_SCORE = 0.3
+
+
+@dataclass
+class SearchResult:
+    "A package matching a search, with how well it matched."
+
+    name: str
+    score: float
+    package: dict[str, Any]
+
+
+def get_trigrams(text: str) -> set[str]:
+    "The trigrams of every word in `text`, padded like `pg_trgm`'s."
+
+    trigrams: set[str] = set()
+
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        padded = f"  {word} "
+        trigrams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+
+    return trigrams
+
+
+def find_metadata_files(paths: Paths) -> dict[str, tuple[Path, int]]:
+    """
+    Every `user/repo/package` in the metadata repository, by lowercase
+    package name, with its modification time.
+    """
+
+    found: dict[str, tuple[Path, int]] = {}
+
+    if not paths.metadata.exists():
+        return found
+
+    with os.scandir(paths.metadata) as users:
+        for user in users:
+            if user.name.startswith(".") or not user.is_dir():
+                continue
+
+            with os.scandir(user.path) as repos:
+                for repo in repos:
+                    package_file = Path(repo.path) / "package"
+
+                    try:
+                        found[f"{user.name}/{repo.name}".lower()] = (
+                            package_file,
+                            package_file.stat().st_mtime_ns,
+                        )
+
+                    except (FileNotFoundError, NotADirectoryError):
+                        pass
+
+    return found
+
+
+def read_index_entry(package_file: Path) -> dict[str, Any] | None:
+    "The searchable parts of a package's metadata."
+
+    try:
+        with package_file.open("r", encoding="utf-8") as metadata_file:
+            package = dict(json.load(metadata_file))
+
+    except (OSError, ValueError) as exception:
+        log.debug("Not indexing", package_file, "reason:", str(exception))
+        return None
+
+    package.setdefault("author", package_file.parent.parent.name)
+    package.setdefault("repo", package_file.parent.name)
+
+    return {
+        key: package.get(key)
+        for key in [*FIELDS, "arches", "distros", "version"]
+    }
+
+
+class SearchIndex:
+    """
+    An inverted index from trigrams to the packages containing them, in an
+    SQLite database so that searching does not have to load all of it.
+    """
+
+    def __init__(self, paths: Paths) -> None:
+        self.paths = paths
+        self.index_path = ensure_dir(paths.cache) / "search-index.sqlite"
+        self.database = sqlite3.connect(self.index_path)
+        # It is only a cache, it can be rebuilt if it is ever lost.
+        self.database.execute("PRAGMA synchronous = OFF")
+        self.database.execute("PRAGMA cache_size = -65536")
+
+        if self.get_meta("version") != INDEX_VERSION:
+            self.database.executescript("""
+                DROP TABLE IF EXISTS meta;
+                DROP TABLE IF EXISTS packages;
+                DROP TABLE IF EXISTS trigrams;
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value);
+                CREATE TABLE packages (
+                    name TEXT PRIMARY KEY, mtime INTEGER, entry TEXT
+                );
+                CREATE TABLE trigrams (
+                    trigram TEXT, name TEXT, PRIMARY KEY (trigram, name)
+                ) WITHOUT ROWID;
+                CREATE INDEX trigrams_name ON trigrams (name);
+                """)
+            self.set_meta("version", INDEX_VERSION)
+            self.database.commit()
+
+    def __enter__(self) -> "SearchIndex":
+        return self
+
+    def __exit__(self, *_exception: object) -> None:
+        self.database.close()
+
+    def get_meta(self, key: str) -> Any:
+        "A value stored alongside the index, or None."
+
+        try:
+            row = self.database.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+
+        except sqlite3.OperationalError:
+            return None
+
+        return row and row[0]
+
+    def set_meta(self, key: str, value: Any) -> None:
+        "Store a value alongside the index."
+
+        self.database.execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value)
+        )
+
+    def get_signature(self) -> int | None:
+        """
+        Changes whenever git updates the metadata repository's work tree,
+        so an unchanged repository does not have to be scanned.
+        """
+
+        try:
+            return (self.paths.metadata / ".git" / "index").stat().st_mtime_ns
+
+        except FileNotFoundError:
+            return None
+
+    def remove(self, name: str) -> None:
+        "Remove a package from the index."
+
+        self.database.execute("DELETE FROM packages WHERE name = ?", (name,))
+        self.database.execute("DELETE FROM trigrams WHERE name = ?", (name,))
+
+    def add(self, name: str, mtime: int, entry: dict[str, Any]) -> None:
+        "Add a package to the index."
+
+        trigrams = get_trigrams(
+            " ".join(str(entry[key]) for key in FIELDS if entry.get(key))
+        )
+
+        self.database.execute(
+            "INSERT INTO packages VALUES (?, ?, ?)",
+            (name, mtime, json.dumps(entry)),
+        )
+        self.database.executemany(
+            "INSERT INTO trigrams VALUES (?, ?)",
+            [(trigram, name) for trigram in trigrams],
+        )
+
+    def update(self) -> None:
+        "Re-index the packages whose metadata changed since the last update."
+
+        signature = self.get_signature()
+
+        if signature is not None and signature == self.get_meta("signature"):
+            return
+
+        found = find_metadata_files(self.paths)
+        indexed = dict(
+            self.database.execute("SELECT name, mtime FROM packages")
+        )
+        changed = 0
+
+        with self.database:
+            for name in indexed.keys() - found.keys():
+                self.remove(name)
+                changed += 1
+
+            for name, (package_file, mtime) in found.items():
+                if indexed.get(name) == mtime:
+                    continue
+
+                if name in indexed:
+                    self.remove(name)
+
+                if (entry := read_index_entry(package_file)) is not None:
+                    self.add(name, mtime, entry)
+
+                changed += 1
+
+            self.set_meta("signature", signature)
+
+        log.debug(f"Re-indexed {changed} packages for searching.")
+
+    def search(self, term: str) -> list[SearchResult]:
+        """
+        Packages sharing at least `MIN_SCORE` of the term's trigrams, best
+        first. Matches in the repo or binname rank above the rest.
+        """
+
+        wanted = sorted(get_trigrams(term))
+
+        if not wanted:
+            return []
+
+        rows = self.database.execute(
+            f"""
+            SELECT packages.name, matches.count, packages.entry
+            FROM (
+                SELECT name, COUNT(*) AS count FROM trigrams
+                WHERE trigram IN ({", ".join("?" * len(wanted))})
+                GROUP BY name HAVING count >= ?
+            ) AS matches
+            JOIN packages ON packages.name = matches.name
+            """,  # nosec B608
+            (*wanted, MIN_SCORE * len(wanted)),
+        )
+
+        results = []
+        needle = term.lower()
+
+        for name, count, entry in rows:
+            package = json.loads(entry)
+            score = count / len(wanted)
+
+            for key in ["repo", "binname"]:
+                if needle in str(package.get(key) or "").lower():
+                    score += 1 if needle == str(package[key]).lower() else 0.5
+                    break
+
+            results.append(SearchResult(name, score, package))
+
+        return sorted(results, key=lambda result: (-result.score, result.name))
+
+
+def get_search_index(paths: Paths) -> SearchIndex:
+    "Open the search index and bring it up to date."
+
+    index = SearchIndex(paths)
+    index.update()
+
+    return index
+
+
+def search_packages(flags: Any, paths: Paths, *args: str) -> None:
+    """
+    Print the packages matching `args`, best first. Packages that do not
+    support this machine's arch or distro are left out unless `--all` is
+    given.
+    """
+
+    # pylint: disable=import-outside-toplevel
+    from apm.metadata import download_metadata_repository
+    from apm.package import Package
+    from apm.requirements import find_unsupported_requirement
+
+    log.IS_DEBUG = flags.debug
+
+    if not args:
+        log.fatal_error("Usage: apm search <term>")
+
+    download_metadata_repository(paths)
+
+    with get_search_index(paths) as index:
+        results = index.search(" ".join(args))
+
+    for result in results:
+        package = result.package
+
+        if not flags.all and find_unsupported_requirement(
+            Package(arches=package["arches"], distros=package["distros"])
+        ):
+            continue
+
+        if flags.machine:
+            print(result.name)
+            continue
+
+        version = f" {package['version']}" if package.get("version") else ""
+        description = (
+            f" - {package['description']}"
+            if package.get("description")
+            else ""
+        )
+        print(f"{result.name}{version}{description}")
@@ -0,0 +1,273 @@
+"""
+Package sources: downloading them with git, keeping them up to date and
+removing them.
+"""
+
+import shutil
+
+from pathlib import Path
+
+from apm import log, timings
+from apm.log import fatal_error
+from .git import git, git_output, is_full_commit_hash
+from .metadata import (
+    get_metadata_repository,
+    is_avalon_package,
+    is_in_metadata_repository,
+    move_metadata_to_dot_avalon_folder,
+)
+from .mirrors import try_mirrors
+from .network import get_remaining
+from .package import Package
+from .path import Paths
+from .transfers import git_transfer
+
+
+def get_sparse_checkout_paths(package: Package | None) -> list[str] | None:
+    """
+    Returns the paths to check out for a package with `sparseCheckout`, or
+    None if the whole repository is needed.
+    """
+
+    if package is None or not package.sparseCheckout:
+        return None
+
+    if package.toCopy in (["all"], None):
+        log.debug("Not using a sparse checkout, `toCopy` needs everything.")
+        return None
+
+    needed = [
+        "/.avalon/",
+        "/requirements.txt",
+        "/CHANGELOG.md",
+        "/CHANGELOG.MD",
+        *package.toCopy,
+        *(package.sparsePaths or []),
+    ]
+
+    for script in (
+        package.compileScript,
+        package.installScript,
+        package.uninstallScript,
+        package.binfile,
+    ):
+        if script:
+            needed.append(script)
+
+    return [path if path.startswith("/") else "/" + path for path in needed]
+
+
+def download_package(  # pylint: disable=too-many-arguments
+    paths: Paths,
+    package_url: str,
+    package_name: str | None = None,
+    branch: str | None = None,
+    commit: str | None = None,
+    sparse_paths: list[str] | None = None,
+) -> bool:
+    """
+    Downloads a specfic commit and branch of a package.
+
+    A full commit hash is fetched on its own, without any history. If
+    `sparse_paths` is given, only those paths are checked out and only
+    their blobs are downloaded.
+
+    Returns whether the download succeeded.
+    """
+
+    if not package_name:
+        package_name = "/".join(package_url.split("/")[-2:])
+
+    package_dir = paths.source / package_name
+    package_dir.parent.mkdir(parents=True, exist_ok=True)
+    log.debug(package_name)
+
+    partial = ["--filter=blob:none"] if sparse_paths else []
+    no_checkout = ["--no-checkout"] if sparse_paths else []
+
+    def set_sparse_checkout() -> bool:
+        return not sparse_paths or not git(
+            "sparse-checkout",
+            "set",
+            "--no-cone",
+            *sparse_paths,
+            cwd=package_dir,
+        )
+
+    if commit and is_full_commit_hash(commit):
+        if (
+            not git("init", "-q", package_dir)
+            and not git(
+                "remote", "add", "origin", package_url, cwd=package_dir
+            )
+            and set_sparse_checkout()
+            and not git_transfer(
+                paths,
+                package_name,
+                "fetch",
+                "--depth",
+                "1",
+                *partial,
+                "origin",
+                commit,
+            )
+            and not git("checkout", "-q", "FETCH_HEAD", cwd=package_dir)
+        ):
+            return True
+
+        log.debug("Fetching", commit, "on its own failed, cloning instead.")
+        remove_package_source(paths, package_name)
+
+    if commit:
+        return (
+            not git_transfer(
+                paths,
+                package_name,
+                "clone",
+                "--filter=blob:none",
+                "--no-checkout",
+                *(["-b", branch] if branch else []),
+                package_url,
+                package_dir,
+            )
+            and set_sparse_checkout()
+            and not git("checkout", "-q", commit, cwd=package_dir)
+        )
+
+    return (
+        not git_transfer(
+            paths,
+            package_name,
+            "clone",
+            "--depth",
+            "1",
+            *partial,
+            *no_checkout,
+            *(["-b", branch] if branch else []),
+            package_url,
+            package_dir,
+        )
+        and set_sparse_checkout()
+        and (not sparse_paths or not git("checkout", "-q", cwd=package_dir))
+    )
+
+
+def pull_package(paths: Paths, package_name: str) -> str:
+    """
+    Brings a package's source up to its remote branch's newest commit.
+
+    The remote is asked for that commit first, so nothing is fetched if it
+    is already checked out. Otherwise only that commit is fetched, and
+    checked out over any local changes. A source that is not on a branch,
+    i.e. a commit or tag was installed, is pinned and left alone. Returns
+    the commit that the source is at.
+    """
+
+    package_dir = paths.source / package_name
+    head = git_output("rev-parse", "HEAD", cwd=package_dir)
+
+    if head is None:
+        fatal_error(f"{package_dir} is not a git repository.")
+
+    branch = git_output(
+        "symbolic-ref", "-q", "--short", "HEAD", cwd=package_dir
+    )
+
+    if not branch:
+        log.debug(package_name, "is pinned to", head.strip())
+        return head.strip()
+
+    ref = f"refs/heads/{branch.strip()}"
+    listing = git_output(
+        "ls-remote", "origin", ref, cwd=package_dir, timeout=get_remaining()
+    )
+
+    if not listing:
+        fatal_error("Failed to find", ref, "in the remote of", package_name)
+
+    remote_commit = listing.split()[0]
+
+    if remote_commit == head.strip():
+        log.debug(package_name, "is at", remote_commit, "already.")
+        return remote_commit
+
+    log.note("Pulling from github.....")
+
+    if git_transfer(
+        paths, package_name, "fetch", "--depth", "1", "origin", ref
+    ) or git("reset", "-q", "--hard", "FETCH_HEAD", cwd=package_dir):
+        fatal_error("Git error")
+
+    return remote_commit
+
+
+def fetch_package(
+    paths: Paths,
+    package_name: str,
+    package: Package | None,
+    branch: str | None = None,
+    commit: str | None = None,
+) -> None:
+    """
+    Replaces a package's source with the given branch or commit, falling
+    back to the main repository's metadata if it is not an Avalon package.
+    The installed files and binary stay until the new build replaces them.
+    """
+
+    log.note("Deleting old source files.....")
+
+    with timings.phase("delete", package=package_name):
+        remove_package_source(paths, package_name)
+
+    log.note("Downloading from github.....")
+    sparse_paths = get_sparse_checkout_paths(package)
+
+    def download_from(mirror: str) -> bool:
+        remove_package_source(paths, package_name)
+        log.debug(f"Downloading {mirror}/{package_name}", "to", paths.source)
+
+        return download_package(
+            paths,
+            f"{mirror}/{package_name}",
+            package_name,
+            branch=branch,
+            commit=commit,
+            sparse_paths=sparse_paths,
+        )
+
+    with timings.phase("download", package=package_name):
+        if not try_mirrors(paths, "source", download_from):
+            fatal_error("Failed to download", package_name)
+
+    get_metadata_repository(paths).invalidate(package_name)
+
+    if is_in_metadata_repository(
+        package_name, paths
+    ) and not is_avalon_package(paths, package_name):
+        log.note("Package is not an Avalon package, but it is \
+            in the main repository... installing from there.....")
+        move_metadata_to_dot_avalon_folder(package_name, paths)
+
+    else:
+        log.debug("Not in the main repo")
+
+
+def remove_package_source(paths: Paths, package_name: str) -> None:
+    """Deletes the source code of a package."""
+
+    if (paths.source / package_name).exists():
+        shutil.rmtree(paths.source / package_name, ignore_errors=True)
+
+    # It no longer comes from a directory.
+    get_sync_path(paths, package_name, ".origin").unlink(missing_ok=True)
+    get_metadata_repository(paths).invalidate(package_name)
+
+
+def get_sync_path(paths: Paths, package_name: str, suffix: str) -> Path:
+    """
+    Where the state of a package installed from a directory is kept: the
+    synced files (`.json`), the directory (`.origin`), and whether they
+    changed since the last successful build (`.pending`).
+    """
+
+    return paths.cache / "sync" / f"{package_name.replace('/', '__')}{suffix}"
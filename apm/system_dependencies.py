@@ -0,0 +1,188 @@
+"""
+A package's system dependencies: apt packages, `apt build-dep`, pip
+packages and `requirements.txt`.
+"""
+
+import getpass
+import os
+import subprocess  # nosec B404
+import time
+
+from pathlib import Path
+
+from apm import events, log, timings
+from apm.log import fatal_error
+from .host import get_host_facts
+from .package import Package
+from .path import Paths
+
+DPKG_STATUS = Path("/var/lib/dpkg/status")
+
+# dpkg's status file modification time and the packages it listed.
+_apt_installed: tuple[int, list[str]] | None = None
+
+
+def system(command: str) -> int:
+    "`os.system`, reporting the command as a `--machine` event."
+
+    start = time.perf_counter()
+    status = os.system(log.debug(command))  # nosec B605
+    events.emit_command(command, os.waitstatus_to_exitcode(status), start)
+
+    return status
+
+
+def get_installed_apt_packages() -> list[str]:
+    """
+    Returns a list of the installed apt packages, remembered until dpkg's
+    status file changes.
+    """
+
+    global _apt_installed  # pylint: disable=global-statement
+
+    try:
+        status_mtime = DPKG_STATUS.stat().st_mtime_ns
+
+    except OSError:
+        status_mtime = None
+
+    if _apt_installed is not None and _apt_installed[0] == status_mtime:
+        return _apt_installed[1]
+
+    aptinstalled = []
+
+    dpkg_output = subprocess.check_output(
+        "dpkg -l".split()
+    ).decode()  # nosec B603
+
+    for i in dpkg_output.split("\n"):
+        if i.strip() != "" and i.startswith("ii"):
+            try:
+                i = i.split("  ")[1]
+
+                if i.strip() not in aptinstalled:
+                    aptinstalled.append(i.strip())
+
+            except IndexError:
+                fatal_error(i)
+
+    if status_mtime is not None:
+        _apt_installed = (status_mtime, aptinstalled)
+
+    return aptinstalled
+
+
+def apt_filter_uninstalled(deps: list[str]) -> list[str]:
+    """Filter out installed packages"""
+    aptinstalled = get_installed_apt_packages()
+
+    return list(filter(lambda dep: dep not in aptinstalled, deps))
+
+
+def am_not_root() -> bool:
+    """Returns whether the user needs to use `sudo`."""
+
+    username = getpass.getuser()
+
+    return username != "root" and not username.startswith("u0_a")
+
+
+def install_apt_dependencies(deps: dict[str, list[str]]) -> None:
+    """Installs a package's apt dependencies."""
+
+    if "apt" not in deps:
+        return
+
+    if deps["apt"] is None:
+        return
+
+    filtered_deps = apt_filter_uninstalled(deps["apt"])
+
+    if len(filtered_deps) > 0:
+        log.note(
+            "Found apt dependencies, installing..... (this will require your password)"
+        )
+
+        joined_deps = " ".join(filtered_deps)
+        sudo = "sudo " if am_not_root() else ""
+
+        if system(f"{sudo}apt install -y {joined_deps}"):
+            fatal_error("apt subprocess encountered an error.")
+
+
+def install_apt_build_dep_dependencies(deps: dict[str, list[str]]) -> None:
+    """Install's a packages `apt build-dep` dependencies."""
+
+    if "build-dep" not in deps:
+        return
+
+    if deps["build-dep"]:
+        log.note(
+            "Found build-dep (apt) dependencies, installing..... (this will require your password)"
+        )
+
+        joined_deps = " ".join(deps["build-dep"])
+        sudo = "sudo " if am_not_root() else ""
+
+        if system(f"{sudo}apt build-dep -y {joined_deps}"):
+            fatal_error("apt subprocess encountered an error.")
+
+
+def install_pip_dependencies(deps: dict[str, list[str]]) -> None:
+    """Installs a package's `pip` dependencies."""
+
+    if "pip" not in deps:
+        return
+
+    if deps["pip"] is None:
+        return
+
+    log.note("Found pip dependencies, installing.....")
+    joined_deps = " ".join(deps["pip"])
+
+    on_gentoo = os.path.exists("/etc/portage")
+    user_flag = " --user" if on_gentoo else ""
+
+    system(f"python3 -m pip install{user_flag} {joined_deps}")
+
+
+def install_requirements_dot_txt(package_name: str, paths: Paths) -> None:
+    """Installs a package's pip depdencies as specified in `requirements.txt`."""
+
+    log.debug(paths.source / package_name / "requirements.txt")
+    log.debug(os.curdir)
+
+    if (paths.source / package_name / "requirements.txt").exists():
+        log.note("Requirements.txt found, installing.....")
+
+        on_gentoo = os.path.exists("/etc/portage")
+        user_flag = " --user" if on_gentoo else ""
+
+        req_txt = paths.source / package_name / "requirements.txt"
+
+        system(
+            f"python3 -m pip --disable-pip-version-check -q install{user_flag} -r {req_txt}"
+        )
+
+
+def install_system_dependencies(
+    paths: Paths, package_name: str, package: Package
+) -> None:
+    """Installs a package's apt and pip dependencies and `requirements.txt`."""
+
+    if package.deps:
+        dependencies = package.deps
+
+        if get_host_facts(paths).package_manager == "apt":
+            with timings.phase("apt"):
+                install_apt_dependencies(dependencies)
+
+            with timings.phase("build-dep"):
+                install_apt_build_dep_dependencies(dependencies)
+
+        with timings.phase("pip"):
+            install_pip_dependencies(dependencies)
+
+    with timings.phase("requirements.txt"):
+        install_requirements_dot_txt(package_name, paths)
+    # TODO: install_poetry_dependencies
@@ -0,0 +1,203 @@
+"""
+Phase timings for installs, updates and compilation.
+
+Phases nest, so a dependency installed while its parent is installing
+shows up underneath the parent's `dependencies` phase. The nesting is
+kept in a context variable, so it carries over to `asyncio.to_thread`.
+
+CPU time is that of the phase's thread and of the subprocesses that
+finished during it. Subprocesses of phases running at the same time are
+counted in each of them.
+"""
+
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator
+
+from apm import events, log
+
+IS_ENABLED = False
+
+_EPOCH = time.perf_counter()
+
+
+@dataclass
+class Phase:
+    "A single timed phase."
+
+    name: str
+    start: float
+    depth: int
+    thread: int
+    args: dict[str, str] = field(default_factory=dict)
+    wall: float = 0.0
+    cpu: float = 0.0
+
+
+_phases: list[Phase] = []
+_depth: ContextVar[int] = ContextVar("depth", default=0)
+_lock = threading.Lock()
+
+
+def _cpu_time() -> float:
+    "CPU time used by this thread and waited-for children (git, apt, ...)"
+
+    times = os.times()
+
+    return time.thread_time() + times.children_user + times.children_system
+
+
+@contextmanager
+def phase(name: str, **args: str) -> Iterator[None]:
+    """
+    Time the enclosed block as the phase `name`, if timings are enabled,
+    and emit its start and end as `--machine` events.
+    """
+
+    if not (IS_ENABLED or events.IS_ENABLED):
+        yield
+        return
+
+    depth = _depth.get()
+    record = Phase(
+        name,
+        time.perf_counter() - _EPOCH,
+        depth,
+        threading.get_ident(),
+        args,
+    )
+
+    if IS_ENABLED:
+        with _lock:
+            _phases.append(record)
+
+    events.emit("phase_start", phase=name, **args)
+    token = _depth.set(depth + 1)
+    cpu_start = _cpu_time()
+    succeeded = False
+
+    try:
+        yield
+        succeeded = True
+
+    finally:
+        record.cpu = _cpu_time() - cpu_start
+        record.wall = time.perf_counter() - _EPOCH - record.start
+        _depth.reset(token)
+        events.emit(
+            "phase_end",
+            phase=name,
+            **args,
+            ok=succeeded,
+            seconds=round(record.wall, 6),
+            cpu=round(record.cpu, 6),
+        )
+
+
+def get_phases() -> list[Phase]:
+    "All phases recorded so far, in the order that they started."
+
+    with _lock:
+        return list(_phases)
+
+
+def reset() -> None:
+    "Forget all recorded phases."
+
+    with _lock:
+        _phases.clear()
+
+
+def format_summary(phases: list[Phase]) -> str:
+    "Format `phases` as an indented table of wall-clock and CPU time."
+
+    rows = [
+        (
+            "  " * record.depth
+            + record.name
+            + "".join(f" {value}" for value in record.args.values()),
+            record.wall,
+            record.cpu,
+        )
+        for record in phases
+    ]
+
+    width = max([len("Phase")] + [len(row[0]) for row in rows])
+    lines = [f"{'Phase':<{width}}  {'Wall (s)':>9}  {'CPU (s)':>9}"]
+
+    for label, wall, cpu in rows:
+        lines.append(f"{label:<{width}}  {wall:>9.3f}  {cpu:>9.3f}")
+
+    return "\n".join(lines)
+
+
+def to_chrome_trace(phases: list[Phase]) -> dict[str, Any]:
+    "Convert `phases` to the Chrome trace-event format, for Perfetto."
+
+    pid = os.getpid()
+
+    return {
+        "displayTimeUnit": "ms",
+        "traceEvents": [
+            {
+                "name": record.name,
+                "cat": "apm",
+                "ph": "X",
+                "ts": round(record.start * 1_000_000),
+                "dur": round(record.wall * 1_000_000),
+                "pid": pid,
+                "tid": record.thread,
+                "args": {**record.args, "cpu_ms": round(record.cpu * 1000, 3)},
+            }
+            for record in phases
+        ],
+    }
+
+
+def write_chrome_trace(trace_path: Path, phases: list[Phase]) -> None:
+    "Write `phases` to `trace_path` as a Chrome trace-event JSON file."
+
+    trace_path.write_text(
+        json.dumps(to_chrome_trace(phases)), encoding="utf-8"
+    )
+
+
+@contextmanager
+def session(enabled: bool) -> Iterator[None]:
+    """
+    Record phases for the enclosed command and report them once it
+    finishes, even when it exits through `fatal_error`.
+
+    The trace file is only written if `AVALON_TRACE` is set.
+    """
+
+    global IS_ENABLED  # pylint: disable=global-statement
+
+    if not enabled:
+        yield
+        return
+
+    IS_ENABLED = True
+    reset()
+
+    try:
+        yield
+
+    finally:
+        IS_ENABLED = False
+        phases = get_phases()
+
+        if phases:
+            log.IS_SILENT = False
+            log.note(format_summary(phases))
+
+        if trace_path := os.environ.get("AVALON_TRACE"):
+            write_chrome_trace(Path(trace_path).expanduser(), phases)
+            log.note("Wrote Chrome trace to", trace_path)
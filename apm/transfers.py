@@ -0,0 +1,397 @@
+"""
+Progress and statistics for the clones and fetches of package sources.
+
+git runs with `--progress` and its progress output is parsed, so that a
+slow download shows how far along it is on a terminal. The size, object
+count and throughput of the last clone and fetch of each package are
+kept in `transfers.json` in the Avalon cache, and `apm transfers` lists
+them, largest first, to find repositories worth a shallow or sparse
+checkout.
+"""
+
+import os
+import re
+import shutil
+import subprocess  # nosec B404
+import sys
+import threading
+import time
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from apm import events, log
+from apm.blobs import format_size
+from apm.config import load_config
+from apm.files import read_json_cache, write_json_cache
+from apm.git import TIMED_OUT, git_output
+from apm.locks import STATE, lock
+from apm.network import (
+    get_host,
+    get_remaining,
+    is_transient_git_error,
+    record_failure,
+    record_success,
+    start_attempt,
+    wait_before_retry,
+)
+from apm.path import Paths
+
+UNITS = {"bytes": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3}
+# e.g. `Receiving objects:  45% (450/1000), 1.20 MiB | 2.00 MiB/s`
+PROGRESS = re.compile(
+    r"(?:Receiving|Unpacking) objects:\s+(\d+)% \((\d+)/(\d+)\)"
+    r"(?:, ([\d.]+) (bytes|KiB|MiB|GiB))?"
+    r"(?: \| ([\d.]+) (bytes|KiB|MiB|GiB)/s)?"
+)
+# How often the progress line is redrawn, in seconds.
+REDRAW_INTERVAL = 0.1
+
+
+@dataclass
+class Transfer:  # pylint: disable=too-many-instance-attributes
+    "A clone or fetch of a package's source."
+
+    package: str
+    operation: str
+    shallow: bool = False
+    partial: bool = False
+    received: int = 0
+    objects: int = 0
+    total_objects: int = 0
+    percent: int = 0
+    seconds: float = 0.0
+    messages: list[str] = field(default_factory=list)
+
+    @property
+    def throughput(self) -> float:
+        "Average bytes per second."
+
+        return self.received / self.seconds if self.seconds else 0.0
+
+    def to_record(self) -> dict[str, Any]:
+        "What is kept in `transfers.json`."
+
+        return {
+            "bytes": self.received,
+            "objects": self.objects,
+            "seconds": round(self.seconds, 3),
+            "throughput": round(self.throughput),
+            "shallow": self.shallow,
+            "partial": self.partial,
+            "time": time.time(),
+        }
+
+
+def parse_progress(transfer: Transfer, line: str) -> None:
+    "Update `transfer` from a line of git's progress output."
+
+    match = PROGRESS.search(line)
+
+    if match is None:
+        # Counters of other phases are noise, anything else may be an error.
+        if line and "% (" not in line:
+            transfer.messages.append(line)
+
+        return
+
+    percent, objects, total_objects, size, unit = match.groups()[:5]
+    transfer.percent = int(percent)
+    transfer.objects = int(objects)
+    transfer.total_objects = int(total_objects)
+
+    if size is not None:
+        transfer.received = round(float(size) * UNITS[unit])
+
+
+def get_directory_size(directory: Path) -> int:
+    "The total size of the files in `directory`."
+
+    total = 0
+
+    for root, _dirs, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+
+            except OSError:
+                pass
+
+    return total
+
+
+_active: list[Transfer] = []
+_display_lock = threading.Lock()
+_last_draw: float = 0.0
+
+
+def format_progress(transfers: list[Transfer], width: int) -> str:
+    "A line describing `transfers`, cut to `width` characters."
+
+    parts = []
+
+    for transfer in transfers:
+        part = f"{transfer.package} {transfer.percent}%"
+
+        if transfer.total_objects:
+            part += f" ({transfer.objects}/{transfer.total_objects})"
+
+        if transfer.received:
+            part += f" {format_size(transfer.received)}"
+
+        parts.append(part)
+
+    return ("Downloading " + ", ".join(parts))[:width]
+
+
+def draw_progress(force: bool = False) -> None:
+    "Redraw the progress line of the running transfers on a terminal."
+
+    global _last_draw  # pylint: disable=global-statement
+
+    if log.IS_SILENT or events.IS_STREAMING or not sys.stderr.isatty():
+        return
+
+    with _display_lock:
+        now = time.monotonic()
+
+        if not force and now - _last_draw < REDRAW_INTERVAL:
+            return
+
+        _last_draw = now
+        line = ""
+
+        if _active:
+            width = shutil.get_terminal_size().columns - 1
+            line = format_progress(_active, width)
+
+        sys.stderr.write(f"\r\033[K{line}")
+        sys.stderr.flush()
+
+
+def run_transfer(
+    transfer: Transfer,
+    command: list[str],
+    cwd: Path | None,
+    timeout: float | None = None,
+) -> int:
+    """
+    Run a git command, following its progress and stopping it after
+    `timeout` seconds, if given. Returns its exit status.
+    """
+
+    log.debug(" ".join(command))
+    start = time.perf_counter()
+
+    with _display_lock:
+        _active.append(transfer)
+
+    try:
+        with subprocess.Popen(  # nosec B603
+            command, cwd=cwd, stderr=subprocess.PIPE
+        ) as process:
+            assert process.stderr is not None  # nosec B101
+            timer = threading.Timer(timeout or 0, process.kill)
+
+            if timeout is not None:
+                timer.start()
+
+            descriptor = process.stderr.fileno()
+            pending = b""
+
+            try:
+                while chunk := os.read(descriptor, 65536):
+                    *lines, pending = re.split(rb"[\r\n]", pending + chunk)
+
+                    for line in lines:
+                        parse_progress(transfer, line.decode(errors="replace"))
+
+                    draw_progress()
+
+                parse_progress(transfer, pending.decode(errors="replace"))
+
+            finally:
+                timer.cancel()
+
+    finally:
+        transfer.seconds = time.perf_counter() - start
+
+        with _display_lock:
+            _active.remove(transfer)
+
+        draw_progress(force=True)
+
+    status = process.returncode
+
+    if timeout is not None and transfer.seconds >= timeout and status < 0:
+        transfer.messages.append(
+            f"git {command[1]} passed the network deadline."
+        )
+        status = TIMED_OUT
+
+    events.emit_command(command, status, start)
+
+    return status
+
+
+def get_remote_host(
+    package_dir: Path, operation: str, options: list[str]
+) -> str:
+    "The host that a clone (of its second to last argument) or fetch uses."
+
+    if operation == "clone":
+        url = options[-2]
+
+    else:
+        url = git_output("remote", "get-url", "origin", cwd=package_dir) or ""
+
+    return get_host(url.strip())
+
+
+def git_transfer(paths: Paths, package_name: str, *args: str | Path) -> int:
+    """
+    Run `git <args>`, a clone or fetch into the source of `package_name`,
+    showing its progress and recording its statistics if it succeeds.
+    Returns its exit status.
+    """
+
+    package_dir = paths.source / package_name
+    operation, *options = map(str, args)
+    host = get_remote_host(package_dir, operation, options)
+    retries = max(load_config(paths).network_retries, 0)
+    size_before = get_directory_size(package_dir / ".git")
+    attempt = 0
+
+    while True:
+        if not start_attempt(host):
+            log.warn(f"Skipping {host} after repeated failures.")
+            return 1
+
+        remaining = get_remaining()
+
+        if remaining is not None and remaining <= 0:
+            log.warn(
+                f"The network deadline passed before {package_name} was "
+                "downloaded."
+            )
+            return TIMED_OUT
+
+        transfer = Transfer(
+            package_name,
+            operation,
+            shallow="--depth" in options,
+            partial=any(option.startswith("--filter") for option in options),
+        )
+        status = run_transfer(
+            transfer,
+            ["git", operation, "--progress", *options],
+            package_dir if operation != "clone" else None,
+            remaining,
+        )
+
+        if not status:
+            record_success(host)
+            break
+
+        transient = is_transient_git_error(transfer.messages)
+
+        if transient:
+            record_failure(host)
+
+        if (
+            not transient
+            or attempt >= retries
+            or not wait_before_retry(host, attempt)
+        ):
+            for message in transfer.messages:
+                print(message, file=sys.stderr)
+
+            return status
+
+        for message in transfer.messages:
+            log.debug(message)
+
+        attempt += 1
+
+    for message in transfer.messages:
+        log.debug(message)
+
+    if not transfer.received:
+        # git leaves the size out when a transfer finishes quickly.
+        transfer.received = max(
+            get_directory_size(package_dir / ".git") - size_before, 0
+        )
+
+    record_transfer(paths, transfer)
+    events.emit(
+        "transfer",
+        package=package_name,
+        operation=operation,
+        **transfer.to_record(),
+    )
+
+    return status
+
+
+def read_transfers(paths: Paths) -> dict[str, dict[str, dict[str, Any]]]:
+    "The recorded transfers of each package, by operation."
+
+    return read_json_cache(paths.cache / "transfers.json")
+
+
+def record_transfer(paths: Paths, transfer: Transfer) -> None:
+    "Keep the statistics of a finished transfer."
+
+    with lock(paths, STATE):
+        transfers = read_transfers(paths)
+        transfers.setdefault(transfer.package, {})[
+            transfer.operation
+        ] = transfer.to_record()
+
+        write_json_cache(paths.cache / "transfers.json", transfers)
+
+
+def format_transfers(transfers: dict[str, dict[str, dict[str, Any]]]) -> str:
+    "Format recorded transfers as a table, largest first."
+
+    rows = sorted(
+        (
+            (package, operation, record)
+            for package, operations in transfers.items()
+            for operation, record in operations.items()
+        ),
+        key=lambda row: -int(row[2]["bytes"]),
+    )
+    width = max([len("Package")] + [len(package) for package, _, _ in rows])
+    lines = [
+        f"{'Package':<{width}}  {'Op':<5}  {'Size':>10}  {'Objects':>8}  "
+        f"{'Time (s)':>8}  {'Rate':>12}  History"
+    ]
+
+    for package, operation, record in rows:
+        history = "shallow" if record["shallow"] else "full"
+
+        if record["partial"]:
+            history += ", blobs on demand"
+
+        lines.append(
+            f"{package:<{width}}  {operation:<5}  "
+            f"{format_size(record['bytes']):>10}  {record['objects']:>8}  "
+            f"{record['seconds']:>8.1f}  "
+            f"{format_size(record['throughput']) + '/s':>12}  {history}"
+        )
+
+    return "\n".join(lines)
+
+
+def list_transfers(_flags: Any, paths: Paths, *_args: str) -> None:
+    "Print the last clone and fetch of each package, largest first"
+
+    transfers = read_transfers(paths)
+
+    if not transfers:
+        log.note("No downloads have been recorded yet.")
+        return
+
+    print(format_transfers(transfers))
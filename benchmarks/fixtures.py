@@ -0,0 +1,217 @@
+"""
+Hermetic fixtures for the benchmark suite.
+
+Everything apm would normally fetch from GitHub is built locally: package
+repositories are served over `file://`, a synthetic AvalonPMPackages
+repository stands in for the metadata repository and a local HTTP server
+plays raw.githubusercontent.com.
+"""
+
+import json
+import os
+import subprocess  # nosec B404
+import threading
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Iterator
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "apm-bench",
+    "GIT_AUTHOR_EMAIL": "apm-bench@localhost",
+    "GIT_COMMITTER_NAME": "apm-bench",
+    "GIT_COMMITTER_EMAIL": "apm-bench@localhost",
+    "GIT_CONFIG_NOSYSTEM": "1",
+}
+
+CHANGELOG = """# Changelog
+
+## [Unreleased]
+
+## [1.1.0] - 2024-02-01
+
+### Added
+- Something new.
+
+## [1.0.0] - 2024-01-01
+
+### Added
+- Initial release.
+"""
+
+
+@dataclass
+class FixturePackage:
+    "A package repository built for the benchmarks."
+
+    author: str
+    repo: str
+    deps: list[str]
+
+    @property
+    def name(self) -> str:
+        "`author/repo`, lowercased like apm does."
+
+        return f"{self.author}/{self.repo}".lower()
+
+    def metadata(self) -> dict[str, Any]:
+        "The package's `.avalon/package`."
+
+        return {
+            "version": "1.1.0",
+            "author": self.author,
+            "repo": self.repo,
+            "binname": self.repo.lower(),
+            "binfile": "bin/run.sh",
+            "needsCompiled": False,
+            "toCopy": ["bin", "share"],
+            "deps": {"avalon": self.deps},
+            "arches": ["all"],
+            "distros": ["all"],
+        }
+
+
+def git(cwd: Path, *args: str) -> None:
+    "Run git quietly in `cwd` with a fixed identity."
+
+    subprocess.run(  # nosec B603 B607
+        ["git", *args],
+        cwd=cwd,
+        env={**os.environ, **GIT_ENV},
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def commit_all(repo_dir: Path, message: str) -> None:
+    "Commit everything in `repo_dir`."
+
+    git(repo_dir, "add", "-A")
+    git(repo_dir, "commit", "-q", "-m", message)
+
+
+def build_package_repository(git_root: Path, package: FixturePackage) -> Path:
+    "Create the git repository for `package` under `git_root`."
+
+    repo_dir = git_root / package.name
+    (repo_dir / ".avalon").mkdir(parents=True)
+    (repo_dir / "bin").mkdir()
+    (repo_dir / "share").mkdir()
+
+    (repo_dir / ".avalon/package").write_text(json.dumps(package.metadata()))
+    (repo_dir / "CHANGELOG.md").write_text(CHANGELOG)
+    (repo_dir / "bin/run.sh").write_text("#!/bin/sh\necho ok\n")
+
+    for index in range(50):
+        (repo_dir / "share" / f"asset{index}.txt").write_text(
+            "x" * 1024 * index
+        )
+
+    git(repo_dir, "init", "-q", "-b", "master")
+    commit_all(repo_dir, "Initial commit")
+
+    return repo_dir
+
+
+def build_metadata_repository(
+    git_root: Path,
+    raw_root: Path,
+    packages: list[FixturePackage],
+    entries: int,
+) -> None:
+    """
+    Create a synthetic AvalonPMPackages with `entries` filler packages,
+    and mirror its files under `raw_root` for the HTTP server.
+    """
+
+    repo_dir = git_root / "r2boyo25" / "AvalonPMPackages"
+    raw_dir = raw_root / "R2Boyo25" / "AvalonPMPackages" / "master"
+
+    for index in range(entries):
+        author, repo = f"user{index % 100}", f"package{index}"
+        metadata = json.dumps(
+            {
+                "author": author,
+                "repo": repo,
+                "version": "0.1.0",
+                "binname": repo,
+                "arches": ["all"],
+                "distros": ["all"],
+            }
+        )
+
+        for root in (repo_dir, raw_dir):
+            (root / author / repo).mkdir(parents=True, exist_ok=True)
+            (root / author / repo / "package").write_text(metadata)
+
+    for package in packages:
+        package_raw_dir = raw_root / package.name / "master" / ".avalon"
+        package_raw_dir.mkdir(parents=True)
+        (package_raw_dir / "package").write_text(
+            json.dumps(package.metadata())
+        )
+
+    git(repo_dir, "init", "-q", "-b", "master")
+    commit_all(repo_dir, "Synthetic metadata")
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    "Static file handler that does not log every request to stderr."
+
+    def log_message(self, *_args: Any) -> None:
+        return
+
+
+@contextmanager
+def raw_server(raw_root: Path) -> Iterator[str]:
+    "Serve `raw_root` on a random local port, yielding its base URL."
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(QuietHandler, directory=str(raw_root))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def hermetic_environment(
+    root: Path, git_root: Path, raw_url: str
+) -> dict[str, str]:
+    """
+    Environment for running apm against the fixtures only.
+
+    Any HTTPS request that escapes the fixtures is sent to a dead proxy and
+    git may only use `file://`, so an accidental network access fails
+    instead of silently skewing the numbers.
+    """
+
+    home = root / "home"
+    home.mkdir(exist_ok=True)
+    (root / "tmp").mkdir(exist_ok=True)
+
+    return {
+        **os.environ,
+        **GIT_ENV,
+        "HOME": str(home),
+        "XDG_CONFIG_HOME": str(home / ".config"),
+        "XDG_CACHE_HOME": str(home / ".cache"),
+        "TMPDIR": str(root / "tmp"),
+        "AVALON_BIN": str(home / "bin"),
+        "AVALON_GIT_URL": git_root.as_uri(),
+        "AVALON_RAW_URL": raw_url,
+        "GIT_ALLOW_PROTOCOL": "file",
+        "HTTPS_PROXY": "http://127.0.0.1:9",
+        "HTTP_PROXY": "http://127.0.0.1:9",
+        "NO_PROXY": "127.0.0.1,localhost",
+        "PYTHONPATH": str(Path(__file__).resolve().parent.parent),
+    }
@@ -0,0 +1,234 @@
+"""
+End-to-end benchmarks for the apm CLI.
+
+Runs `install`, `update`, `uninstall`, `installed` and `changes` against
+hermetic fixtures (see `fixtures.py`), compares the median latency of each
+case against `baseline.json` and exits non-zero if any case regressed by
+more than the threshold, or if there is no baseline. No network access
+is needed.
+
+    python benchmarks/run.py [--iterations N] [--threshold 0.25]
+                             [--entries 5000] [--update-baseline]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess  # nosec B404
+import sys
+import tempfile
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from fixtures import (
+    FixturePackage,
+    build_metadata_repository,
+    build_package_repository,
+    hermetic_environment,
+    raw_server,
+)
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baseline.json"
+
+PACKAGES = [
+    FixturePackage("Bench", "Leaf", []),
+    FixturePackage("Bench", "Middle", ["Bench/Leaf"]),
+    FixturePackage("Bench", "App", ["Bench/Middle"]),
+]
+
+
+@dataclass
+class Case:
+    "A benchmarked command, with an untimed setup step run before each sample."
+
+    name: str
+    argv: list[str]
+    setup: list[str] | None = None
+
+
+CASES = [
+    Case("install", ["--fresh", "install", "bench/app"]),
+    Case("update", ["update", "bench/app"], setup=["install", "bench/app"]),
+    Case(
+        "uninstall",
+        ["uninstall", "bench/leaf"],
+        setup=["install", "bench/leaf"],
+    ),
+    Case("installed", ["installed"], setup=["install", "bench/app"]),
+    Case("changes", ["changes", "bench/app"], setup=["install", "bench/app"]),
+]
+
+
+@dataclass
+class Result:
+    "Timings for one case."
+
+    name: str
+    samples: list[float]
+
+    @property
+    def median(self) -> float:
+        "Median latency in seconds."
+
+        return statistics.median(self.samples)
+
+    @property
+    def throughput(self) -> float:
+        "Commands per second."
+
+        return len(self.samples) / sum(self.samples)
+
+
+def make_runner(
+    env: dict[str, str], cwd: Path
+) -> Callable[[list[str]], float]:
+    "Return a function that runs apm with `argv` and returns how long it took."
+
+    def run(argv: list[str]) -> float:
+        start = time.perf_counter()
+        process = subprocess.run(  # nosec B603
+            [sys.executable, "-m", "apm", "--machine", *argv],
+            cwd=cwd,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            check=False,
+        )
+        elapsed = time.perf_counter() - start
+
+        if process.returncode:
+            sys.exit(
+                f"`apm {' '.join(argv)}` failed ({process.returncode}):\n"
+                + process.stdout.decode(errors="replace")
+                + process.stderr.decode(errors="replace")
+            )
+
+        return elapsed
+
+    return run
+
+
+def run_cases(
+    run: Callable[[list[str]], float], iterations: int
+) -> list[Result]:
+    "Run every case `iterations` times, after one untimed warm-up run."
+
+    results = []
+
+    for case in CASES:
+        samples = []
+
+        for index in range(iterations + 1):
+            if case.setup:
+                run(case.setup)
+
+            elapsed = run(case.argv)
+
+            if index:
+                samples.append(elapsed)
+
+        results.append(Result(case.name, samples))
+
+    return results
+
+
+def compare(
+    results: list[Result], baseline: dict[str, float], threshold: float
+) -> bool:
+    "Print `results` against `baseline`, returning whether any case regressed."
+
+    regressed = False
+    print(
+        f"{'Case':<10}  {'Median (s)':>10}  {'Ops/s':>7}  {'Baseline':>8}  "
+        "Change"
+    )
+
+    for result in results:
+        line = (
+            f"{result.name:<10}  {result.median:>10.3f}  "
+            f"{result.throughput:>7.2f}"
+        )
+
+        if result.name not in baseline:
+            print(line + f"  {'-':>8}  -")
+            continue
+
+        change = result.median / baseline[result.name] - 1
+        line += f"  {baseline[result.name]:>8.3f}  {change:+.1%}"
+
+        if change > threshold:
+            line += "  REGRESSION"
+            regressed = True
+
+        print(line)
+
+    return regressed
+
+
+def main() -> None:
+    "Build the fixtures, run the benchmarks and check them for regressions."
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="allowed slowdown of the median, as a fraction of the baseline",
+    )
+    parser.add_argument(
+        "--entries",
+        type=int,
+        default=5000,
+        help="number of packages in the synthetic metadata repository",
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    options = parser.parse_args()
+
+    if not options.update_baseline and not BASELINE_PATH.exists():
+        sys.exit(
+            f"No baseline at {BASELINE_PATH} to check for regressions. "
+            "Record one with --update-baseline on the reference machine."
+        )
+
+    with tempfile.TemporaryDirectory(prefix="apm-bench-") as temp:
+        root = Path(temp)
+        git_root = root / "git"
+        raw_root = root / "raw"
+
+        for package in PACKAGES:
+            build_package_repository(git_root, package)
+
+        build_metadata_repository(
+            git_root, raw_root, PACKAGES, options.entries
+        )
+
+        with raw_server(raw_root) as raw_url:
+            env = hermetic_environment(root, git_root, raw_url)
+            work_dir = root / "work"
+            work_dir.mkdir()
+
+            results = run_cases(make_runner(env, work_dir), options.iterations)
+
+    if options.update_baseline:
+        BASELINE_PATH.write_text(
+            json.dumps(
+                {result.name: round(result.median, 4) for result in results},
+                indent=4,
+            )
+            + "\n"
+        )
+        print(f"Wrote {BASELINE_PATH}")
+        return
+
+    if compare(
+        results, json.loads(BASELINE_PATH.read_text()), options.threshold
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import json
+
+from pathlib import Path
+
+import pytest
+
+from apm import archive
+from apm.archive import Archive, ArchiveError
+
+
+def make_package(root: Path) -> Path:
+    (root / ".avalon").mkdir(parents=True)
+    (root / ".git").mkdir()
+    (root / ".git/HEAD").write_text("ref: refs/heads/master\n")
+    (root / ".avalon/package").write_text('{"author": "a", "repo": "b"}')
+    (root / "run.sh").write_text("#!/bin/sh\n")
+    (root / "run.sh").chmod(0o755)
+    (root / "big.bin").write_bytes(bytes(range(256)) * 10000)
+    (root / "link").symlink_to("run.sh")
+
+    return root
+
+
+def test_pack_and_extract(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(archive, "CHUNK_SIZE", 4096)
+    src = make_package(tmp_path / "src")
+    archive.pack(src, tmp_path / "b.apm")
+
+    assert archive.is_archive(tmp_path / "b.apm")
+
+    with Archive(tmp_path / "b.apm") as package:
+        assert ".git/HEAD" not in package.entries
+        assert len(package.entries["big.bin"].chunks) > 1
+        assert (
+            package.read(".avalon/package") == b'{"author": "a", "repo": "b"}'
+        )
+
+        package.extract(tmp_path / "out", jobs=4)
+
+    assert (tmp_path / "out/big.bin").read_bytes() == (
+        src / "big.bin"
+    ).read_bytes()
+    assert (tmp_path / "out/run.sh").stat().st_mode & 0o777 == 0o755
+    assert (tmp_path / "out/link").readlink() == Path("run.sh")
+
+
+def test_corrupt_chunk(tmp_path: Path) -> None:
+    src = make_package(tmp_path / "src")
+    archive.pack(src, tmp_path / "b.apm")
+
+    data = bytearray((tmp_path / "b.apm").read_bytes())
+    data[-1] ^= 0xFF
+    (tmp_path / "b.apm").write_bytes(bytes(data))
+
+    with Archive(tmp_path / "b.apm") as package, pytest.raises(ArchiveError):
+        package.extract(tmp_path / "out")
+
+
+def write_archive(path: Path, manifest: object) -> None:
+    data = json.dumps(manifest).encode()
+    path.write_bytes(archive.HEADER.pack(archive.MAGIC, len(data)) + data)
+
+
+@pytest.mark.parametrize(
+    "manifest",
+    [
+        [],
+        {"version": 1},
+        {"files": [{"mode": 0o644}]},
+        {"files": [{"path": "a", "mode": "rwx"}]},
+        {"files": [{"path": "a", "chunks": [[0, 1]]}]},
+        {"files": [{"path": "a", "chunks": [["0", 1, 1, "", "zlib"]]}]},
+        {"files": ["a"]},
+    ],
+)
+def test_invalid_manifest(tmp_path: Path, manifest: object) -> None:
+    write_archive(tmp_path / "b.apm", manifest)
+
+    with pytest.raises(ArchiveError):
+        Archive(tmp_path / "b.apm")
+
+
+def test_special_modes_are_not_extracted(tmp_path: Path) -> None:
+    write_archive(
+        tmp_path / "b.apm",
+        {
+            "version": 1,
+            "files": [{"path": "run", "mode": 0o4755, "sha256": ""}],
+        },
+    )
+
+    with Archive(tmp_path / "b.apm") as package:
+        package.extract(tmp_path / "out")
+
+    assert (tmp_path / "out/run").stat().st_mode & 0o7777 == 0o755
+
+
+@pytest.mark.parametrize(
+    "files",
+    [
+        [
+            {"path": "a", "link": "../outside"},
+            {"path": "a/evil", "sha256": ""},
+        ],
+        [
+            {"path": "./a", "link": "../outside"},
+            {"path": "a/b/evil", "sha256": ""},
+        ],
+        [{"path": "../evil", "sha256": ""}],
+    ],
+)
+def test_entries_outside_the_destination_are_refused(
+    tmp_path: Path, files: list[dict[str, str]]
+) -> None:
+    write_archive(tmp_path / "b.apm", {"version": 1, "files": files})
+    (tmp_path / "out").mkdir()
+
+    with Archive(tmp_path / "b.apm") as package, pytest.raises(ArchiveError):
+        package.extract(tmp_path / "out")
+
+    assert not (tmp_path / "outside").exists()
+    assert not (tmp_path / "evil").exists()
+
+
+def test_existing_symlinks_are_not_followed(tmp_path: Path) -> None:
+    write_archive(
+        tmp_path / "b.apm",
+        {"version": 1, "files": [{"path": "a/evil", "sha256": ""}]},
+    )
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "out").mkdir()
+    (tmp_path / "out/a").symlink_to(tmp_path / "outside")
+
+    with Archive(tmp_path / "b.apm") as package, pytest.raises(ArchiveError):
+        package.extract(tmp_path / "out")
+
+    assert not (tmp_path / "outside/evil").exists()
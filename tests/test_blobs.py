@@ -0,0 +1,84 @@
+import os
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from apm import blobs
+from apm.generations import get_generations_dir
+from apm.path import Paths
+
+
+def make_paths(root: Path) -> Paths:
+    return Paths(
+        root=root / "root",
+        cache=root / "cache",
+        files=root / "files",
+        blobs=root / "files/.blobs",
+    )
+
+
+def test_link_from_store(tmp_path: Path) -> None:
+    paths = make_paths(tmp_path)
+    src = tmp_path / "src"
+    src.write_text("same")
+
+    blobs.link_from_store(paths, src, paths.files / "a/one/file")
+    blobs.link_from_store(paths, src, paths.files / "b/two/file")
+    blobs.link_from_store(paths, src, paths.files / "b/two/bin", mode=0o755)
+
+    assert os.path.samefile(
+        paths.files / "a/one/file", paths.files / "b/two/file"
+    )
+    assert not os.path.samefile(
+        paths.files / "a/one/file", paths.files / "b/two/bin"
+    )
+    assert (paths.files / "b/two/bin").stat().st_mode & 0o777 == 0o755
+    assert (paths.files / "a/one/file").stat().st_nlink == 3
+
+
+def test_dedupe_reports_reclaimed_bytes(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    paths = make_paths(tmp_path)
+
+    for package in ["a/one", "b/two", "c/three"]:
+        (paths.files / package).mkdir(parents=True)
+        (paths.files / package / "data").write_bytes(b"x" * 1000)
+        (paths.files / package / package[0]).write_text(package)
+
+    # Hardlinked files are only freed once all their links are replaced.
+    os.link(paths.files / "b/two/data", paths.files / "b/two/copy")
+
+    blobs.dedupe_packages(SimpleNamespace(), paths)
+
+    assert "Reclaimed 2.0 KiB" in capsys.readouterr().out
+    assert os.path.samefile(
+        paths.files / "a/one/data", paths.files / "c/three/data"
+    )
+    assert os.path.samefile(
+        paths.files / "a/one/data", paths.files / "b/two/copy"
+    )
+
+    (paths.files / "c/three/c").unlink()
+    blobs.dedupe_packages(SimpleNamespace(), paths)
+
+    assert "Reclaimed 7 B" in capsys.readouterr().out
+
+
+def test_dedupe_frees_files_hardlinked_across_generations(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    paths = make_paths(tmp_path)
+
+    for package in ["a/one", "b/two"]:
+        generations = get_generations_dir(paths, package)
+        (generations / "1").mkdir(parents=True)
+        (generations / "1/data").write_bytes(b"x" * 100 * 1024)
+        (generations / "2").mkdir()
+        os.link(generations / "1/data", generations / "2/data")
+
+    blobs.dedupe_packages(SimpleNamespace(), paths)
+
+    assert "Reclaimed 100.0 KiB" in capsys.readouterr().out
@@ -0,0 +1,87 @@
+import os
+import socket
+import sys
+import threading
+
+from pathlib import Path
+
+import pytest
+
+from apm import daemon as daemon_module
+from apm.daemon import NO_DAEMON, Daemon, forward_to_daemon, get_socket_path
+from apm.path import Paths, get_run_temp
+
+
+def test_commands_run_in_the_daemon(
+    tmp_path: Path,
+    capfd: pytest.CaptureFixture[str],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    pytest.importorskip("kazparse")
+    monkeypatch.delenv(NO_DAEMON, raising=False)
+    monkeypatch.chdir(tmp_path)
+    paths = Paths(cache=tmp_path / "cache")
+    seen: dict[str, str | None] = {}
+
+    def command(argv: list[str], _paths: Paths) -> None:
+        seen["cwd"] = os.getcwd()
+        seen["no daemon"] = os.environ.get(NO_DAEMON)
+        # Written straight to the file descriptor, like git or a script.
+        os.write(1, f"ran {' '.join(argv)}\n".encode())
+        sys.exit(3)
+
+    assert forward_to_daemon(paths, ["installed"]) is None
+
+    daemon = Daemon(paths, command)
+    daemon.bind()
+    server = threading.Thread(target=daemon.serve)
+    server.start()
+
+    try:
+        assert forward_to_daemon(paths, ["install", "a/tool"]) == 3
+        assert forward_to_daemon(paths, ["installed"]) == 3
+
+        # Paths and mirrors are fixed when the daemon starts.
+        monkeypatch.setenv("AVALON_BIN", str(tmp_path / "bin"))
+        assert forward_to_daemon(paths, ["installed"]) is None
+
+    finally:
+        daemon.close()
+        server.join()
+
+    assert capfd.readouterr().out == "ran install a/tool\nran installed\n"
+    assert seen == {"cwd": str(tmp_path), "no daemon": "1"}
+    assert os.environ.get(NO_DAEMON) is None
+    assert forward_to_daemon(paths, ["installed"]) is None
+
+
+def test_silent_clients_do_not_block_the_daemon(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.delenv(NO_DAEMON, raising=False)
+    monkeypatch.setattr(daemon_module, "RECEIVE_TIMEOUT", 0.1)
+    paths = Paths(cache=tmp_path / "cache", temp=tmp_path / "temp")
+    ran: list[list[str]] = []
+    temps: list[Path] = []
+
+    def command(argv: list[str], _paths: Paths) -> None:
+        ran.append(argv)
+        temps.append(get_run_temp(paths))
+
+    daemon = Daemon(paths, command)
+    daemon.bind()
+    server = threading.Thread(target=daemon.serve)
+    server.start()
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as silent:
+            silent.connect(str(get_socket_path(paths)))
+            assert forward_to_daemon(paths, ["installed"]) == 0
+
+    finally:
+        daemon.close()
+        server.join()
+
+    assert ran == [["installed"]]
+    # Deleted after each command, not when the daemon exits.
+    assert not temps[0].exists()
@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+from apm import events, log, timings
+
+
+def read_events(output: str) -> list[dict[str, object]]:
+    return [json.loads(line) for line in output.splitlines()]
+
+
+def test_session_emits_events(capfd: pytest.CaptureFixture[str]) -> None:
+    events.emit("ignored")
+
+    with events.session(True, "install", ("a/tool",)):
+        with timings.phase("compile", package="a/tool"):
+            log.note("Compiling.....")
+
+        # e.g. a build script, which must not corrupt the stream.
+        os.system("echo script output")  # nosec B605 B607
+
+    output, errors = capfd.readouterr()
+    emitted = read_events(output)
+
+    assert [event["event"] for event in emitted] == [
+        "start",
+        "phase_start",
+        "log",
+        "phase_end",
+        "result",
+    ]
+    assert emitted[0]["args"] == ["a/tool"]
+    assert emitted[2]["level"] == "note"
+    assert emitted[2]["message"] == "Compiling....."
+    assert emitted[3]["package"] == "a/tool" and emitted[3]["ok"]
+    assert emitted[4]["status"] == 0 and emitted[4]["ok"]
+    assert "script output" in errors
+    assert not events.IS_ENABLED
+
+
+def test_session_reports_exit_status(
+    capfd: pytest.CaptureFixture[str],
+) -> None:
+    with pytest.raises(SystemExit):
+        with events.session(True, "install", ()):
+            log.fatal_error("No such package.")
+
+    *_, error, result = read_events(capfd.readouterr().out)
+
+    assert error["level"] == "error"
+    assert result["status"] == 1 and not result["ok"]
+
+
+def test_disabled_session_prints_normally(
+    capfd: pytest.CaptureFixture[str],
+) -> None:
+    with events.session(False, "install", ()):
+        events.emit("ignored")
+        print("plain")
+
+    assert capfd.readouterr().out == "plain\n"
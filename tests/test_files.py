@@ -0,0 +1,50 @@
+import tarfile
+
+from pathlib import Path
+
+from apm.files import extract_tarball, replace_link, sync_directory
+
+
+def test_sync_directory(tmp_path: Path) -> None:
+    src, dst, manifest = (
+        tmp_path / "src",
+        tmp_path / "dst",
+        tmp_path / "sync.json",
+    )
+    (src / ".git").mkdir(parents=True)
+    (src / ".git/HEAD").write_text("ref: refs/heads/master\n")
+    (src / ".gitignore").write_text("build/\n")
+    (src / "main.c").write_text("int main() {}\n")
+    (src / "old.c").write_text("")
+
+    assert sync_directory(src, dst, manifest)
+    assert (dst / "main.c").read_text() == "int main() {}\n"
+    assert not (dst / ".git").exists()
+
+    (dst / "build").mkdir()
+    (dst / "build/main.o").write_text("")
+    assert not sync_directory(src, dst, manifest)
+
+    (src / "old.c").unlink()
+    assert sync_directory(src, dst, manifest)
+    assert not (dst / "old.c").exists()
+    assert (dst / "build/main.o").exists()
+
+
+def test_extract_tarball(tmp_path: Path) -> None:
+    (tmp_path / "package/.avalon").mkdir(parents=True)
+    (tmp_path / "package/.avalon/package").write_text("{}")
+
+    with tarfile.open(tmp_path / "package.tar.xz", "w:xz") as tar:
+        tar.add(tmp_path / "package", arcname=".")
+
+    extract_tarball(tmp_path / "package.tar.xz", tmp_path / "out")
+    assert (tmp_path / "out/.avalon/package").read_text() == "{}"
+
+
+def test_replace_link(tmp_path: Path) -> None:
+    (tmp_path / "link").symlink_to("a")
+    replace_link(tmp_path / "link", "b")
+
+    assert (tmp_path / "link").readlink() == Path("b")
+    assert [path.name for path in tmp_path.iterdir()] == ["link"]
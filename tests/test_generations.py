@@ -0,0 +1,93 @@
+import os
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from apm import generations
+from apm.path import Paths
+
+
+def make_paths(root: Path) -> Paths:
+    return Paths(
+        root=root / "root",
+        cache=root / "cache",
+        files=root / "files",
+        binaries=root / "bin",
+    )
+
+
+def stage(root: Path, version: str) -> Paths:
+    staged = Paths(
+        files=root / f"stage{version}/files",
+        binaries=root / f"stage{version}/bin",
+    )
+    (staged.files / "a/tool").mkdir(parents=True)
+    (staged.files / "a/tool/lib.so").write_text("unchanged")
+    (staged.files / "a/tool/tool").write_text(version)
+    staged.binaries.mkdir()
+    (staged.binaries / "tool").symlink_to(staged.files / "a/tool/tool")
+
+    return staged
+
+
+def test_publish_and_rollback(tmp_path: Path) -> None:
+    paths = make_paths(tmp_path)
+
+    assert generations.get_built_commit(paths, "a/tool") is None
+    assert (
+        generations.publish_generation(
+            paths, stage(tmp_path, "1"), "a/tool", "c1"
+        )
+        == 1
+    )
+    assert (paths.binaries / "tool").read_text() == "1"
+
+    assert (
+        generations.publish_generation(
+            paths, stage(tmp_path, "2"), "a/tool", "c2"
+        )
+        == 2
+    )
+    assert (paths.binaries / "tool").read_text() == "2"
+    assert generations.get_built_commit(paths, "a/tool") == "c2"
+
+    old, new = (
+        generations.get_generations_dir(paths, "a/tool")
+        / str(generation)
+        / "lib.so"
+        for generation in (1, 2)
+    )
+    assert os.path.samefile(old, new)
+
+    generations.rollback_package(SimpleNamespace(), paths, "a/tool")
+
+    assert generations.get_current_generation(paths, "a/tool") == 1
+    assert (paths.binaries / "tool").read_text() == "1"
+    assert (paths.files / "a/tool/tool").read_text() == "1"
+    assert generations.get_built_commit(paths, "a/tool") == "c1"
+
+    with pytest.raises(SystemExit):
+        generations.rollback_package(SimpleNamespace(), paths, "a/tool")
+
+
+def test_old_generations_are_collected(tmp_path: Path) -> None:
+    paths = make_paths(tmp_path)
+    paths.root.mkdir()
+    (paths.root / "config.json").write_text('{"keep_generations": 2}')
+
+    # A files directory from before generations becomes the first one.
+    (paths.files / "a/tool").mkdir(parents=True)
+
+    for version in "234":
+        generations.publish_generation(
+            paths, stage(tmp_path, version), "a/tool"
+        )
+
+    assert generations.list_generations(paths, "a/tool") == [3, 4]
+
+    generations.remove_generations(paths, "a/tool")
+
+    assert not (paths.files / "a/tool").exists()
+    assert not (paths.binaries / "tool").is_symlink()
@@ -0,0 +1,38 @@
+from pathlib import Path
+
+import pytest
+
+from apm import host
+from apm.host import HostFacts
+from apm.path import Paths
+
+
+@pytest.fixture(autouse=True)
+def forget_facts(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setattr(host, "_facts", None)
+    monkeypatch.setattr(host, "BOOT_ID", tmp_path / "boot_id")
+    (tmp_path / "boot_id").write_text("boot-1\n")
+
+
+def test_facts_are_cached_per_boot(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    paths = Paths(cache=tmp_path / "cache")
+    detected: list[None] = []
+
+    def detect() -> HostFacts:
+        detected.append(None)
+        return HostFacts("Debian", "x86_64", "apt")
+
+    monkeypatch.setattr(host, "detect_host_facts", detect)
+
+    assert host.get_host_facts(paths) == HostFacts("Debian", "x86_64", "apt")
+
+    monkeypatch.setattr(host, "_facts", None)
+    assert host.get_host_facts(paths).distro == "Debian"
+    assert len(detected) == 1
+
+    (tmp_path / "boot_id").write_text("boot-2\n")
+    monkeypatch.setattr(host, "_facts", None)
+    host.get_host_facts(paths)
+    assert len(detected) == 2
@@ -0,0 +1,64 @@
+import subprocess
+import sys
+
+from pathlib import Path
+
+import pytest
+
+# Microseconds that `import apm.cli` may take, as reported by -X importtime.
+BUDGET = 50_000
+
+HEAVY_MODULES = [
+    "requests",
+    "semver",
+    "keepachangelog",
+    "distro",
+    "gitignore_parser",
+]
+
+
+def import_times(module: str) -> dict[str, int]:
+    "Cumulative import time of every module imported by `module`."
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=Path(__file__).resolve().parent.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+def test_cli_does_not_import_heavy_modules() -> None:
+    pytest.importorskip("kazparse")
+    times = import_times("apm.cli")
+
+    assert not [module for module in HEAVY_MODULES if module in times]
+
+
+def test_cli_import_time() -> None:
+    pytest.importorskip("kazparse")
+
+    # Take the best of a few runs so that a busy machine does not fail it.
+    assert min(import_times("apm.cli")["apm.cli"] for _ in range(3)) < BUDGET
+
+
+def test_paths_do_not_create_directories(tmp_path: Path) -> None:
+    subprocess.run(
+        [sys.executable, "-c", "import apm.path"],
+        cwd=Path(__file__).resolve().parent.parent,
+        env={"HOME": str(tmp_path), "PATH": ""},
+        check=True,
+    )
+
+    assert not list(tmp_path.iterdir())
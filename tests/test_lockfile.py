@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import subprocess
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("kazparse")
+
+# pylint: disable=wrong-import-position
+from apm import generations, lockfile, metadata
+from apm.metadata import REFRESHED_STAMP
+from apm.path import Paths
+
+
+def run(*args: str | Path, cwd: Path) -> str:
+    return subprocess.run(
+        [str(arg) for arg in args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def make_repo(path: Path) -> str:
+    (path / ".avalon").mkdir(parents=True)
+    (path / ".avalon/package").write_text(
+        json.dumps({"author": "a", "repo": "tool", "toCopy": ["tool.sh"]})
+    )
+    (path / "tool.sh").write_text("echo 1\n")
+    run("git", "init", "-q", cwd=path)
+    run("git", "add", ".", cwd=path)
+    run(
+        "git",
+        "-c",
+        "user.name=a",
+        "-c",
+        "user.email=a@a",
+        "commit",
+        "-qm",
+        "1",
+        cwd=path,
+    )
+    run("git", "config", "uploadpack.allowAnySHA1InWant", "true", cwd=path)
+
+    return run("git", "rev-parse", "HEAD", cwd=path)
+
+
+@pytest.fixture(name="paths")
+def fixture_paths(tmp_path: Path) -> Paths:
+    paths = Paths(
+        root=tmp_path / "root",
+        cache=tmp_path / "cache",
+        source=tmp_path / "src",
+        binaries=tmp_path / "bin",
+        metadata=tmp_path / "metadata",
+        files=tmp_path / "files",
+        temp=tmp_path / "tmp",
+    )
+    (paths.metadata / ".git").mkdir(parents=True)
+    (paths.metadata / ".git" / REFRESHED_STAMP).touch()
+    paths.root.mkdir()
+    (paths.root / "config.json").write_text(
+        json.dumps({"mirrors": {"source": [f"file://{tmp_path / 'remote'}"]}})
+    )
+
+    return paths
+
+
+def test_sync_and_lock(paths: Paths, tmp_path: Path) -> None:
+    commit = make_repo(tmp_path / "remote/a/tool")
+    flags = SimpleNamespace(
+        debug=False, force=False, timings=False, machine=False, noinstall=False
+    )
+    lock = tmp_path / "avalon.lock"
+    lockfile.write_lockfile(
+        lock, {"a/tool": lockfile.LockedPackage(commit, None, None, [])}
+    )
+
+    lockfile.sync_packages(flags, paths, str(lock))
+
+    assert (paths.files / "a/tool/tool.sh").read_text() == "echo 1\n"
+    assert list((paths.cache / "builds").iterdir())
+    assert not list((paths.files / ".staging").iterdir())
+
+    lockfile.lock_packages(flags, paths, str(tmp_path / "new.lock"))
+    locked = lockfile.read_lockfile(tmp_path / "new.lock")["a/tool"]
+
+    assert locked.commit == commit
+    assert locked.metadata == lockfile.hash_metadata(paths, "a/tool")
+
+    # Nothing differs, so nothing is downloaded.
+    shutil.rmtree(tmp_path / "remote")
+    lockfile.sync_packages(flags, paths, str(tmp_path / "new.lock"))
+
+
+def test_prune_builds(paths: Paths) -> None:
+    (paths.root / "config.json").write_text(
+        json.dumps({"keep_generations": 2})
+    )
+    builds = paths.cache / "builds"
+    builds.mkdir(parents=True)
+    names = [f"a__tool-{commit}-abcd.apm" for commit in ("aaa", "bbb", "ccc")]
+
+    for age, name in enumerate(reversed(names)):
+        (builds / name).touch()
+        os.utime(builds / name, (1000 - age, 1000 - age))
+
+    (builds / "a__tool-x-aaa-abcd.apm").touch()
+    os.utime(builds / "a__tool-x-aaa-abcd.apm", (0, 0))
+
+    lockfile.prune_builds(paths, "a/tool")
+
+    assert sorted(build.name for build in builds.iterdir()) == sorted(
+        names[1:] + ["a__tool-x-aaa-abcd.apm"]
+    )
+
+
+def test_rollback_restores_the_installed_version(paths: Paths) -> None:
+    source = paths.source / "a/tool/.avalon"
+    source.mkdir(parents=True)
+
+    for version, commit in [("1.0.0", "c1"), ("2.0.0", "c2")]:
+        (source / "package").write_text(json.dumps({"version": version}))
+        staged = Paths(files=paths.temp / version, binaries=paths.temp / "bin")
+        (staged.files / "a/tool").mkdir(parents=True)
+        generations.publish_generation(paths, staged, "a/tool", commit)
+
+    assert metadata.get_package_version(paths, "a/tool") == "2.0.0"
+
+    generations.rollback_package(SimpleNamespace(), paths, "a/tool")
+
+    assert metadata.get_package_version(paths, "a/tool") == "1.0.0"
+    assert lockfile.get_installed_state(paths, "a/tool").commit == "c1"
+    assert lockfile.get_installed_state(paths, "a/tool").version == "1.0.0"
@@ -0,0 +1,54 @@
+import subprocess
+import sys
+
+from pathlib import Path
+
+from apm.locks import lock, package_lock
+from apm.path import Paths, get_run_temp
+
+TRY_LOCK = """
+import fcntl, sys
+with open(sys.argv[1], "a+") as file:
+    try:
+        fcntl.lockf(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        sys.exit(1)
+"""
+
+
+def is_free(paths: Paths, name: str) -> bool:
+    "Whether another process could take the lock right now."
+
+    lock_path = paths.cache / "locks" / (name.replace("/", "__") + ".lock")
+
+    return (
+        subprocess.run(
+            [sys.executable, "-c", TRY_LOCK, lock_path], check=False
+        )
+    ).returncode == 0
+
+
+def test_package_locks_exclude_other_processes(tmp_path: Path) -> None:
+    paths = Paths(cache=tmp_path / "cache")
+
+    with package_lock(paths, "A/Tool"):
+        # Re-entrant, e.g. for a package installing itself via update.
+        with package_lock(paths, "a/tool"):
+            assert not is_free(paths, "a/tool")
+
+        assert not is_free(paths, "a/tool")
+
+        with lock(paths, "b/other"):
+            assert not is_free(paths, "b/other")
+
+    assert is_free(paths, "a/tool")
+    assert is_free(paths, "b/other")
+
+
+def test_run_temp_is_unique_to_the_run(tmp_path: Path) -> None:
+    paths = Paths(temp=tmp_path / "tmp")
+    run_temp = get_run_temp(paths)
+
+    assert run_temp.is_dir()
+    assert run_temp.parent == paths.temp
+    assert get_run_temp(paths) == run_temp
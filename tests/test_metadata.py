@@ -0,0 +1,140 @@
+import subprocess
+import time
+
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+pytest.importorskip("kazparse")
+
+from apm import metadata  # pylint: disable=wrong-import-position
+from apm.locks import METADATA, lock  # pylint: disable=wrong-import-position
+from apm.package import Package  # pylint: disable=wrong-import-position
+from apm.path import Paths  # pylint: disable=wrong-import-position
+
+
+def test_metadata_is_read_once(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    paths = Paths(source=tmp_path / "src", metadata=tmp_path / "cache")
+    package_file = paths.source / "a/b/.avalon/package"
+    package_file.parent.mkdir(parents=True)
+    package_file.write_text('{"version": "1.0.0"}')
+    remote = []
+
+    monkeypatch.setattr(
+        metadata,
+        "get_remote_package_metadata",
+        lambda *args, **kwargs: remote.append(args),
+    )
+    repository = metadata.get_metadata_repository(paths)
+
+    assert metadata.get_package_metadata(paths, "a/b").version == "1.0.0"
+
+    package_file.write_text('{"version": "2.0.0"}')
+    assert metadata.get_package_metadata(paths, "a/b").version == "1.0.0"
+
+    repository.invalidate("a/b")
+    assert metadata.get_package_metadata(paths, "a/b").version == "2.0.0"
+
+    assert repository.get("c/d") is None
+    assert repository.get("c/d") is None
+    assert len(remote) == 1
+
+
+def test_metadata_invalidated_while_read_is_not_kept(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    paths = Paths(source=tmp_path / "src", metadata=tmp_path / "cache")
+    repository = metadata.MetadataRepository(paths)
+    reads: list[str] = []
+
+    def read(_paths: Paths, package_name: str) -> Package:
+        reads.append(package_name)
+
+        if len(reads) == 1:
+            # e.g. another thread replacing the source.
+            repository.invalidate(package_name)
+
+        return Package(version=str(len(reads)))
+
+    monkeypatch.setattr(metadata, "get_local_package_metadata", read)
+
+    assert repository.get("a/b") == Package(version="1")
+    assert repository.get("a/b") == Package(version="2")
+    assert repository.get("a/b") == Package(version="2")
+
+
+def test_remote_metadata_of_a_commit_on_a_branch(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    urls: list[str] = []
+
+    class Response:
+        status_code = 200
+
+        def __init__(self, url: str) -> None:
+            self.text = url
+
+        def json(self) -> dict[str, str]:
+            return {"version": "1.0.0"}
+
+    def request(_paths: Paths, _method: str, url: str) -> Response:
+        urls.append(url)
+        return Response(url)
+
+    monkeypatch.setattr(metadata, "request", request)
+    monkeypatch.setattr(
+        metadata, "get_ranked_mirrors", lambda *_: ["https://raw"]
+    )
+
+    package = metadata.get_remote_package_metadata(
+        Paths(cache=tmp_path), "a/b", commit="abc123", branch="dev"
+    )
+
+    assert package == Package(version="1.0.0")
+    assert urls == ["https://raw/a/b/abc123/.avalon/package"]
+
+
+def commit(repository: Path, name: str) -> None:
+    (repository / name).write_text(name)
+
+    for command in [
+        ["add", name],
+        ["-c", "user.name=a", "-c", "user.email=a@a", "commit", "-qm", name],
+    ]:
+        subprocess.run(["git", *command], cwd=repository, check=True)
+
+
+def test_background_refresh_waits_for_the_lock(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    paths = Paths(cache=tmp_path / "avalon", metadata=tmp_path / "cache")
+    (tmp_path / "remote").mkdir()
+    subprocess.run(["git", "init", "-q"], cwd=tmp_path / "remote", check=True)
+    commit(tmp_path / "remote", "old")
+    subprocess.run(
+        ["git", "clone", "-q", tmp_path / "remote", paths.metadata], check=True
+    )
+    commit(tmp_path / "remote", "new")
+
+    processes: list[subprocess.Popen[bytes]] = []
+    start = subprocess.Popen
+
+    def popen(*args: Any, **kwargs: Any) -> subprocess.Popen[bytes]:
+        processes.append(start(*args, **kwargs))
+        return processes[-1]
+
+    monkeypatch.setattr(subprocess, "Popen", popen)
+
+    with lock(paths, METADATA):
+        metadata.refresh_metadata_repository_in_background(paths)
+        time.sleep(0.5)
+
+        assert processes[0].poll() is None
+        assert not (paths.metadata / "new").exists()
+
+    assert processes[0].wait(timeout=30) == 0
+    assert (paths.metadata / "new").exists()
+    assert metadata.get_metadata_repository_age(paths) is not None
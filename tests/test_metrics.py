@@ -0,0 +1,72 @@
+import json
+
+from pathlib import Path
+
+import pytest
+
+from apm import events, timings
+from apm.config import _loaded
+from apm.metrics import session
+from apm.path import Paths
+
+
+def run_install(paths: Paths, fail: bool = False) -> None:
+    with session(paths), events.session(False, "install", ("a/tool",)):
+        events.emit("cache", cache="build", hit=not fail)
+        events.emit("transfer", operation="clone", bytes=3_000_000_000)
+
+        with timings.phase("compile", package="a/tool"):
+            if fail:
+                raise SystemExit(1)
+
+
+def test_metrics_add_up_across_runs(tmp_path: Path) -> None:
+    paths = Paths(root=tmp_path / "root", cache=tmp_path / "cache")
+    paths.root.mkdir()
+    metrics_file = tmp_path / "textfile" / "apm.prom"
+    (paths.root / "config.json").write_text(
+        json.dumps({"metrics_file": str(metrics_file)})
+    )
+    _loaded.clear()
+
+    try:
+        run_install(paths)
+
+        with pytest.raises(SystemExit):
+            run_install(paths, fail=True)
+
+    finally:
+        _loaded.clear()
+
+    text = metrics_file.read_text()
+
+    assert "# TYPE apm_runs_total counter" in text
+    assert 'apm_runs_total{command="install",status="success"} 1' in text
+    assert 'apm_runs_total{command="install",status="failure"} 1' in text
+    assert (
+        'apm_package_results_total{package="a/tool",result="failure"} 1'
+        in text
+    )
+    assert (
+        'apm_package_results_total{package="a/tool",result="success"} 1'
+        in text
+    )
+    assert 'apm_fetched_bytes_total{operation="clone"} 6000000000' in text
+    assert 'apm_cache_hit_ratio{cache="build"} 0.5' in text
+    assert 'apm_phase_duration_seconds_count{phase="compile"} 2' in text
+    assert (
+        'apm_phase_duration_seconds_bucket{phase="compile",le="+Inf"} 2'
+        in text
+    )
+    assert [path.name for path in metrics_file.parent.iterdir()] == [
+        "apm.prom"
+    ]
+    assert not events.IS_ENABLED
+
+
+def test_no_metrics_by_default(tmp_path: Path) -> None:
+    paths = Paths(root=tmp_path / "root", cache=tmp_path / "cache")
+    _loaded.clear()
+    run_install(paths)
+
+    assert not paths.cache.exists()
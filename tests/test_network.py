@@ -0,0 +1,163 @@
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import pytest
+import requests
+
+from apm import http, network
+from apm.git import TIMED_OUT
+from apm.path import Paths
+from apm.transfers import Transfer, run_transfer
+
+
+@pytest.fixture(autouse=True)
+def reset_network(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(network, "_breakers", {})
+    monkeypatch.setattr(network, "_deadline", None)
+    monkeypatch.setattr(time, "sleep", lambda _: None)
+
+
+@dataclass
+class Response:
+    status_code: int
+
+    def close(self) -> None:
+        pass
+
+
+class Session:
+    "Answers requests with the given statuses, or raises exceptions."
+
+    def __init__(self, *answers: int | Exception) -> None:
+        self.answers = list(answers)
+        self.timeouts: list[float] = []
+
+    def request(
+        self, _method: str, _url: str, timeout: float, **_: Any
+    ) -> Response:
+        self.timeouts.append(timeout)
+        answer = self.answers.pop(0)
+
+        if isinstance(answer, Exception):
+            raise answer
+
+        return Response(answer)
+
+
+def test_get_host() -> None:
+    assert (
+        network.get_host("https://user@github.com:443/a/b") == "github.com:443"
+    )
+    assert network.get_host("git@github.com:a/b") == "github.com"
+    assert network.get_host("file:///srv/git/a") == ""
+
+
+def test_request_retries_transient_failures(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    session = Session(requests.ConnectionError(), 503, 404)
+    monkeypatch.setattr(http, "_session", session)
+
+    response = network.request(
+        Paths(root=tmp_path), "GET", "https://a.example/x"
+    )
+
+    assert response.status_code == 404
+    assert session.timeouts == [10.0, 10.0, 10.0]
+    assert network.is_available("a.example")
+
+
+def test_breaker_skips_failing_host(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(http, "_session", Session(500, 500, 500))
+    paths = Paths(root=tmp_path)
+
+    assert (
+        network.request(paths, "GET", "https://b.example/x").status_code == 500
+    )
+    assert not network.is_available("b.example")
+
+    with pytest.raises(requests.ConnectionError):
+        network.request(paths, "GET", "https://b.example/x")
+
+    network._breakers["b.example"].opened = (
+        time.monotonic() - network.BREAKER_COOLDOWN
+    )
+    assert network.is_available("b.example")
+
+
+def test_one_attempt_is_let_through_after_the_cooldown() -> None:
+    for _ in range(network.BREAKER_THRESHOLD):
+        network.record_failure("d.example")
+
+    network._breakers["d.example"].opened = (
+        time.monotonic() - network.BREAKER_COOLDOWN
+    )
+
+    assert network.start_attempt("d.example")
+    assert not network.start_attempt("d.example")
+    assert not network.is_available("d.example")
+
+    network.record_failure("d.example")
+    assert not network.start_attempt("d.example")
+
+    network._breakers["d.example"].opened = (
+        time.monotonic() - network.BREAKER_COOLDOWN
+    )
+
+    assert network.start_attempt("d.example")
+    network.record_success("d.example")
+    assert network.start_attempt("d.example")
+    assert network.start_attempt("d.example")
+
+
+def test_deadline_limits_attempts(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    session = Session(200)
+    monkeypatch.setattr(http, "_session", session)
+    monkeypatch.setattr(network, "_deadline", time.monotonic() + 2)
+
+    network.request(Paths(root=tmp_path), "GET", "https://c.example/x")
+    assert 0 < session.timeouts[0] <= 2
+
+    monkeypatch.setattr(network, "_deadline", time.monotonic())
+
+    with pytest.raises(requests.Timeout):
+        network.request(Paths(root=tmp_path), "GET", "https://c.example/x")
+
+
+def test_backoff_is_jittered_and_capped() -> None:
+    assert 0.25 <= network.get_backoff(0) <= 0.5
+    assert (
+        network.BACKOFF_CAP / 2
+        <= network.get_backoff(20)
+        <= network.BACKOFF_CAP
+    )
+
+
+def test_transient_git_errors() -> None:
+    assert network.is_transient_git_error(
+        [
+            "error: RPC failed; curl 28 Operation too slow. "
+            "Less than 1000 bytes/sec"
+        ]
+    )
+    assert not network.is_transient_git_error(
+        ["remote: Repository not found.", "fatal: repository not found"]
+    )
+
+
+def test_transfer_stops_at_deadline() -> None:
+    transfer = Transfer("a/tool", "clone")
+    start = time.monotonic()
+
+    assert (
+        run_transfer(transfer, ["sleep", "10"], None, timeout=0.2) == TIMED_OUT
+    )
+    assert time.monotonic() - start < 5
+    assert "deadline" in transfer.messages[-1]
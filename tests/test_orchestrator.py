@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("kazparse")
+
+# pylint: disable=wrong-import-position
+from apm import orchestrator, resolver
+from apm.locks import package_lock
+from apm.path import Paths
+from apm.resolver import Candidate
+
+DEPENDENCIES = {"a/b": ["a/d"], "a/c": [], "a/d": []}
+
+
+@pytest.fixture(name="events")
+def fixture_events(monkeypatch: pytest.MonkeyPatch) -> list[tuple[str, str]]:
+    events: list[tuple[str, str]] = []
+    lock = threading.Lock()
+
+    def fetch(self: orchestrator.Orchestrator, candidate: Candidate) -> None:
+        package_dir = self.paths.source / candidate.name / ".avalon"
+        package_dir.mkdir(parents=True)
+        (package_dir / "package").write_text(
+            json.dumps({"deps": {"avalon": DEPENDENCIES[candidate.name]}})
+        )
+
+        with lock:
+            events.append(("fetch", candidate.name))
+
+    def build(
+        _self: orchestrator.Orchestrator, package_name: str, _prebuilt: object
+    ) -> None:
+        time.sleep(0.05)
+
+        with lock:
+            events.append(("build", package_name))
+
+    monkeypatch.setattr(orchestrator.Orchestrator, "fetch", fetch)
+    monkeypatch.setattr(orchestrator.Orchestrator, "build", build)
+    monkeypatch.setattr(
+        orchestrator, "install_system_dependencies", lambda *_args: None
+    )
+    monkeypatch.setattr(resolver, "_resolved", {})
+
+    for name in DEPENDENCIES:
+        resolver._resolved[name] = Candidate(name, None)
+
+    resolver._resolved["a/e"] = Candidate("a/e", None, installed=True)
+
+    return events
+
+
+def get_paths(tmp_path: Path) -> Paths:
+    return Paths(
+        root=tmp_path / "root",
+        cache=tmp_path / "cache",
+        source=tmp_path / "src",
+    )
+
+
+def run(tmp_path: Path, names: list[str]) -> None:
+    paths = get_paths(tmp_path)
+    flags = SimpleNamespace(force=False, noinstall=False)
+    orchestrator.install_dependencies(flags, paths, "r/root", names)
+
+
+def test_dependencies_are_built_after_their_dependencies(
+    tmp_path: Path, events: list[tuple[str, str]]
+) -> None:
+    run(tmp_path, ["a/b", "a/c", "a/e"])
+
+    builds = [name for event, name in events if event == "build"]
+
+    assert sorted(builds) == ["a/b", "a/c", "a/d"]
+    assert builds.index("a/d") < builds.index("a/b")
+    # Everything is downloaded while the first package compiles.
+    assert [event for event, _name in events[:3]] == ["fetch"] * 3
+
+
+def test_dependency_cycles_are_reported(
+    tmp_path: Path,
+    events: list[tuple[str, str]],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setitem(DEPENDENCIES, "a/d", ["a/b"])
+
+    with pytest.raises(SystemExit):
+        run(tmp_path, ["a/b"])
+
+    assert not [event for event in events if event[0] == "build"]
+
+
+def test_a_busy_package_does_not_hold_up_the_others(
+    tmp_path: Path, events: list[tuple[str, str]]
+) -> None:
+    locked = threading.Event()
+
+    def hold() -> None:
+        # e.g. another apm building the package.
+        with package_lock(get_paths(tmp_path), "a/c"):
+            locked.set()
+            deadline = time.monotonic() + 5
+
+            while (
+                "build",
+                "a/b",
+            ) not in events and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    locked.wait()
+
+    try:
+        run(tmp_path, ["a/c", "a/b"])
+
+    finally:
+        holder.join()
+
+    builds = [name for event, name in events if event == "build"]
+
+    assert builds == ["a/d", "a/b", "a/c"]
@@ -0,0 +1,100 @@
+import os
+
+from concurrent.futures import Future
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("kazparse")
+
+# pylint: disable=wrong-import-position
+from apm import build, generations
+from apm.archive import pack
+from apm.package import Package
+from apm.path import Paths
+from apm.build import install_prebuilt_package, stage_install
+
+
+def make_artifact(tmp_path: Path, files: list[str]) -> Path:
+    build = tmp_path / "build"
+    build.mkdir()
+
+    for name in files:
+        (build / name).write_text("#!/bin/sh\n")
+
+    pack(build, tmp_path / "tool.apm", [build / name for name in files])
+
+    return tmp_path / "tool.apm"
+
+
+def test_prebuilt_artifact_is_installed(tmp_path: Path) -> None:
+    paths = Paths(files=tmp_path / "files", binaries=tmp_path / "bin")
+    artifact = make_artifact(tmp_path, ["tool"])
+
+    assert install_prebuilt_package(
+        paths, "a/tool", Package(binname="tool"), artifact
+    )
+    assert (paths.binaries / "tool").resolve() == paths.files / "a/tool/tool"
+    assert not artifact.exists()
+
+
+def test_prebuilt_artifact_without_the_binary_is_not_used(
+    tmp_path: Path,
+) -> None:
+    paths = Paths(files=tmp_path / "files", binaries=tmp_path / "bin")
+    artifact = make_artifact(tmp_path, ["other"])
+
+    assert not install_prebuilt_package(
+        paths, "a/tool", Package(binname="tool"), artifact
+    )
+    assert not list((paths.files / "a/tool").iterdir())
+    assert not (paths.binaries / "tool").exists()
+
+
+def test_staged_builds_install_into_their_generation(tmp_path: Path) -> None:
+    paths = Paths(files=tmp_path / "files", binaries=tmp_path / "bin")
+    artifact = make_artifact(tmp_path, ["tool"])
+
+    with stage_install(paths, "a/tool") as staged:
+        assert install_prebuilt_package(
+            staged, "a/tool", Package(binname="tool"), artifact
+        )
+        built_in = (staged.files / "a/tool").resolve()
+        generations.publish_generation(paths, staged, "a/tool")
+
+    assert built_in == generations.get_generations_dir(paths, "a/tool") / "1"
+    assert (built_in / "tool").is_file()
+    assert os.readlink(paths.binaries / "tool") == str(
+        paths.files / "a/tool/tool"
+    )
+
+    with pytest.raises(RuntimeError):
+        with stage_install(paths, "a/tool"):
+            raise RuntimeError
+
+    assert generations.list_generation_dirs(paths, "a/tool") == [1]
+    assert not list((paths.files / ".staging").iterdir())
+
+
+def test_failed_prebuilt_downloads_are_built_from_source(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    paths = Paths(
+        root=tmp_path / "root",
+        source=tmp_path / "src",
+        files=tmp_path / "files",
+        binaries=tmp_path / "bin",
+    )
+    (paths.source / "a/tool").mkdir(parents=True)
+    (paths.source / "a/tool/build.sh").write_text('echo built > "$1/tool"\n')
+    package = Package(
+        binname="tool", needsCompiled=True, compileScript="build.sh"
+    )
+    monkeypatch.setattr(build, "get_package_metadata", lambda *_: package)
+    prebuilt: Future[Path | None] = Future()
+    prebuilt.set_exception(OSError("No space left on device"))
+
+    build.build_package("a/tool", paths, SimpleNamespace(), prebuilt)
+
+    assert (paths.binaries / "tool").read_text() == "built\n"
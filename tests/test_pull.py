@@ -0,0 +1,135 @@
+import json
+import subprocess
+import sys
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("kazparse")
+
+# pylint: disable=wrong-import-position
+from apm import build, pm_util
+from apm.metadata import REFRESHED_STAMP
+from apm.path import Paths
+from apm.sources import pull_package
+
+
+def run(*args: str | Path, cwd: Path) -> str:
+    return subprocess.run(
+        [str(arg) for arg in args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def commit(repository: Path, text: str) -> str:
+    (repository / "file").write_text(text)
+    run("git", "add", "file", cwd=repository)
+    run(
+        "git",
+        "-c",
+        "user.name=apm",
+        "-c",
+        "user.email=apm@example.com",
+        "commit",
+        "-qm",
+        text,
+        cwd=repository,
+    )
+
+    return run("git", "rev-parse", "HEAD", cwd=repository)
+
+
+def test_pull_only_fetches_changes(tmp_path: Path) -> None:
+    origin = tmp_path / "origin"
+    origin.mkdir()
+    run("git", "init", "-q", "-b", "main", cwd=origin)
+    commit(origin, "1")
+
+    paths = Paths(source=tmp_path / "src")
+    package_dir = paths.source / "a/tool"
+    package_dir.parent.mkdir(parents=True)
+    run(
+        "git",
+        "clone",
+        "-q",
+        "--depth",
+        "1",
+        f"file://{origin}",
+        package_dir,
+        cwd=tmp_path,
+    )
+
+    first = run("git", "rev-parse", "HEAD", cwd=package_dir)
+    assert pull_package(paths, "a/tool") == first
+
+    second = commit(origin, "2")
+    # Build scripts may have changed tracked files.
+    (package_dir / "file").write_text("built")
+
+    assert pull_package(paths, "a/tool") == second
+    assert run("git", "rev-parse", "HEAD", cwd=package_dir) == second
+    assert (package_dir / "file").read_text() == "2"
+    assert run("git", "rev-list", "--count", "HEAD", cwd=package_dir) == "1"
+    assert pull_package(paths, "a/tool") == second
+
+    # An installed commit or tag is pinned.
+    run("git", "checkout", "-q", "--detach", cwd=package_dir)
+    commit(origin, "3")
+
+    assert pull_package(paths, "a/tool") == second
+    assert run("git", "rev-parse", "HEAD", cwd=package_dir) == second
+
+
+def test_update_resyncs_directory_installs(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    paths = Paths(
+        root=tmp_path / "root",
+        cache=tmp_path / "cache",
+        source=tmp_path / "src",
+        binaries=tmp_path / "bin",
+        metadata=tmp_path / "metadata",
+        files=tmp_path / "files",
+        temp=tmp_path / "tmp",
+    )
+    (paths.metadata / ".git").mkdir(parents=True)
+    (paths.metadata / ".git" / REFRESHED_STAMP).touch()
+    flags = SimpleNamespace(
+        debug=False,
+        force=False,
+        fresh=False,
+        update=False,
+        noinstall=False,
+        timings=False,
+        machine=False,
+    )
+    package_dir = tmp_path / "tool"
+    (package_dir / ".avalon").mkdir(parents=True)
+    (package_dir / ".avalon/package").write_text(
+        json.dumps({"author": "a", "repo": "tool", "toCopy": ["tool.sh"]})
+    )
+    (package_dir / "tool.sh").write_text("echo 1\n")
+
+    pm_util.install_package_from_directory(flags, paths, [str(package_dir)])
+    assert (paths.files / "a/tool/tool.sh").read_text() == "echo 1\n"
+
+    (package_dir / "tool.sh").write_text("echo 2\n")
+    pm_util.update_package(flags, paths, "a/tool")
+    assert (paths.files / "a/tool/tool.sh").read_text() == "echo 2\n"
+
+    # A failed build is retried, although the files were synced already.
+    (package_dir / "tool.sh").write_text("echo 3\n")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(build, "build_package", lambda *_: sys.exit(1))
+
+        with pytest.raises(SystemExit):
+            pm_util.update_package(flags, paths, "a/tool")
+
+    pm_util.update_package(flags, paths, "a/tool")
+    assert (paths.files / "a/tool/tool.sh").read_text() == "echo 3\n"
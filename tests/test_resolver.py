@@ -0,0 +1,121 @@
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+pytest.importorskip("kazparse")
+
+# pylint: disable=wrong-import-position
+from apm import resolver
+from apm.package import Package, Requirement, parse_requirement
+from apm.path import Paths
+from apm.resolver import Candidate, Resolver, expand_constraint, parse_version
+
+# name -> version -> Avalon dependencies
+REGISTRY: dict[str, dict[str, list[str]]] = {
+    "a/app": {"1.0.0": ["l/lib>=1.0", "u/util"]},
+    "l/lib": {"2.0.0": ["u/util^2"], "1.5.0": ["u/util~1.1"], "1.0.0": []},
+    "u/util": {"1.2.0": [], "1.1.3": []},
+}
+
+
+@pytest.fixture(name="fake_resolver")
+def fixture_fake_resolver(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> Resolver:
+    def iter_candidates(
+        _self: Resolver, requirement: Requirement
+    ) -> Iterator[Candidate]:
+        for version in REGISTRY[requirement.name]:
+            yield Candidate(
+                requirement.name, parse_version(version), ref=f"v{version}"
+            )
+
+    def get_metadata(_self: Resolver, candidate: Candidate) -> Package:
+        return Package(
+            deps={"avalon": REGISTRY[candidate.name][str(candidate.version)]}
+        )
+
+    monkeypatch.setattr(Resolver, "iter_candidates", iter_candidates)
+    monkeypatch.setattr(Resolver, "get_metadata", get_metadata)
+
+    return Resolver(Paths(files=tmp_path), update=False)
+
+
+def test_parse_requirement() -> None:
+    assert parse_requirement("l/lib >=1.0, <2") == Requirement(
+        "l/lib", constraint=">=1.0, <2"
+    )
+    assert parse_requirement("l/lib/dev:abc123") == Requirement(
+        "l/lib", branch="dev", commit="abc123"
+    )
+
+
+def test_expand_constraint() -> None:
+    assert expand_constraint("^1.2") == [">=1.2.0", "<2.0.0"]
+    assert expand_constraint("^0.3.1") == [">=0.3.1", "<0.4.0"]
+    assert expand_constraint("~1.2.3, !=1.2.4") == [
+        ">=1.2.3",
+        "<1.3.0",
+        "!=1.2.4",
+    ]
+    assert expand_constraint("1.0") == ["==1.0.0"]
+
+    with pytest.raises(ValueError):
+        expand_constraint(">=banana")
+
+
+def test_backtracks_to_a_consistent_version(fake_resolver: Resolver) -> None:
+    resolved = fake_resolver.resolve(
+        resolver.get_requirements(Package(deps={"avalon": ["a/app"]}), "root"),
+        {},
+        {},
+    )
+
+    assert resolved is not None
+    # lib 2.0.0 needs util 2, which does not exist.
+    assert {
+        name: str(candidate.version) for name, candidate in resolved.items()
+    } == {
+        "a/app": "1.0.0",
+        "l/lib": "1.5.0",
+        "u/util": "1.1.3",
+    }
+
+
+def test_reports_conflicts(fake_resolver: Resolver) -> None:
+    requirements = (
+        parse_requirement("u/util>=1.2", "root"),
+        parse_requirement("l/lib==1.5.0", "root"),
+    )
+
+    assert fake_resolver.resolve(requirements, {}, {}) is None
+    assert (
+        "No version of u/util satisfies all of:\n  >=1.2 (required by root)\n"
+        in (resolver.describe_conflicts(fake_resolver.conflicts))
+    )
+
+
+def test_updates_offer_the_remote_default_branch(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    (tmp_path / "files/l/lib").mkdir(parents=True)
+    monkeypatch.setattr(
+        resolver,
+        "get_local_package_metadata",
+        lambda _paths, _name: Package(version="1.0.0"),
+    )
+    monkeypatch.setattr(
+        resolver,
+        "get_remote_package_metadata",
+        lambda _paths, _name, **_refs: Package(version="2.0.0"),
+    )
+    monkeypatch.setattr(Resolver, "get_tags", lambda _self, _name: [])
+
+    for update, version in [(False, "1.0.0"), (True, "2.0.0")]:
+        candidates = Resolver(Paths(files=tmp_path / "files"), update=update)
+        candidate = next(
+            candidates.iter_candidates(parse_requirement("l/lib"))
+        )
+
+        assert str(candidate.version) == version
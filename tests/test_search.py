@@ -0,0 +1,49 @@
+import json
+import os
+
+from pathlib import Path
+
+from apm.path import Paths
+from apm.search import get_search_index
+
+
+def add_package(paths: Paths, name: str, **metadata: str) -> None:
+    package_dir = paths.metadata / name
+    package_dir.mkdir(parents=True, exist_ok=True)
+    (package_dir / "package").write_text(json.dumps(metadata))
+
+
+def test_search(tmp_path: Path) -> None:
+    paths = Paths(cache=tmp_path / "cache", metadata=tmp_path / "metadata")
+    add_package(paths, "R2Boyo25/AvalonGen", description="Generates packages")
+    add_package(
+        paths, "someone/ripgrep", binname="rg", description="Fast grep"
+    )
+    add_package(paths, "someone/fzf", description="Fuzzy finder")
+
+    with get_search_index(paths) as index:
+        results = index.search("avalongen")
+        assert [result.name for result in results] == ["r2boyo25/avalongen"]
+
+        # Fuzzy: a typo still finds it.
+        assert index.search("ripgrap")[0].name == "someone/ripgrep"
+        assert index.search("grep")[0].name == "someone/ripgrep"
+
+
+def test_index_is_updated_incrementally(tmp_path: Path) -> None:
+    paths = Paths(cache=tmp_path / "cache", metadata=tmp_path / "metadata")
+    add_package(paths, "someone/fzf", description="Fuzzy finder")
+    add_package(paths, "someone/bat", description="cat with wings")
+    get_search_index(paths).database.close()
+
+    add_package(paths, "someone/fzf", description="Command-line finder")
+    os.utime(paths.metadata / "someone/fzf/package", ns=(1, 1))
+    (paths.metadata / "someone/bat/package").unlink()
+
+    with get_search_index(paths) as index:
+        assert [
+            name
+            for name, in index.database.execute("SELECT name FROM packages")
+        ] == ["someone/fzf"]
+        assert index.search("fuzzy") == []
+        assert index.search("command")[0].name == "someone/fzf"
@@ -0,0 +1,66 @@
+import asyncio
+
+from apm import timings
+
+
+def test_phases_nest() -> None:
+    with timings.session(True):
+        with timings.phase("install"):
+            with timings.phase("compile", package="user/repo"):
+                pass
+
+        phases = timings.get_phases()
+
+    assert [(phase.name, phase.depth) for phase in phases] == [
+        ("install", 0),
+        ("compile", 1),
+    ]
+    assert phases[0].wall >= phases[1].wall
+    assert "  compile user/repo" in timings.format_summary(phases)
+
+
+def test_phases_nest_across_threads() -> None:
+    def build() -> None:
+        with timings.phase("compile", package="user/dependency"):
+            pass
+
+    async def install() -> None:
+        await asyncio.to_thread(build)
+
+    with timings.session(True):
+        with timings.phase("dependencies"):
+            asyncio.run(install())
+
+        with timings.phase("apt"):
+            pass
+
+        phases = timings.get_phases()
+
+    assert [(phase.name, phase.depth) for phase in phases] == [
+        ("dependencies", 0),
+        ("compile", 1),
+        ("apt", 0),
+    ]
+    assert phases[0].thread != phases[1].thread
+
+
+def test_chrome_trace() -> None:
+    with timings.session(True):
+        with timings.phase("download", package="user/repo"):
+            pass
+
+        trace = timings.to_chrome_trace(timings.get_phases())
+
+    (event,) = trace["traceEvents"]
+    assert event["ph"] == "X"
+    assert event["name"] == "download"
+    assert event["args"]["package"] == "user/repo"
+
+
+def test_disabled_records_nothing() -> None:
+    timings.reset()
+
+    with timings.phase("install"):
+        pass
+
+    assert not timings.get_phases()
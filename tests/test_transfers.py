@@ -0,0 +1,97 @@
+import json
+import subprocess
+
+from pathlib import Path
+
+from apm.path import Paths
+from apm.transfers import (
+    Transfer,
+    format_progress,
+    format_transfers,
+    git_transfer,
+    parse_progress,
+    read_transfers,
+)
+
+
+def test_parse_progress() -> None:
+    transfer = Transfer("a/tool", "clone")
+
+    for line in [
+        "Cloning into 'tool'...",
+        "remote: Enumerating objects: 1000, done.",
+        "remote: Counting objects:  50% (500/1000)",
+        "Receiving objects:  45% (450/1000), 1.50 MiB | 2.00 MiB/s",
+        "Resolving deltas:  10% (10/100)",
+    ]:
+        parse_progress(transfer, line)
+
+    assert transfer.percent == 45
+    assert (transfer.objects, transfer.total_objects) == (450, 1000)
+    assert transfer.received == 1572864
+    assert transfer.messages == [
+        "Cloning into 'tool'...",
+        "remote: Enumerating objects: 1000, done.",
+    ]
+
+    parse_progress(
+        transfer, "Unpacking objects: 100% (3/3), 2.00 KiB | 1.00 MiB/s"
+    )
+    assert transfer.received == 2048
+
+    assert format_progress([transfer], 80) == (
+        "Downloading a/tool 100% (3/3) 2.0 KiB"
+    )
+    assert format_progress([transfer], 15) == "Downloading a/t"
+
+
+def test_git_transfer_records_clone(tmp_path: Path) -> None:
+    origin = tmp_path / "origin"
+    origin.mkdir()
+
+    def run(*args: str | Path, cwd: Path = origin) -> None:
+        subprocess.run([str(arg) for arg in args], cwd=cwd, check=True)
+
+    run("git", "init", "-q", "-b", "main")
+    (origin / "file").write_text("contents" * 1000)
+    run("git", "add", "file")
+    run(
+        "git",
+        "-c",
+        "user.name=apm",
+        "-c",
+        "user.email=apm@example.com",
+        "commit",
+        "-qm",
+        "1",
+    )
+
+    paths = Paths(source=tmp_path / "src", cache=tmp_path / "cache")
+    package_dir = paths.source / "a/tool"
+    package_dir.parent.mkdir(parents=True)
+
+    assert not git_transfer(
+        paths,
+        "a/tool",
+        "clone",
+        "--depth",
+        "1",
+        f"file://{origin}",
+        package_dir,
+    )
+    assert (package_dir / "file").exists()
+
+    record = read_transfers(paths)["a/tool"]["clone"]
+    assert record["bytes"] > 0
+    assert record["shallow"] and not record["partial"]
+    assert format_transfers(read_transfers(paths)).splitlines()[1].split()[
+        :2
+    ] == [
+        "a/tool",
+        "clone",
+    ]
+
+    assert git_transfer(paths, "a/tool", "fetch", "origin", "missing")
+    assert set(
+        json.loads((paths.cache / "transfers.json").read_text())["a/tool"]
+    ) == {"clone"}